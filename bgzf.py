@@ -0,0 +1,702 @@
+'''
+BGZF (blocked gzip) output and tabix indexing readable by htslib, i.e. bgzip/tabix compatible,
+and reading of gzip and BGZF files with decompression in background threads
+'''
+import cStringIO
+import gzip
+import os
+import Queue
+import struct
+import threading
+import zlib
+
+#same maximal uncompressed block size as bgzip
+BLOCK_SIZE = 0xff00
+MAX_BLOCK_SIZE = 0x10000
+#empty block marking the end of a BGZF file
+EOF_BLOCK = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+GZIP_MAGIC = '\x1f\x8b'
+#compressed bytes read and decompressed at a time
+READ_CHUNK_SIZE = 1 << 22
+#decompressed chunks buffered ahead of the reader
+READ_AHEAD_CHUNKS = 4
+
+#tabix parameters, same as tabix -p vcf
+TBI_MIN_SHIFT = 14
+TBI_META_BIN = 37450
+TBX_VCF = 2
+
+
+def thread_pool(threads):
+    '''
+    :return: pool of threads, None for a single thread. multiprocessing is only imported for a pool
+    '''
+    if threads <= 1:
+        return None
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(threads)
+
+
+def compress_block(data, level = zlib.Z_DEFAULT_COMPRESSION):
+    '''
+    compress data into one BGZF block
+    :param data: at most BLOCK_SIZE bytes
+    :param level: zlib compression level
+    :return: BGZF block
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) + 26 > MAX_BLOCK_SIZE:
+        #incompressible data, store it as is so that the block does not have to be split
+        return compress_block(data, 0)
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(compressed) + 25)
+    return header + compressed + struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BgzfWriter(object):
+    '''
+    write a BGZF file, data is compressed in BLOCK_SIZE chunks
+    with threads > 1, batches of blocks are compressed in the background while more data is written
+    '''
+    def __init__(self, filename, level = zlib.Z_DEFAULT_COMPRESSION, threads = 1):
+        self.filename = filename
+        self.level = level
+        self.handle = open(filename, 'wb')
+        self.address = 0
+        self.buffer = []
+        self.buffer_size = 0
+        #number of blocks handed over for compression, and file address of each block written
+        self.blocks = 0
+        self.block_addresses = [0]
+        self.pending = []
+        self.in_flight = None
+        self.pool = thread_pool(threads)
+        self.batch_size = 4 * threads
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= BLOCK_SIZE:
+            self.flush_blocks()
+
+    def tell(self):
+        '''
+        :return: block offset (block number << 16 | offset in block) of the next byte written,
+                 turned into a virtual offset by virtual_offset once the block is written
+        '''
+        return (self.blocks << 16) | self.buffer_size
+
+    def virtual_offset(self, block_offset):
+        '''
+        :return: virtual offset (block address << 16 | offset in block) of a block offset from tell
+        '''
+        return (self.block_addresses[block_offset >> 16] << 16) | (block_offset & 0xffff)
+
+    def compress(self, data):
+        return compress_block(data, self.level)
+
+    def flush_blocks(self, flush_all = False):
+        '''
+        compress full blocks, and the remaining partial block if flush_all
+        '''
+        data = ''.join(self.buffer)
+        start = 0
+        while len(data) - start >= BLOCK_SIZE or (flush_all and start < len(data)):
+            self.pending.append(data[start:start + BLOCK_SIZE])
+            self.blocks += 1
+            start += BLOCK_SIZE
+        data = data[start:]
+        self.buffer = [data] if data else []
+        self.buffer_size = len(data)
+        if len(self.pending) >= self.batch_size or (flush_all and self.pending):
+            self.submit_blocks()
+        if flush_all:
+            self.write_in_flight()
+
+    def submit_blocks(self):
+        '''
+        compress pending blocks, in the background if threaded
+        '''
+        blocks, self.pending = self.pending, []
+        if self.pool is None:
+            self.write_blocks([self.compress(block) for block in blocks])
+            return
+        #keep at most one batch in flight so that blocks are written in order
+        self.write_in_flight()
+        self.in_flight = self.pool.map_async(self.compress, blocks)
+
+    def write_in_flight(self):
+        if self.in_flight is not None:
+            blocks = self.in_flight.get()
+            self.in_flight = None
+            self.write_blocks(blocks)
+
+    def write_blocks(self, blocks):
+        for block in blocks:
+            self.handle.write(block)
+            self.address += len(block)
+            self.block_addresses.append(self.address)
+
+    def close(self):
+        if self.handle.closed:
+            return
+        try:
+            self.flush_blocks(flush_all = True)
+            self.handle.write(EOF_BLOCK)
+        finally:
+            self.handle.close()
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def bgzf_block_size(data, offset = 0):
+    '''
+    :return: size of the BGZF block starting at offset of data, None if there is no complete BGZF header there
+    '''
+    if len(data) < offset + 18 or data[offset:offset + 4] != '\x1f\x8b\x08\x04':
+        return None
+    extra_length, = struct.unpack_from('<H', data, offset + 10)
+    extra = offset + 12
+    if len(data) < extra + extra_length:
+        return None
+    while extra + 4 <= offset + 12 + extra_length:
+        field_length, = struct.unpack_from('<H', data, extra + 2)
+        if data[extra:extra + 2] == 'BC' and field_length == 2:
+            return struct.unpack_from('<H', data, extra + 4)[0] + 1
+        extra += 4 + field_length
+    return None
+
+
+def inflate_block(block):
+    '''
+    :return: data of a BGZF block
+    '''
+    extra_length, = struct.unpack_from('<H', block, 10)
+    data = zlib.decompress(block[12 + extra_length:-8], -zlib.MAX_WBITS)
+    crc, size = struct.unpack_from('<2I', block, len(block) - 8)
+    if size != len(data) or crc != zlib.crc32(data) & 0xffffffff:
+        raise IOError('BGZF block with wrong CRC or size')
+    return data
+
+
+def inflate_stream(handle, data = ''):
+    '''
+    decompress the gzip members of a file, starting with data already read from it
+    :return: generator of decompressed data
+    :raise IOError: if the file ends within a member
+    '''
+    while True:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            if not data:
+                data = handle.read(READ_CHUNK_SIZE)
+                if not data:
+                    #a finished member leaves any further input unused, an unfinished one takes it in
+                    try:
+                        decompressed = decompressor.decompress('\0')
+                    except zlib.error:
+                        decompressed = ''
+                    if decompressor.unused_data != '\0':
+                        raise IOError('{} is truncated, it ends within a gzip member'.format(handle.name))
+                    yield decompressed + decompressor.flush()
+                    return
+            decompressed = decompressor.decompress(data)
+            data = decompressor.unused_data
+            if decompressed:
+                yield decompressed
+            if data:
+                break
+        #the member may end right before the end of a chunk, read on to tell whether another member follows
+        while len(data) < len(GZIP_MAGIC):
+            read = handle.read(READ_CHUNK_SIZE)
+            if not read:
+                break
+            data += read
+        #next member, anything else at the end of the file is ignored as gzip does
+        if not data.startswith(GZIP_MAGIC):
+            return
+
+
+def inflate_bgzf(handle, pool = None):
+    '''
+    decompress a BGZF file a batch of blocks at a time, the blocks of a batch in parallel with a pool.
+    Falls back to inflate_stream at the first gzip member that is not a BGZF block
+    :return: generator of decompressed data
+    '''
+    data = ''
+    while True:
+        read = handle.read(READ_CHUNK_SIZE)
+        data += read
+        blocks = []
+        offset = 0
+        while True:
+            size = bgzf_block_size(data, offset)
+            if size is None or offset + size > len(data):
+                break
+            blocks.append(data[offset:offset + size])
+            offset += size
+        data = data[offset:]
+        if blocks:
+            yield ''.join(pool.map(inflate_block, blocks) if pool is not None else map(inflate_block, blocks))
+        if not read or (not blocks and len(data) >= MAX_BLOCK_SIZE + 18):
+            break
+    if not read and bgzf_block_size(data) is not None:
+        raise IOError('{} is truncated, it ends within a BGZF block'.format(handle.name))
+    if data:
+        for decompressed in inflate_stream(handle, data):
+            yield decompressed
+
+
+class GzipReader(object):
+    '''
+    read-only file object over a gzip or BGZF file, decompressed by a background thread
+    (the blocks of BGZF files by threads in parallel) while the lines are read out of large buffers
+    '''
+    def __init__(self, filename, threads = 1):
+        self.name = filename
+        self.handle = open(filename, 'rb')
+        self.closed = False
+        #complete lines decompressed and the partial line following them
+        self.lines = cStringIO.StringIO('')
+        self.partial = ''
+        self.eof = False
+        self.queue = Queue.Queue(READ_AHEAD_CHUNKS)
+        self.stop = threading.Event()
+        self.pool = thread_pool(threads)
+        self.thread = threading.Thread(target = self.decompress)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def decompress(self):
+        try:
+            start = self.handle.read(MAX_BLOCK_SIZE)
+            self.handle.seek(0)
+            if bgzf_block_size(start) is not None:
+                chunks = inflate_bgzf(self.handle, self.pool)
+            else:
+                chunks = inflate_stream(self.handle)
+            for chunk in chunks:
+                if chunk and not self.put(chunk):
+                    return
+            self.put(None)
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        '''
+        :return: False if the reader was closed
+        '''
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout = 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def fill(self):
+        '''
+        read the next decompressed lines
+        :return: False at the end of the file
+        '''
+        while not self.eof:
+            chunk = self.queue.get()
+            if isinstance(chunk, Exception):
+                self.eof = True
+                self.close_pool()
+                raise chunk
+            if chunk is None:
+                self.eof = True
+                self.close_pool()
+                self.lines = cStringIO.StringIO(self.partial)
+                self.partial = ''
+                return True
+            data = self.partial + chunk
+            end = data.rfind('\n') + 1
+            self.partial = data[end:]
+            if end:
+                self.lines = cStringIO.StringIO(data[:end])
+                return True
+        return False
+
+    def readline(self):
+        while True:
+            line = self.lines.readline()
+            if line or not self.fill():
+                return line
+
+    def read(self, size = -1):
+        data = []
+        while size < 0 or size > 0:
+            read = self.lines.read() if size < 0 else self.lines.read(size)
+            data.append(read)
+            if size > 0:
+                size -= len(read)
+            if (size < 0 or size > 0) and not self.fill():
+                break
+        return ''.join(data)
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def __iter__(self):
+        while True:
+            for line in self.lines:
+                yield line
+            if not self.fill():
+                return
+
+    def readlines(self):
+        return list(self)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stop.set()
+        self.thread.join()
+        self.handle.close()
+        self.close_pool()
+
+    def close_pool(self):
+        '''
+        stop the threads decompressing BGZF blocks, once the whole file is decompressed or the reader is closed
+        '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def reg2bin(beg, end):
+    '''
+    smallest bin containing [beg, end), as in the SAM specification
+    '''
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+def compress_binning(bins):
+    '''
+    move the chunks of bins spanning less than 64kb of compressed data into their parent bin, as htslib does
+    :param bins: bin -> list of chunks, modified in place
+    '''
+    for level in xrange(5, 0, -1):
+        first_bin = ((1 << (3 * level)) - 1) // 7
+        for bin in [b for b in bins if b >= first_bin]:
+            chunks = bins[bin]
+            if level < 5:
+                chunks.sort()
+            parent = (bin - 1) >> 3
+            if (chunks[-1][1] >> 16) - (chunks[0][0] >> 16) < MAX_BLOCK_SIZE and parent in bins:
+                bins[parent].extend(chunks)
+                del bins[bin]
+
+
+def merge_chunks(chunks):
+    '''
+    merge chunks starting in the BGZF block another chunk ends in, as htslib does
+    '''
+    merged = []
+    for chunk in sorted(chunks):
+        if merged and merged[-1][1] >> 16 >= chunk[0] >> 16:
+            merged[-1][1] = max(merged[-1][1], chunk[1])
+        else:
+            merged.append(list(chunk))
+    return merged
+
+
+def vcf_interval(line):
+    '''
+    :return: (chr, 0-based start, end) of a VCF record as computed by tabix -p vcf
+    '''
+    fields = line.split('\t', 8)
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+    info = fields[7] if len(fields) > 7 else ''
+    if info.startswith('END='):
+        end_start = 4
+    else:
+        end_start = info.find(';END=')
+        end_start = end_start + 5 if end_start >= 0 else None
+    if end_start is not None:
+        digits = len(info) - end_start - len(info[end_start:].lstrip('0123456789'))
+        if digits:
+            end = int(info[end_start:end_start + digits])
+    return fields[0], beg, end
+
+
+class TabixIndexer(object):
+    '''
+    build a tabix (.tbi) index from records added in sorted order
+    '''
+    def __init__(self):
+        self.names = []
+        self.tids = {}
+        #per contig: bin -> chunks, linear index, [first offset, last offset, number of records]
+        self.bins = []
+        self.linear = []
+        self.meta = []
+        self.save_bin = None
+        self.save_offset = 0
+        self.last_beg = 0
+        self.last_offset = 0
+
+    def add(self, chrom, beg, end, start_offset, end_offset):
+        '''
+        add a record
+        :param chrom: contig name
+        :param beg: 0-based start
+        :param end: 0-based exclusive end
+        :param start_offset: virtual offset of the record
+        :param end_offset: virtual offset following the record
+        '''
+        if beg < 0:
+            beg = 0
+        if end <= beg:
+            end = beg + 1
+        if not self.names or chrom != self.names[-1]:
+            if chrom in self.tids:
+                raise ValueError('records of {} are not contiguous'.format(chrom))
+            self.close_contig()
+            self.tids[chrom] = len(self.names)
+            self.names.append(chrom)
+            self.bins.append({})
+            self.linear.append([])
+            self.meta.append([start_offset, start_offset, 0])
+        elif beg < self.last_beg:
+            raise ValueError('records of {} are not sorted at {}'.format(chrom, beg + 1))
+
+        linear = self.linear[-1]
+        last_window = (end - 1) >> TBI_MIN_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in xrange(beg >> TBI_MIN_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start_offset
+
+        bin = reg2bin(beg, end)
+        if bin != self.save_bin:
+            if self.save_bin is not None:
+                self.bins[-1].setdefault(self.save_bin, []).append([self.save_offset, start_offset])
+            self.save_bin = bin
+            self.save_offset = start_offset
+        self.meta[-1][1] = end_offset
+        self.meta[-1][2] += 1
+        self.last_beg = beg
+        self.last_offset = end_offset
+
+    def extend(self, other, shift):
+        '''
+        add the contigs of another finished index, for records moved shift bytes further in the compressed file
+        '''
+        self.close_contig()
+        shift <<= 16
+        for tid, name in enumerate(other.names):
+            if name in self.tids:
+                raise ValueError('records of {} are not contiguous'.format(name))
+            self.tids[name] = len(self.names)
+            self.names.append(name)
+            self.bins.append(dict((bin, [[beg + shift, end + shift] for beg, end in chunks]) for bin, chunks in other.bins[tid].iteritems()))
+            self.linear.append([None if offset is None else offset + shift for offset in other.linear[tid]])
+            first_offset, last_offset, n_records = other.meta[tid]
+            self.meta.append([first_offset + shift, last_offset + shift, n_records])
+
+    def close_contig(self):
+        if self.save_bin is not None:
+            self.bins[-1].setdefault(self.save_bin, []).append([self.save_offset, self.last_offset])
+        self.save_bin = None
+        self.last_beg = 0
+
+    def finish(self, final_offset, resolve = None):
+        '''
+        end the last contig at final_offset, the offset following all the data, as htslib does
+        :param resolve: function turning the offsets added into virtual offsets, None if they already are
+        '''
+        if self.names:
+            self.last_offset = final_offset
+            self.meta[-1][1] = final_offset
+        self.close_contig()
+        if resolve is None:
+            return
+        for tid in xrange(len(self.names)):
+            for chunks in self.bins[tid].itervalues():
+                for chunk in chunks:
+                    chunk[0], chunk[1] = resolve(chunk[0]), resolve(chunk[1])
+            self.linear[tid] = [None if offset is None else resolve(offset) for offset in self.linear[tid]]
+            self.meta[tid][0], self.meta[tid][1] = resolve(self.meta[tid][0]), resolve(self.meta[tid][1])
+
+    def write(self, filename):
+        '''
+        write the index, itself BGZF compressed
+        '''
+        self.close_contig()
+        with BgzfWriter(filename) as out:
+            names = ''.join(name + '\0' for name in self.names)
+            out.write(struct.pack('<4s8i', 'TBI\1', len(self.names), TBX_VCF, 1, 2, 0, ord('#'), 0, len(names)))
+            out.write(names)
+            for tid in xrange(len(self.names)):
+                bins = self.bins[tid]
+                compress_binning(bins)
+                out.write(struct.pack('<i', len(bins) + 1))
+                for bin in sorted(bins):
+                    chunks = merge_chunks(bins[bin])
+                    out.write(struct.pack('<Ii', bin, len(chunks)))
+                    out.write(''.join(struct.pack('<2Q', *chunk) for chunk in chunks))
+                first_offset, last_offset, n_records = self.meta[tid]
+                out.write(struct.pack('<Ii4Q', TBI_META_BIN, 2, first_offset, last_offset, n_records, 0))
+                #windows without records point to the closest record before them
+                linear = self.linear[tid]
+                previous = first_offset
+                for window in xrange(len(linear)):
+                    if linear[window] is None:
+                        linear[window] = previous
+                    previous = linear[window]
+                out.write(struct.pack('<i', len(linear)))
+                out.write(struct.pack('<{}Q'.format(len(linear)), *linear))
+            out.write(struct.pack('<Q', 0))
+
+
+def read_tabix_index(filename):
+    '''
+    read a tabix index as written by TabixIndexer.write
+    :return: finished TabixIndexer
+    '''
+    indexer = TabixIndexer()
+    with gzip.open(filename, 'rb') as index_fd:
+        data = index_fd.read()
+    magic, n_ref, _, _, _, _, _, _, names_length = struct.unpack_from('<4s8i', data)
+    if magic != 'TBI\1':
+        raise ValueError('{} is not a tabix index'.format(filename))
+    offset = struct.calcsize('<4s8i')
+    indexer.names = data[offset:offset + names_length].split('\0')[:n_ref]
+    indexer.tids = dict((name, tid) for tid, name in enumerate(indexer.names))
+    offset += names_length
+    for _ in xrange(n_ref):
+        bins = {}
+        meta = [0, 0, 0]
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        for _ in xrange(n_bin):
+            bin, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            chunks = struct.unpack_from('<{}Q'.format(2 * n_chunk), data, offset)
+            offset += 16 * n_chunk
+            if bin == TBI_META_BIN:
+                meta = [chunks[0], chunks[1], chunks[2]]
+            else:
+                bins[bin] = [[chunks[i], chunks[i + 1]] for i in xrange(0, len(chunks), 2)]
+        n_intv, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        indexer.linear.append(list(struct.unpack_from('<{}Q'.format(n_intv), data, offset)))
+        offset += 8 * n_intv
+        indexer.bins.append(bins)
+        indexer.meta.append(meta)
+    return indexer
+
+
+def concatenate_indexed_vcfs(vcfs, filename):
+    '''
+    concatenate BGZF compressed VCFs written by IndexedVcfWriter with separate_header, without decompressing them.
+    The header is taken from the first VCF, the records of the others are copied from the block their first record
+    starts. The index <filename>.tbi is put together from theirs, no contig may be in two VCFs
+    :return: filename
+    '''
+    indexer = TabixIndexer()
+    with open(filename, 'wb') as out:
+        for i, vcf in enumerate(vcfs):
+            index = read_tabix_index(vcf + '.tbi')
+            with open(vcf, 'rb') as piece:
+                end = os.fstat(piece.fileno()).st_size
+                piece.seek(max(end - len(EOF_BLOCK), 0))
+                if piece.read() == EOF_BLOCK:
+                    end -= len(EOF_BLOCK)
+                start = 0
+                if i:
+                    if not index.names:
+                        continue
+                    start = index.meta[0][0] >> 16
+                    if index.meta[0][0] & 0xffff:
+                        raise ValueError('header and records of {} share a BGZF block'.format(vcf))
+                indexer.extend(index, out.tell() - start)
+                piece.seek(start)
+                while start < end:
+                    data = piece.read(min(end - start, 1 << 20))
+                    if not data:
+                        raise IOError('{} is truncated'.format(vcf))
+                    out.write(data)
+                    start += len(data)
+        out.write(EOF_BLOCK)
+    indexer.write(filename + '.tbi')
+    return filename
+
+
+class IndexedVcfWriter(object):
+    '''
+    write a sorted VCF BGZF compressed together with its tabix index <filename>.tbi
+    the index is built from block offsets while writing, no second pass over the output is needed
+    '''
+    def __init__(self, filename, level = zlib.Z_DEFAULT_COMPRESSION, threads = 1, separate_header = False):
+        '''
+        :param separate_header: start the records in a new block, for concatenate_indexed_vcfs
+        '''
+        self.filename = filename
+        self.writer = BgzfWriter(filename, level, threads)
+        self.indexer = TabixIndexer()
+        self.separate_header = separate_header
+
+    def write(self, line):
+        '''
+        write a single header line or record
+        '''
+        if line.startswith('#'):
+            self.writer.write(line)
+            return
+        if self.separate_header:
+            self.writer.flush_blocks(flush_all = True)
+            self.separate_header = False
+        start_offset = self.writer.tell()
+        self.writer.write(line)
+        chrom, beg, end = vcf_interval(line)
+        self.indexer.add(chrom, beg, end, start_offset, self.writer.tell())
+
+    def close(self):
+        if self.writer.handle.closed:
+            return
+        self.writer.flush_blocks(flush_all = True)
+        self.indexer.finish(self.writer.tell(), self.writer.virtual_offset)
+        self.writer.close()
+        self.indexer.write(self.filename + '.tbi')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
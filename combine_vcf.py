@@ -42,19 +42,22 @@ def process(args):
     """
     input_vcfs = args.vcfs
     temp_files = []
-    for i in range(len(args.vcfs)):
-        current_vcf = args.vcfs[i]
+    #combine_vcf merges sorted inputs directly and sorts on its own otherwise,
+    #only a single input has to be turned into an indexed vcf.gz here
+    if len(args.vcfs) == 1:
+        current_vcf = args.vcfs[0]
         if current_vcf.endswith(".gz") and os.path.isfile(current_vcf + ".tbi"):
-            input_vcfs[i] = current_vcf
+            input_vcfs[0] = current_vcf
         elif current_vcf.endswith(".gz"):
             LOGGER.info('indexing {}'.format(current_vcf))
             utils.index_vcf_gz(current_vcf)
-            input_vcfs[i] = current_vcf
+            input_vcfs[0] = current_vcf
         else:
             LOGGER.info('sort and index {}'.format(current_vcf))
-            input_vcfs[i] = utils.sort_and_compress(current_vcf,
-                    '{}.tmp.{}'.format(args.output_prefix, i), mode = 3, overwrite = args.overwrite)
-            temp_files.append(input_vcfs[i])
+            input_vcfs[0] = utils.sort_and_compress(current_vcf,
+                    '{}.tmp.{}'.format(args.output_prefix, 0), mode = 3, overwrite = args.overwrite,
+                    reference = args.reference, threads = args.compress_threads)
+            temp_files.append(input_vcfs[0])
     output_vcf = args.output_prefix + '.vcf'
     if input_vcfs and len(input_vcfs) == 1:
         output_vcf = output_vcf + '.gz'
@@ -68,7 +71,8 @@ def process(args):
             shutil.copyfile(input_vcfs[0], output_vcf_idx)
     else:
         output_vcf = utils.combine_vcf(output_vcf, input_vcfs,
-            duplicate_handling_mode = dup_mode)
+            duplicate_handling_mode = dup_mode, reference = args.reference,
+            threads = args.compress_threads)
     for i in temp_files:
         if not os.path.exists(i):
             continue
@@ -86,6 +90,8 @@ if __name__ == "__main__":
     main_parser.add_argument("--output_prefix", metavar="PREFIX", help="output prefix", required = True)
     main_parser.add_argument("--vcfs", metavar="VCF", help="variant calls to be evaluated", nargs="+", default=[], required = True)
     main_parser.add_argument("--mode", metavar="MODE", help="mode for duplicates", choices = ['first_duplicate','all_duplicate','no_duplicate'], default = 'first_duplicate')
+    main_parser.add_argument("--reference", metavar="FASTA", help="reference with .fai, order contigs as in the .fai instead of version order")
+    main_parser.add_argument("--compress_threads", metavar="INT", help="number of threads for BGZF compression", type = int, default = 1)
     main_parser.add_argument("--overwrite", action = 'store_true', help="overwrite existing files")
     main_parser.add_argument("--loglevel", help="Set logging level", choices=["debug", "warn", "info"], default="info")
 
@@ -8,10 +8,80 @@ import logging
 import shutil
 import utils
 import re
+import heapq
+import bgzf
 LOGGER = None
 
+#sources of records in merge_results
+VARSIM_TP, VARSIM_FN, VCFEVAL_TP, VARSIM_FP, VCFEVAL_TP_PREDICT = range(5)
+
+def tag_records(vcf, source, contig_order = None):
+    '''
+    generate (sort key, source, line) of each record in a sorted VCF
+    '''
+    for key, line in utils.iter_sorted_vcf_records(vcf, contig_order):
+        yield key, source, line
+
+def iter_record_blocks(vcfs, contig_order = None):
+    '''
+    merge sorted VCFs, grouping records at the same sort position
+    (chr, pos, ref and alt as compared by the sort)
+    :param contig_order: see utils.vcf_sort_key
+    :return: generator of lists of (source, line), source being the index in vcfs
+    '''
+    block = []
+    block_key = None
+    for key, source, line in heapq.merge(*[tag_records(vcf, i, contig_order) for i, vcf in enumerate(vcfs)]):
+        if key[:4] != block_key:
+            if block:
+                yield block
+            block = []
+            block_key = key[:4]
+        block.append((source, line))
+    if block:
+        yield block
+
+def write_merged_results(inputs, augmented_tp, augmented_t, augmented_fn, augmented_fp, threads = 1, contig_order = None):
+    '''
+    compute augmented TP, T, FN and FP in one pass over the sorted inputs,
+    outputs are written BGZF compressed and tabix indexed
+    :param inputs: VCFs indexed by VARSIM_TP ... VCFEVAL_TP_PREDICT
+    :param threads: number of BGZF compression threads per output
+    :param contig_order: see utils.vcf_sort_key
+    :raise UnsortedVcfError: if an input is not sorted
+    '''
+    tp_header = utils.read_vcf_header(inputs[VARSIM_TP])
+    fp_header = utils.read_vcf_header(inputs[VARSIM_FP])
+    with bgzf.IndexedVcfWriter(augmented_tp, threads = threads) as tp_out, bgzf.IndexedVcfWriter(augmented_t, threads = threads) as t_out, \
+            bgzf.IndexedVcfWriter(augmented_fn, threads = threads) as fn_out, bgzf.IndexedVcfWriter(augmented_fp, threads = threads) as fp_out:
+        for output, header in ((tp_out, tp_header), (t_out, tp_header), (fn_out, tp_header), (fp_out, fp_header)):
+            for l in header:
+                output.write(l)
+        for block in iter_record_blocks(inputs, contig_order):
+            variants = {}
+            for source, line in block:
+                chr0, pos0, id0, ref0, alt0 = line.rstrip().split()[0:5]
+                variants.setdefault((chr0, pos0, ref0, alt0), []).append((source, line))
+            tp_lines, t_lines, fn_lines, fp_lines = [], [], [], []
+            for records in variants.itervalues():
+                #records are sorted by line, first duplicate is kept like in utils.combine_vcf
+                tp = next((line for source, line in records if source in (VARSIM_TP, VCFEVAL_TP)), None)
+                t = next((line for source, line in records if source in (VARSIM_TP, VARSIM_FN)), None)
+                fp = [line for source, line in records if source in (VARSIM_FP, VCFEVAL_TP_PREDICT)]
+                if tp:
+                    tp_lines.append(tp)
+                if t:
+                    t_lines.append(t)
+                if (tp is None) != (t is None):
+                    fn_lines.append(t or tp)
+                if len(fp) == 1:
+                    fp_lines.append(fp[0])
+            for output, lines in ((tp_out, tp_lines), (t_out, t_lines), (fn_out, fn_lines), (fp_out, fp_lines)):
+                for l in sorted(lines):
+                    output.write(l)
+
 def merge_results(outdir, varsim_tp, varsim_fn, vcfeval_tp,
-                  varsim_fp, vcfeval_tp_predict):
+                  varsim_fp, vcfeval_tp_predict, threads = 1, reference = None):
     '''
     generate augmented TP, FN, FP
     :param varsim_tp:
@@ -19,6 +89,8 @@ def merge_results(outdir, varsim_tp, varsim_fn, vcfeval_tp,
     :param vcfeval_tp:
     :param varsim_fp:
     :param vcfeval_tp_predict:
+    :param threads: number of BGZF compression threads
+    :param reference: FASTA with .fai giving the contig order the inputs are sorted in, version sort if None
     :return:
     '''
     #some implementation philosiphy (subject to change)
@@ -28,17 +100,30 @@ def merge_results(outdir, varsim_tp, varsim_fn, vcfeval_tp,
     #varsim_tp + varsim_fn = T
     #T - augmented_tp = augmented_fn
     #varsim_fp - vcfeval_tp_predict = augmented_fp
-    augmented_tp = os.path.join(outdir, "merge_tp.vcf")
-    augmented_t = os.path.join(outdir, "merge_t.vcf")
-    augmented_fn = os.path.join(outdir, "merge_fn.vcf")
-    augmented_fp = os.path.join(outdir, "merge_fp.vcf")
-    augmented_tp = utils.combine_vcf(augmented_tp, [varsim_tp, vcfeval_tp], duplicate_handling_mode=utils.COMBINE_KEEP_FIRST_DUPLICATE)
-    augmented_t = utils.combine_vcf(augmented_t, [varsim_tp, varsim_fn], duplicate_handling_mode=utils.COMBINE_KEEP_FIRST_DUPLICATE)
-
-    #assumption: augmented_tp is subset of augmented_t
-    augmented_fn = utils.combine_vcf(augmented_fn, [augmented_t, augmented_tp], duplicate_handling_mode=utils.COMBINE_KEEP_NO_DUPLICATE)
-    #assumption: vcfeval_tp_predict is subset of varsim_fp
-    augmented_fp = utils.combine_vcf(augmented_fp, [varsim_fp, vcfeval_tp_predict], duplicate_handling_mode=utils.COMBINE_KEEP_NO_DUPLICATE)
+    #all four sets are computed in a single pass over the five inputs
+    logger = logging.getLogger(merge_results.__name__)
+    augmented_tp = os.path.join(outdir, "merge_tp.vcf.gz")
+    augmented_t = os.path.join(outdir, "merge_t.vcf.gz")
+    augmented_fn = os.path.join(outdir, "merge_fn.vcf.gz")
+    augmented_fp = os.path.join(outdir, "merge_fp.vcf.gz")
+
+    inputs = [varsim_tp, varsim_fn, vcfeval_tp, varsim_fp, vcfeval_tp_predict]
+    contig_order = utils.get_contig_order(reference) if reference else None
+    sorted_inputs = []
+    while True:
+        try:
+            write_merged_results(inputs, augmented_tp, augmented_t, augmented_fn, augmented_fp, threads, contig_order)
+            break
+        except utils.UnsortedVcfError as e:
+            #e.g. vcfeval output without a reference to follow, sort a copy and start over
+            logger.info('{}, sorting it first'.format(e))
+            source = inputs.index(e.vcf)
+            inputs[source] = utils.sort_and_compress(e.vcf, os.path.join(outdir, "merge_input{}".format(source)), mode = 3, overwrite = True,
+                                                     reference = reference, threads = threads)
+            sorted_inputs.append(inputs[source])
+    for i in sorted_inputs:
+        os.remove(i)
+        os.remove(i + ".tbi")
 
     return augmented_tp, augmented_fn, augmented_fp, augmented_t
 
@@ -220,25 +305,35 @@ class RTGVCFComparator(VCFComparator):
                 raise Exception('{0} was not generated by vcfeval. Please check and rerun.'.format(i))
         self.tp, self.tp_predict, self.fn, self.fp = tp, tp_predict, fn, fp
 
-def generate_sdf(reference, log, java = 'java'):
+def generate_sdf(reference, log, java = 'java', cache_dir = None):
     '''
-    take reference and generate SDF
+    take reference and generate SDF. Concurrent evaluations wait for the one generating it
     :param reference:
+    :param cache_dir: cache the SDF there by checksum of the reference instead of next to the reference
     :return:
     '''
+    def format_sdf(sdf):
+        cmd = [java, utils.JAVA_XMX, '-jar',utils.RTGJAR,'format',
+               '-o', sdf, reference]
+        if log:
+            with utils.versatile_open(log, 'a') as logout:
+                utils.run_shell_command(cmd, logout, logout)
+        else:
+            utils.run_shell_command(cmd, sys.stdout, sys.stderr)
+
+    def build_cached_sdf(entry):
+        sdf = os.path.join(entry, 'ref.sdf')
+        format_sdf(sdf)
+        return sdf
+
+    if cache_dir:
+        return utils.cached_build(cache_dir, 'sdf', [reference], {}, build_cached_sdf, None)
     sdf = reference + '.sdf'
     if os.path.exists(sdf):
         LOGGER.info('{0} exists, doing nothing'.format(sdf))
         LOGGER.info('to rerun SDF generation, please remove or rename {0}'.format(sdf))
         return sdf
-    cmd = [java, utils.JAVA_XMX, '-jar',utils.RTGJAR,'format',
-           '-o', sdf, reference]
-    if log:
-        with utils.versatile_open(log, 'a') as logout:
-            utils.run_shell_command(cmd, logout, logout)
-    else:
-        utils.run_shell_command(cmd, sys.stdout, sys.stderr)
-    return sdf
+    return utils.publish(sdf, format_sdf)
 
 def process(args):
     '''
@@ -278,14 +373,14 @@ def process(args):
                match_geno = args.match_geno, log_to_file= args.log_to_file, opts = args.vcfcompare_options, java = args.java,
                                             sv_length=args.sv_length)
     varsim_tp, varsim_fn, varsim_fp = varsim_comparator.get_tp(), varsim_comparator.get_fn(), varsim_comparator.get_fp()
-    varsim_tp = utils.sort_and_compress(varsim_tp)
-    varsim_fn = utils.sort_and_compress(varsim_fn)
-    varsim_fp = utils.sort_and_compress(varsim_fp)
+    varsim_tp = utils.sort_and_compress(varsim_tp, reference = args.reference, threads = args.compress_threads)
+    varsim_fn = utils.sort_and_compress(varsim_fn, reference = args.reference, threads = args.compress_threads)
+    varsim_fp = utils.sort_and_compress(varsim_fp, reference = args.reference, threads = args.compress_threads)
     #run vcfeval
     sdf = args.sdf
     if not sdf:
         LOGGER.info("user did not supply SDF-formatted reference, trying to generate one...")
-        sdf = generate_sdf(args.reference, args.log_to_file, java = args.java)
+        sdf = generate_sdf(args.reference, args.log_to_file, java = args.java, cache_dir = args.cache_dir)
 
     '''for vcfeval
     sample column must be present, and not empty
@@ -307,79 +402,132 @@ def process(args):
     augmented_tp, augmented_fn, augmented_fp, augmented_t = merge_results(
                       outdir = args.out_dir,
                       varsim_tp = varsim_tp, varsim_fn = varsim_fn,
-                      vcfeval_tp = vcfeval_tp, varsim_fp = varsim_fp, vcfeval_tp_predict = vcfeval_tp_predict)
+                      vcfeval_tp = vcfeval_tp, varsim_fp = varsim_fp, vcfeval_tp_predict = vcfeval_tp_predict,
+                      threads = args.compress_threads, reference = args.reference)
     augmented_tp, augmented_fn, augmented_fp, augmented_t = summarize_results(os.path.join(args.out_dir,"augmented"), augmented_tp, augmented_fn, augmented_fp, augmented_t,
-                      var_types= args.var_types, sv_length= args.sv_length, regions = args.regions, bed_either = args.bed_either, java = args.java, bin_breaks = args.bin_breaks)
+                      var_types= args.var_types, sv_length= args.sv_length, regions = args.regions, bed_either = args.bed_either, java = args.java, bin_breaks = args.bin_breaks,
+                      threads = args.compress_threads, reference = args.reference)
 
 
     if args.master_vcf and args.call_vcf:
-        match_false(augmented_fp, [args.call_vcf, args.master_vcf, augmented_fn], args.out_dir, args.sample, args.log_to_file, args.vcfeval_options, sdf, args.java)
-        match_false(augmented_fn, [args.call_vcf], args.out_dir, args.sample, args.log_to_file, args.vcfeval_options, sdf, args.java)
+        match_false(augmented_fp, [args.call_vcf, args.master_vcf, augmented_fn], args.out_dir, args.sample, args.log_to_file, args.vcfeval_options, sdf, args.java, args.compress_threads, args.reference)
+        match_false(augmented_fn, [args.call_vcf], args.out_dir, args.sample, args.log_to_file, args.vcfeval_options, sdf, args.java, args.compress_threads, args.reference)
 
     LOGGER.info("Variant comparison done.\nTrue positive: {0}\nFalse negative: {1}\nFalse positive: {2}\n".
                 format(augmented_tp, augmented_fn, augmented_fp))
 
 
-def match_false(augmented_file, files_to_pair_with, out_dir, sample, log_to_file, vcfeval_options, sdf, java = "java"):
+class FalseCallPairing(object):
+    '''
+    companion variants that can be paired with false calls, indexed by position
+
+    vcfeval is run once for all false calls against the companion file, the
+    pairing for each individual call is then looked up in memory. A matched
+    companion variant belongs to the matched call closest to it, so that a call
+    is only paired with what vcfeval matched around it and never with the match
+    of a neighbouring call
+    '''
+    def __init__(self, matched_vcf, matched_calls_vcf, companion_vcf):
+        '''
+        :param matched_vcf: companion variants matched by vcfeval (baseline TP)
+        :param matched_calls_vcf: false calls matched by vcfeval (calls TP)
+        :param companion_vcf: companion file
+        '''
+        self.companion = utils.VariantIndex(companion_vcf)
+        matched_calls = utils.VariantIndex(matched_calls_vcf)
+        matched = utils.VariantIndex(matched_vcf)
+        #(chr, pos, ref, alt) of a matched call -> (number in file order, variant) of its matched companion variants
+        self.matched = {}
+        for chrom, variants in matched.variants.iteritems():
+            for number, variant in zip(matched.numbers[chrom], variants):
+                call = matched_calls.get_closest_variant(variant)
+                if call:
+                    self.matched.setdefault(self.get_key(call), []).append((number, variant))
+
+    @staticmethod
+    def get_key(variant):
+        return variant[0], variant[1], variant[3], variant[4]
+
+    def get_closest_variant(self, variant):
+        '''
+        :return: companion variant matched with variant closest to it, None if there is none within utils.CLOSEST_VARIANT_DISTANCE
+        '''
+        pos = int(variant[1])
+        closest = None
+        for number, matched in self.matched.get(self.get_key(variant), []):
+            dist = abs(int(matched[1]) - pos)
+            if dist < utils.CLOSEST_VARIANT_DISTANCE and (closest is None or (dist, number) < closest[:2]):
+                closest = (dist, number, matched)
+        return closest[2][:] if closest else None
+
+    def get_matching_alt_ref(self, variant):
+        '''
+        :return: companion variant at the same position with matching alt and ref, None if not found
+        '''
+        return self.companion.get_matching_alt_ref(variant)
+
+
+def pair_false_calls(augmented_file, companion_vcf, vcfeval_prefix, sample, log_to_file, vcfeval_options, sdf, java = "java"):
+    '''
+    compare all false calls with a companion file in a single vcfeval run
+    :return: FalseCallPairing
+    '''
+    if os.path.exists(vcfeval_prefix):
+        LOGGER.warn('{0} exists, removing ...'.format(vcfeval_prefix))
+        shutil.rmtree(vcfeval_prefix)
+    vcfeval_comparator = RTGVCFComparator(prefix=vcfeval_prefix, true_vcf = companion_vcf, reference = sdf,
+                                          regions = None,
+                                          sample = sample, vcfs = [augmented_file],
+                                          exclude_filtered = False,
+                                          match_geno = False,
+                                          log_to_file= log_to_file,
+                                          opts = vcfeval_options, java = java)
+    pairing = FalseCallPairing(vcfeval_comparator.get_tp(), vcfeval_comparator.get_tp_predict(), companion_vcf)
+    #clean up
+    shutil.rmtree(vcfeval_prefix)
+    return pairing
+
+
+def match_false(augmented_file, files_to_pair_with, out_dir, sample, log_to_file, vcfeval_options, sdf, java = "java", threads = 1, reference = None):
     """Try to pair up each false call in a file (augmented_file) with a variant in the other files provided in a list (files_to_pair_with) to create an annotated version of the first file.
     By default the the first variant in the list is provided to get an AF, the 2nd to determine the simulated variant (for false positives) and the 3rd to determine if a false positive is
     a pure false positive (not simulated) or not (wrong genotype)"""
     files_to_pair_with_clean = []
     for item in files_to_pair_with:
-        files_to_pair_with_clean.append(utils.make_clean_vcf(item, out_dir))
+        files_to_pair_with_clean.append(utils.make_clean_vcf(item, out_dir, threads))
+
+    #one vcfeval run per companion file, individual false calls are paired up afterwards
+    pairings = []
+    for item in files_to_pair_with_clean:
+        if item:
+            vcfeval_prefix = os.path.join(out_dir, 'vcfeval_compare_results_annotate')
+            pairings.append(pair_false_calls(augmented_file, item, vcfeval_prefix, sample, log_to_file, vcfeval_options, sdf, java))
+        else:
+            pairings.append(None)
 
-    content = []
     annotated_content = []
 
     with utils.versatile_open(augmented_file, "rt") as augmented_file_handle:
-        for line in augmented_file_handle.readlines():
+        for line in augmented_file_handle:
             line_strip = line.strip()
             line_split = line_strip.split()
 
             if line_strip[0] == "#":
                 annotated_content.append(line_strip)
-                content.append(line_strip)
 
             else:
-                if content[-1][0] != "#":
-                    del content[-1]
-                content.append(line_strip)
-
-                single_var_file = utils.write_vcf(content, os.path.join(out_dir, "single.vcf"))
-                single_var_file = utils.sort_and_compress(single_var_file)
-
-                single_var_chr = line_split[0]
                 info = ''
 
-                for i, item in enumerate(files_to_pair_with_clean):
+                for i, pairing in enumerate(pairings):
 
                     nonmatching_gt_variant = None
 
-                    if item:
-                        vcfeval_prefix = os.path.join(out_dir, 'vcfeval_compare_results_annotate')
-
-                        #Restrict the comparison to just the chromosome of the single variant by creating a filtered comparison file
-                        filtered_true_vcf = utils.write_filtered_vcf(item, single_var_chr, os.path.join(out_dir, "filtered.vcf"))
-                        filtered_true_vcf = utils.sort_and_compress(filtered_true_vcf)
-
-                        vcfeval_comparator = RTGVCFComparator(prefix=vcfeval_prefix, true_vcf = filtered_true_vcf, reference = sdf,
-                                         regions = None,
-                                         sample = sample, vcfs = [single_var_file],
-                                         exclude_filtered = False,
-                                         match_geno = False,
-                                         log_to_file= log_to_file,
-                                         opts = vcfeval_options, java = java)
-
-                        nonmatching_gt_variant = utils.get_closest_variant(line_split, vcfeval_comparator.get_tp())
+                    if pairing:
+                        nonmatching_gt_variant = pairing.get_closest_variant(line_split)
 
                         #if not nonmatching_gt_variant, check for matching alt and ref at the same position. Example of when this could be applicable is a 0/0 call when vcfeval will not pair up variants at the same locus with the same alt and ref even with match_geno=False
                         if not nonmatching_gt_variant:
-                            nonmatching_gt_variant = utils.get_matching_alt_ref(line_split, filtered_true_vcf)
-
-                        #clean up
-                        if os.path.exists(vcfeval_prefix):
-                            LOGGER.warn('{0} exists, removing ...'.format(vcfeval_prefix))
-                            shutil.rmtree(vcfeval_prefix)
+                            nonmatching_gt_variant = pairing.get_matching_alt_ref(line_split)
 
                     if i == 0:
                         AO_RO_DP_AD = {"AO": None, "RO": None, "DP": None, "AD": None}
@@ -427,14 +575,8 @@ def match_false(augmented_file, files_to_pair_with, out_dir, sample, log_to_file
                 line_split[6] = info
                 annotated_content.append('\t'.join(line_split))
 
-                #clean up
-                for fil in [single_var_file, filtered_true_vcf]:
-                    if os.path.isfile(fil):
-                        os.remove(fil)
-                        os.remove(fil+".tbi")
-
-    annotated_file = utils.write_vcf(annotated_content, os.path.join(args.out_dir, "{}_annotated.vcf".format(os.path.splitext(os.path.splitext(os.path.basename(augmented_file))[0])[0])))
-    annotated_file = utils.sort_and_compress(annotated_file)
+    annotated_file = utils.write_vcf(annotated_content, os.path.join(out_dir, "{}_annotated.vcf".format(os.path.splitext(os.path.splitext(os.path.basename(augmented_file))[0])[0])))
+    annotated_file = utils.sort_and_compress(annotated_file, reference = reference, threads = threads)
 
     #clean up
     for item in files_to_pair_with_clean:
@@ -490,13 +632,14 @@ def parse_jsons(jsonfile, stats, count_sv = False, count_all = False):
                         stats[vt][mt] += 0
 
 def summarize_results(prefix, tp, fn, fp, t, var_types, sv_length = 100, regions = None, bed_either = False, java = 'java', bin_breaks = None,
-                      ignore_ins_len = False):
+                      ignore_ins_len = False, threads = 1, reference = None):
     '''
     count variants by type and tabulate
     :param augmented_tp:
     :param augmented_fn:
     :param augmented_fp:
     :param augmented_t:
+    :param reference: FASTA with .fai giving the contig order of the outputs, version sort if None
     :return:
     '''
     cmd = [java, utils.JAVA_XMX, '-jar', utils.VARSIMJAR, 'vcfcompareresultsparser',
@@ -520,10 +663,10 @@ def summarize_results(prefix, tp, fn, fp, t, var_types, sv_length = 100, regions
     fp = prefix + "_fp.vcf"
     t = prefix + "_t.vcf"
 
-    tp = utils.sort_and_compress(tp)
-    fn = utils.sort_and_compress(fn)
-    fp = utils.sort_and_compress(fp)
-    t = utils.sort_and_compress(t)
+    tp = utils.sort_and_compress(tp, reference = reference, threads = threads)
+    fn = utils.sort_and_compress(fn, reference = reference, threads = threads)
+    fp = utils.sort_and_compress(fp, reference = reference, threads = threads)
+    t = utils.sort_and_compress(t, reference = reference, threads = threads)
 
     jsonfile = "{0}_report.json".format(prefix)
     metrics = ['tp', 'fp', 't', 'fn']
@@ -563,7 +706,7 @@ if __name__ == "__main__":
     main_parser.add_argument("--match_geno", action = 'store_true', help="compare genotype in addition to alleles", required = False)
     main_parser.add_argument("--sv_length", type = int, help="length cutoff for SV (only effective for counting, not comparison). For comparison, please add -sv_length to --vcfcompare_options.", required = False, default = 100)
     main_parser.add_argument("--ignore_ins_len", action = 'store_true', help="Ignore length of insertion (treat it as 0 length), otherwise ignore insertions and other SVs without proper SVLEN.", required = False)
-    main_parser.add_argument('--version', action='version', version=utils.get_version())
+    main_parser.add_argument('--version', action=utils.VersionAction)
     main_parser.add_argument("--log_to_file", metavar="LOGFILE", help="logfile. If not specified, log to stderr", required=False, type=str, default="")
     main_parser.add_argument("--loglevel", help="Set logging level", choices=["debug", "warn", "info"], default="info")
     main_parser.add_argument("--vcfcompare_options", metavar="OPT", help="additional options for VarSim vcfcompare", default="", type = str)
@@ -571,6 +714,8 @@ if __name__ == "__main__":
     main_parser.add_argument("--bed_either", action = 'store_true', help="Use either break-end of the variant for filtering instead of both")
     main_parser.add_argument("--java_max_mem", metavar="XMX", help="max java memory", default="10g", type = str)
     main_parser.add_argument("--java", metavar="PATH", help="path to java", default="java", type = str)
+    main_parser.add_argument("--compress_threads", metavar="INT", help="number of threads for BGZF compression", default=1, type = int)
+    main_parser.add_argument("--cache_dir", metavar="DIR", help="directory to cache the SDF of the reference in, shared by runs on the same reference", required = False, type = str)
     main_parser.add_argument("--bin_breaks", metavar="INPUT_STR", help="user defined bin breaks", required = False, type = str)
 
     args = main_parser.parse_args()
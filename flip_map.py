@@ -5,8 +5,167 @@ import argparse
 import logging
 import os
 import sys
+import bgzf
+import mapindex
+import utils
 logger = None
 
+#bytes of text map flipped at a time
+CHUNK_SIZE = 1 << 20
+COLUMNS = 8
+FEATURE = 6
+#all characters but the column and line separators
+NOT_SEPARATORS = "".join(chr(c) for c in xrange(256) if chr(c) not in "\t\n")
+
+def flip_block(block):
+    """exchange source and destination of a map block
+    Arguments:
+        block: mapindex.MapBlock
+    Returns:
+        flipped mapindex.MapBlock, INS and DEL exchanged
+    """
+    feature = {'DEL': 'INS', 'INS': 'DEL'}.get(block.feature, block.feature)
+    return block._replace(host_chr = block.ref_chr, host_loc = block.ref_loc, ref_chr = block.host_chr, ref_loc = block.host_loc, feature = feature)
+
+def flip_lines(lines):
+    """flip map lines one at a time, for lines the columnar flip does not handle
+    Arguments:
+        lines: map lines
+    Returns:
+        (flipped lines, flipped lines on *_paternal, flipped lines on *_maternal) as text
+    """
+    flipped, paternal, maternal = [], [], []
+    for l in lines:
+        if not l.rstrip():
+            continue
+        fields = l.split("\t")
+        # exchange source and destination chromosomes
+        fields[1], fields[3] = fields[3], fields[1]
+        # exchnage source and destination positions
+        fields[2], fields[4] = fields[4], fields[2]
+        # set INS -> DEL and DEL -> INS
+        if fields[6] == 'DEL':
+            fields[6] = 'INS'
+        elif fields[6] == 'INS':
+            fields[6] = 'DEL'
+        flipped_line = "\t".join(fields)
+        flipped.append(flipped_line)
+        if fields[3].endswith('_paternal'):
+            paternal.append(flipped_line)
+        if fields[3].endswith('_maternal'):
+            maternal.append(flipped_line)
+    return "".join(flipped), "".join(paternal), "".join(maternal)
+
+def field_equals(buf, starts, string):
+    """numpy mask of the starts where the bytes of buf spell string
+    """
+    import numpy as np
+    if not len(starts):
+        return np.zeros(0, dtype = bool)
+    return (buf[starts[:, None] + np.arange(len(string))] == np.frombuffer(string, dtype = np.uint8)).all(axis = 1)
+
+def flip_chunk(text, split_haplotype = True):
+    """flip whole map lines as columns of a byte array. Within a line, flipping exchanges the adjacent byte ranges
+    "<host chr>\t<host loc>\t" and "<ref chr>\t<ref loc>\t", and INS and DEL have the same length, so the flipped
+    lines are a gather of the bytes of the chunk. INS/DEL and haplotypes are selected with numpy masks
+    Arguments:
+        text: map lines
+    Returns:
+        (flipped lines, flipped lines on *_paternal, flipped lines on *_maternal) as text
+    """
+    import numpy as np
+    num_lines = text.count("\n")
+    # every line needs exactly COLUMNS fields
+    if not num_lines or text.translate(None, NOT_SEPARATORS) != ("\t" * (COLUMNS - 1) + "\n") * num_lines:
+        return flip_lines(text.splitlines(True))
+    buf = np.frombuffer(text, dtype = np.uint8)
+    tabs = np.flatnonzero(buf == ord("\t")).reshape(num_lines, COLUMNS - 1)
+    line_ends = np.flatnonzero(buf == ord("\n")) + 1
+
+    # gather index: each byte of the swapped ranges comes from its position shifted by the length of the other range,
+    # the shifts are set where they change and summed up
+    host_start = tabs[:, 0] + 1
+    ref_start = tabs[:, 2] + 1
+    ref_end = tabs[:, 4] + 1
+    host_shift = ref_start - host_start
+    ref_shift = ref_end - ref_start
+    shifts = np.zeros(len(buf) + 1, dtype = np.int32)
+    shifts[host_start] = host_shift
+    shifts[host_start + ref_shift] = -ref_shift - host_shift
+    shifts[ref_end] = ref_shift
+    gather = np.arange(len(buf), dtype = np.int32)
+    gather += np.cumsum(shifts[:-1], dtype = np.int32)
+    flipped = buf[gather]
+
+    # INS <-> DEL, in place as they have the same length
+    feature_start = tabs[:, FEATURE - 1] + 1
+    feature_length = tabs[:, FEATURE] - feature_start
+    short_feature = feature_start[feature_length == 3]
+    insertions = short_feature[field_equals(buf, short_feature, 'INS')]
+    deletions = short_feature[field_equals(buf, short_feature, 'DEL')]
+    for i, (ins, de) in enumerate(zip('INS', 'DEL')):
+        flipped[insertions + i] = ord(de)
+        flipped[deletions + i] = ord(ins)
+    flipped = flipped.tostring()
+    if not split_haplotype:
+        return flipped, "", ""
+
+    # the destination after flipping is the host chromosome, select lines by its suffix.
+    # Lines of a chromosome are together, so the selected lines are copied as runs
+    host_end = tabs[:, 1]
+    line_starts = np.concatenate(([0], line_ends[:-1]))
+    haplotypes = []
+    for suffix in ('_paternal', '_maternal'):
+        long_host = np.flatnonzero(host_end - host_start >= len(suffix))
+        mask = np.zeros(num_lines + 2, dtype = np.int8)
+        mask[long_host + 1] = field_equals(buf, host_end[long_host] - len(suffix), suffix)
+        run_bounds = np.flatnonzero(np.diff(mask)).reshape(-1, 2)
+        haplotypes.append("".join(flipped[start:end] for start, end in
+                                  zip(line_starts[run_bounds[:, 0]].tolist(), line_ends[run_bounds[:, 1] - 1].tolist())))
+    return flipped, haplotypes[0], haplotypes[1]
+
+def read_chunks(fh, chunk_size = CHUNK_SIZE):
+    """read whole lines about chunk_size bytes at a time
+    """
+    rest = ""
+    while True:
+        data = fh.read(chunk_size)
+        if not data:
+            break
+        data = rest + data
+        end = data.rfind("\n") + 1
+        rest = data[end:]
+        if end:
+            yield data[:end]
+    if rest:
+        yield rest
+
+def read_block_chunks(map_file, chunk_blocks = 1 << 20):
+    chunk = []
+    for block in mapindex.read_map(map_file):
+        chunk.append(block)
+        if len(chunk) >= chunk_blocks:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def flip_map(map_file, split_haplotype = True):
+    """flip a text map, gzipped or not, or a binary map
+    Returns:
+        generator of (flipped lines, flipped lines on *_paternal, flipped lines on *_maternal) as text
+    """
+    if mapindex.is_binary_map(map_file):
+        for chunk in read_block_chunks(map_file):
+            yield flip_lines(mapindex.format_map_line(block) for block in chunk)
+        return
+    with utils.versatile_open(map_file, 'rb') as fh:
+        for chunk in read_chunks(fh):
+            yield flip_chunk(chunk, split_haplotype)
+
+def open_output(filename, gzip):
+    return bgzf.BgzfWriter(filename) if gzip else open(filename, 'w')
+
 def process_args(args):
     """main function
     Arguments:
@@ -16,30 +175,29 @@ def process_args(args):
     Raises:
         None
     """
-    outfile = args.prefix + ".map"
-    outfile_paternal = args.prefix + ".paternal.map"
-    outfile_maternal = args.prefix + ".maternal.map"
-    with open(outfile, 'w') as fh, open(outfile_paternal, 'w') as fh_paternal, open(outfile_maternal, 'w') as fh_maternal:
-        for l in args.map:
-            if not l.rstrip():
-                continue
-            fields = l.split("\t")
-            # exchange source and destination chromosomes
-            fields[1], fields[3] = fields[3], fields[1]
-            # exchnage source and destination positions
-            fields[2], fields[4] = fields[4], fields[2]
-            # set INS -> DEL and DEL -> INS
-            if fields[6] == 'DEL':
-                fields[6] = 'INS'
-            elif fields[6] == 'INS':
-                fields[6] = 'DEL'
-            flipped_line = "\t".join(fields)
-            fh.write(flipped_line)
-            if args.split_haplotype:
-                if fields[3].endswith('_paternal'):
-                    fh_paternal.write(flipped_line)
-                if fields[3].endswith('_maternal'):
-                    fh_maternal.write(flipped_line)
+    suffix = mapindex.BINARY_MAP_SUFFIX if args.binary else (".map.gz" if args.gzip else ".map")
+    outfile = args.prefix + suffix
+    outfile_paternal = args.prefix + ".paternal" + suffix
+    outfile_maternal = args.prefix + ".maternal" + suffix
+    if args.binary:
+        # the binary maps are indexed after all their blocks are read
+        flipped_blocks = [flip_block(block) for block in mapindex.read_map(args.map)]
+        mapindex.write_binary_map(flipped_blocks, outfile)
+        # without --split_haplotype the haplotype maps are written empty
+        mapindex.write_binary_map((block for block in flipped_blocks if args.split_haplotype and block.ref_chr.endswith('_paternal')), outfile_paternal)
+        mapindex.write_binary_map((block for block in flipped_blocks if args.split_haplotype and block.ref_chr.endswith('_maternal')), outfile_maternal)
+    else:
+        outputs = []
+        try:
+            # without --split_haplotype the haplotype maps are written empty
+            for filename in (outfile, outfile_paternal, outfile_maternal):
+                outputs.append(open_output(filename, args.gzip))
+            for flipped in flip_map(args.map, args.split_haplotype):
+                for fh, text in zip(outputs, flipped):
+                    fh.write(text)
+        finally:
+            for fh in outputs:
+                fh.close()
     logger.info("{} done.".format(outfile))
     if args.split_haplotype:
         logger.info("{} {} done.".format(outfile_paternal, outfile_maternal))
@@ -51,7 +209,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Flip map file (for internal use)", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument("prefix", type = str, help = 'output prefix')
-    parser.add_argument("map", type = argparse.FileType('r'), help = 'VarSim map file')
+    parser.add_argument("map", type = str, help = 'VarSim map file, text (gzipped if it ends with .gz) or binary ({})'.format(mapindex.BINARY_MAP_SUFFIX))
+    parser.add_argument("--gzip", action = 'store_true', help = 'Write gzip (BGZF) compressed text maps')
+    parser.add_argument("--binary", action = 'store_true', help = 'Write indexed binary maps ({}) instead of text maps'.format(mapindex.BINARY_MAP_SUFFIX))
     parser.add_argument("--split_haplotype", action = 'store_true', help = 'Split destination (after flipping) *_paternal and *_maternal (if any) chromosomes into separate files')
     parser.add_argument('--version', action='version', version='%(prog)s 0.0.1')
     parser.add_argument("--verbose","-v", action = 'count',  help='increase verbosity')
@@ -1,15 +1,25 @@
 import os
+import re
+import resource
 import subprocess
 import sys
-import numpy
 import argparse
-import pysam
-import vcf
-import pybedtools
 import logging
 from collections import defaultdict, OrderedDict
 from utils import makedirs
 
+#bound on the number of formatted values remembered by RawRecordFormatter
+FORMAT_CACHE_SIZE = 1 << 16
+
+#INFO values that PyVCF writes back unchanged. Floats are limited to the ones str() prints as they are
+CANONICAL_INTEGER = r"(?:0|-?[1-9][0-9]*|\.)"
+CANONICAL_FLOAT = r"(?:-?(?:0\.(?:0|0{0,3}[1-9](?:[0-9]{0,4}[1-9])?)|[1-9][0-9]{0,5}\.(?:0|[0-9]{0,4}[1-9]))|\.)"
+CANONICAL_STRING = r"[^,;]*"
+
+#sorted regions of a contig closer than this are read with one tabix fetch,
+#skipping the records between them is cheaper than seeking and decompressing a block again
+FETCH_MERGE_GAP = 1 << 12
+
 def uint(value):
   if not value.isdigit(): raise argparse.ArgumentTypeError("%s is not digit-only" % value)
   ret = int(value)
@@ -17,6 +27,8 @@ def uint(value):
   return ret
 
 def gen_restricted_reference(reference, regions_bed, out_reference, use_short_contigs_names=False):
+    import pysam
+    import pybedtools
     logger = logging.getLogger(gen_restricted_reference.__name__)
 
     reference_handle = pysam.Fastafile(reference)
@@ -37,7 +49,256 @@ def gen_restricted_reference(reference, regions_bed, out_reference, use_short_co
     return out_reference
 
 
-def gen_restricted_vcf(in_vcf, regions_bed, out_vcf, restricted_reference, targeted_samples, flank=0, use_short_contig_names=False):
+class RawRecordFormatter(object):
+  '''
+  Formats raw VCF lines the way a round trip through PyVCF's Reader and Writer does (typed INFO and FORMAT values,
+  INFO ordered as in the header, ...), without building record objects
+  '''
+  def __init__(self, reader, reserved_info, reserved_format):
+    '''
+    :param reader: PyVCF reader of the header
+    '''
+    self.infos = dict((ID, (info.type, info.num)) for ID, info in reader.infos.iteritems())
+    self.info_order = dict((ID, index) for index, ID in enumerate(reader.infos.iterkeys()))
+    self.formats = dict((ID, (fmt.type, fmt.num)) for ID, fmt in reader.formats.iteritems())
+    self.reserved_info = reserved_info
+    self.reserved_format = reserved_format
+    #INFO ID -> pattern of the values written back unchanged, IDs neither in the header nor reserved keep any value
+    canonical_values = dict((ID, self.canonical_values(entry_type, None)) for ID, entry_type in reserved_info.iteritems())
+    canonical_values.update((ID, self.canonical_values(entry_type, entry_num)) for ID, (entry_type, entry_num) in self.infos.iteritems())
+    self.canonical_info = dict((ID, re.compile(values + r"\Z")) for ID, values in canonical_values.iteritems())
+    #";" + INFO written back unchanged, canonical entries of the header IDs in header order
+    self.canonical_info_str = re.compile("".join("(?:;%s(?:=%s)?(?=;|\\Z))?" % (re.escape(ID), canonical_values[ID])
+                                                 for ID in reader.infos) + r"\Z")
+    self.format_cache = {}
+    #formatted INFO entries, QUAL and samples, most of them repeat from record to record
+    self.info_cache = {}
+    self.qual_cache = {}
+    self.sample_cache = {}
+
+  @staticmethod
+  def cached(cache, key, func, *args):
+    if key not in cache:
+      if len(cache) >= FORMAT_CACHE_SIZE:
+        cache.clear()
+      cache[key] = func(*args)
+    return cache[key]
+
+  @staticmethod
+  def canonical_values(entry_type, entry_num):
+    if entry_type == "Flag":
+      #a Flag with a value is written without it
+      return "(?!)"
+    value = {"Integer": CANONICAL_INTEGER, "Float": CANONICAL_FLOAT}.get(entry_type, CANONICAL_STRING)
+    if entry_num != 1:
+      value = "%s(?:,%s)*" % (value, value)
+    return value
+
+  @staticmethod
+  def map_values(func, values):
+    return [func(value) if value != "." else None for value in values]
+
+  @staticmethod
+  def stringify(value):
+    if type(value) == list:
+      return ",".join(str(v) if v is not None else "." for v in value)
+    return str(value) if value is not None else "."
+
+  def parse_info(self, info_str):
+    '''
+    :return: ID -> value as parsed by PyVCF
+    '''
+    info = {}
+    if info_str == ".":
+      return info
+    for entry in info_str.split(";"):
+      entry = entry.split("=", 1)
+      ID = entry[0]
+      if ID in self.infos:
+        entry_type, entry_num = self.infos[ID]
+      else:
+        entry_num = None
+        entry_type = self.reserved_info.get(ID, "String" if entry[1:] else "Flag")
+      if entry_type == "Integer":
+        values = entry[1].split(",")
+        try:
+          value = self.map_values(int, values)
+        except ValueError:
+          value = self.map_values(float, values)
+      elif entry_type == "Float":
+        value = self.map_values(float, entry[1].split(","))
+      elif entry_type == "Flag" or not entry[1:]:
+        entry_type = "Flag"
+        value = True
+      else:
+        value = self.map_values(str, entry[1].split(","))
+      if entry_num == 1 and entry_type != "Flag":
+        value = value[0]
+      info[ID] = value
+    return info
+
+  def format_info(self, info):
+    if not info:
+      return "."
+    default_order = len(self.infos)
+    keys = sorted(info, key=lambda ID: (self.info_order.get(ID, default_order), ID))
+    return ";".join((ID if info[ID] else "") if isinstance(info[ID], bool) else "%s=%s" % (ID, self.stringify(info[ID])) for ID in keys)
+
+  def format_info_entry(self, entry):
+    info = self.parse_info(entry)
+    ID = next(iter(info))
+    return (self.info_order.get(ID, len(self.infos)), ID), self.format_info(info)
+
+  def format_info_str(self, info_str):
+    '''
+    same as format_info(parse_info(info_str)), entries in canonical form are kept as they are and the others are
+    formatted only once
+    '''
+    if info_str == "." or self.canonical_info_str.match(";" + info_str):
+      return info_str
+    default_order = len(self.infos)
+    entries = []
+    for entry in info_str.split(";"):
+      ID, has_value, value = entry.partition("=")
+      if ID and (not has_value or ID not in self.canonical_info or self.canonical_info[ID].match(value)):
+        entries.append(((self.info_order.get(ID, default_order), ID), entry))
+      else:
+        entries.append(self.cached(self.info_cache, entry, self.format_info_entry, entry))
+    if len(entries) > 1:
+      keys = [key for key, _ in entries]
+      if len(set(keys)) < len(keys):
+        #repeated IDs, the last value is kept
+        return self.format_info(self.parse_info(info_str))
+      if keys != sorted(keys):
+        entries.sort()
+    return ";".join(formatted for _, formatted in entries)
+
+  def format_qual_str(self, qual):
+    return self.cached(self.qual_cache, qual, self.format_qual, qual)
+
+  @staticmethod
+  def format_qual(qual):
+    try:
+      qual = int(qual)
+    except ValueError:
+      try:
+        qual = float(qual)
+      except ValueError:
+        return "."
+    if not qual:
+      return "."
+    #the csv module writes floats with repr
+    return repr(qual) if isinstance(qual, float) else str(qual)
+
+  @staticmethod
+  def format_alt(alt):
+    '''
+    only paired breakends are not written back as they are, the mate position is written as a number
+    '''
+    if "[" not in alt and "]" not in alt:
+      return alt
+    alts = []
+    for allele in alt.split(","):
+      items = re.split("[\\[\\]]", allele)
+      if len(items) == 1:
+        alts.append(allele)
+        continue
+      remote_chrom, remote_pos = items[1].split(":")[:2]
+      remote_tag = "[" if "[" in allele else "]"
+      remote_tag = remote_tag + remote_chrom + ":" + str(int(remote_pos)) + remote_tag
+      if allele[0] in "[]":
+        alts.append(remote_tag + items[2])
+      else:
+        alts.append(items[0] + remote_tag)
+    return ",".join(alts)
+
+  def get_sample_format(self, fmt):
+    if fmt not in self.format_cache:
+      fields = fmt.split(":")
+      types = []
+      nums = []
+      for field in fields:
+        if field in self.formats:
+          field_type, field_num = self.formats[field]
+        else:
+          field_type, field_num = self.reserved_format.get(field, "String"), None
+        types.append(field_type)
+        nums.append(field_num)
+      self.format_cache[fmt] = (fields, types, nums, fields.index("GT") if "GT" in fields else None)
+    return self.format_cache[fmt]
+
+  def format_sample_str(self, fmt, sample):
+    return self.cached(self.sample_cache, (fmt, sample), self.format_sample, fmt, sample)
+
+  def format_sample(self, fmt, sample):
+    fields, types, nums, gt_index = self.get_sample_format(fmt)
+    data = [None] * len(fields)
+    for i, value in enumerate(sample.split(":")):
+      if fields[i] == "GT":
+        data[i] = value
+        continue
+      if not value or value == ".":
+        continue
+      if nums[i] == 1 or "," not in value:
+        if types[i] == "Integer":
+          try:
+            data[i] = int(value)
+          except ValueError:
+            data[i] = float(value)
+        elif types[i] == "Float":
+          data[i] = float(value)
+        else:
+          data[i] = value
+        continue
+      values = value.split(",")
+      if types[i] == "Integer":
+        try:
+          data[i] = self.map_values(int, values)
+        except ValueError:
+          data[i] = self.map_values(float, values)
+      elif types[i] in ("Float", "Numeric"):
+        data[i] = self.map_values(float, values)
+      else:
+        data[i] = values
+    if gt_index is not None:
+      gt = data[gt_index]
+    else:
+      gt = "./." if "GT" in fmt else ""
+    if not gt:
+      return ":".join(self.stringify(value) for value in data)
+    return ":".join([gt] + [self.stringify(value) for value in data[1:]])
+
+
+def get_fetch_groups(regions, max_gap=FETCH_MERGE_GAP):
+    '''
+    :param regions: BED regions
+    :return: generator of lists of (region index, region), sorted disjoint regions of a contig at most max_gap apart
+    '''
+    group = []
+    for region_index, region in enumerate(regions, start=1):
+        if group:
+            previous = group[-1][1]
+            if region.chrom != previous.chrom or region.start < previous.end or region.start - previous.end > max_gap:
+                yield group
+                group = []
+        group.append((region_index, region))
+    if group:
+        yield group
+
+
+def get_sample_vcf(out_vcf, sample):
+    base, ext = os.path.splitext(out_vcf)
+    return "%s.%s%s" % (base, sample, ext)
+
+
+def gen_restricted_vcf(in_vcf, regions_bed, out_vcf, restricted_reference, targeted_samples, flank=0, use_short_contig_names=False, per_sample=False):
+    '''
+    :param per_sample: write one VCF per targeted sample, named by get_sample_vcf, instead of one VCF with all of them
+    :return: the bgzipped VCF, or sample -> bgzipped VCF of the sample with per_sample
+    '''
+    import pysam
+    import vcf
+    import pybedtools
     logger = logging.getLogger(gen_restricted_vcf.__name__)
 
     if not in_vcf:
@@ -65,7 +326,11 @@ def gen_restricted_vcf(in_vcf, regions_bed, out_vcf, restricted_reference, targe
     }
 
     # get the base name and use it in the output
+    # PyVCF only parses and writes the header, records are restricted on their raw lines
     vcf_template_reader = vcf.Reader(open(in_vcf, "r"))
+    formatter = RawRecordFormatter(vcf_template_reader, vcf.parser.RESERVED_INFO, vcf.parser.RESERVED_FORMAT)
+    sample_indexes = vcf_template_reader._sample_indexes
+    num_samples = len(vcf_template_reader.samples)
     vcf_template_reader.metadata["reference"] = restricted_reference
     vcf_template_reader.contigs = OrderedDict([(contig_name, vcf.parser._Contig(contig_name, contig_length)) for (contig_name, contig_length) in contigs])
 
@@ -76,50 +341,79 @@ def gen_restricted_vcf(in_vcf, regions_bed, out_vcf, restricted_reference, targe
                 new_samples.append(k)
         vcf_template_reader.samples = new_samples
 
-    vcf_writer = vcf.Writer(open(out_vcf, "w"), vcf_template_reader)
-
-    if targeted_samples:
-        vcf_template_reader = vcf.Reader(open(in_vcf, "r"))
-
-    #tabix_vcf = pysam.TabixFile(invcf, parser=pysam.asVCF())
+    split_samples = (new_samples if targeted_samples else list(vcf_template_reader.samples)) if per_sample else []
+    if per_sample and not split_samples:
+        logger.error("None of the samples %s found in %s" % (", ".join(targeted_samples), in_vcf))
+        return OrderedDict()
+
+    #the output VCFs with the columns of their samples, in the order written.
+    #Sample columns are resolved once from the header and projected from each record
+    if per_sample:
+        outputs = [(get_sample_vcf(out_vcf, sample), [sample], [9 + sample_indexes[sample]]) for sample in split_samples]
+    elif new_samples:
+        outputs = [(out_vcf, new_samples, [9 + sample_indexes[sample] for sample in new_samples])]
+    else:
+        outputs = [(out_vcf, vcf_template_reader.samples, range(9, 9 + num_samples))]
+    #all the per-sample VCFs are open at once, e.g. 2504 for 1000 Genomes
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit != resource.RLIM_INFINITY and soft_limit < len(outputs) + 64:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (len(outputs) + 64 if hard_limit == resource.RLIM_INFINITY else min(len(outputs) + 64, hard_limit), hard_limit))
+    out_fds = []
+    for vcf_file, samples, sample_columns in outputs:
+        vcf_template_reader.samples = samples
+        out_fds.append((open(vcf_file, "w"), sample_columns))
+        vcf.Writer(out_fds[-1][0], vcf_template_reader)
+
+    vcf_tabix = pysam.TabixFile(in_vcf)
+    #column separator of PyVCF
+    row_pattern = re.compile("\t| +")
     info_warned = False
     regions_bedtool = pybedtools.BedTool(regions_bed)
 
     logger.warning("only process fully-contained variants")
     logger.warning("right now we only deal with SVLEN, which is agnostic of region start")
     logger.warning("ignore END in INFO field for now")
-    for region_index, region in enumerate(regions_bedtool, start=1):
+    for group in get_fetch_groups(regions_bedtool):
+        contig = str(group[0][1].chrom)
         records = None
-        try: records = vcf_template_reader.fetch(chrom=str(region.chrom), start=region.start, end=region.end)
-        except ValueError: logger.info("No records found in %s from %s" % (str(region).strip(), in_vcf))
+        try: records = vcf_tabix.fetch(contig, group[0][1].start, group[-1][1].end)
+        except ValueError: logger.info("No records found in %s:%d-%d from %s" % (contig, group[0][1].start, group[-1][1].end, in_vcf))
         if records is None: continue
-        for record in records:
-            if record.POS <= region.start + flank or record.POS + len(record.REF) + flank - 1 >= region.end: continue
-            if 'SVTYPE' in record.INFO and record.INFO['SVTYPE'] in ['DEL','INV','DUP'] and record.POS + max(map(abs, record.INFO['SVLEN'])) >= region.end + flank: continue
-            record.CHROM = str(region_index) if use_short_contig_names else ("%s_%d_%d" % (str(region.chrom), region.start, region.end))
-            # record.POS seems to be zero-based, at least in the infinite wisdom of my version of pysam
-            record.POS = record.POS - region.start
-            if not new_samples:
-                vcf_writer.write_record(record)
-                continue
-            else:
-                snames = []
-                sindexes = {}
-            for s in new_samples:
-                for i in xrange(len(record.samples)):
-                    if s == record.samples[i].sample:
-                        sindexes[s] = i
-                        snames.append(record.samples[i])
-            vcfrecord = vcf.model._Record(record.CHROM, record.POS, record.ID, record.REF, record.ALT, record.QUAL, record.FILTER, record.INFO, record.FORMAT, sindexes, snames)
-            vcf_writer.write_record(vcfrecord)
-    vcf_writer.close()
-    pysam.tabix_index(out_vcf, force=True, preset='vcf')
-    logger.info("Lifted over the VCF %s to %s" % (in_vcf, out_vcf))
-
+        #records are dealt to the regions of the group in order, a record past the start of the next region is outside the current one
+        regions = [(str(region_index) if use_short_contig_names else ("%s_%d_%d" % (contig, region.start, region.end)), region.start, region.end)
+                   for region_index, region in group]
+        next_region = 1
+        chrom, region_start, region_end = regions[0]
+        for line in records:
+            line = line.rstrip()
+            row = line.split("\t") if " " not in line else row_pattern.split(line)
+            pos = int(row[1])
+            while next_region < len(regions) and pos > regions[next_region][1]:
+                chrom, region_start, region_end = regions[next_region]
+                next_region += 1
+            if pos <= region_start + flank or pos + len(row[3]) + flank - 1 >= region_end: continue
+            info = formatter.parse_info(row[7]) if "SVTYPE" in row[7] else {}
+            if 'SVTYPE' in info and info['SVTYPE'] in ['DEL','INV','DUP'] and pos + max(map(abs, info['SVLEN'])) >= region_end + flank: continue
+            # POS is one-based in the VCF, shifting it by the zero-based region start makes it one-based in the region
+            site = "\t".join([chrom, str(pos - region_start), row[2], row[3], formatter.format_alt(row[4]), formatter.format_qual_str(row[5]), row[6], formatter.format_info_str(row[7])])
+            fmt = row[8] if len(row) > 8 and row[8] != "." else None
+            for out_fd, sample_columns in out_fds:
+                if fmt is None:
+                    out_fd.write(site + "\n")
+                    continue
+                out_fd.write("\t".join([site, fmt] + [formatter.format_sample_str(fmt, row[column]) for column in sample_columns if column < len(row)]) + "\n")
+    for out_fd, _ in out_fds:
+        out_fd.close()
+    for vcf_file, _, _ in outputs:
+        pysam.tabix_index(vcf_file, force=True, preset='vcf')
+        logger.info("Lifted over the VCF %s to %s" % (in_vcf, vcf_file))
+
+    if per_sample:
+        return OrderedDict((samples[0], "{}.gz".format(vcf_file)) for vcf_file, samples, _ in outputs)
     return "{}.gz".format(out_vcf)
 
 
-def gen_restricted_ref_and_vcfs(reference, invcfs, regions, samples, outdir, flank=0, short_contig_names=False):
+def gen_restricted_ref_and_vcfs(reference, invcfs, regions, samples, outdir, flank=0, short_contig_names=False, per_sample=False):
     restricted_fasta = reference
     outvcfs = invcfs
 
@@ -133,7 +427,7 @@ def gen_restricted_ref_and_vcfs(reference, invcfs, regions, samples, outdir, fla
             outvcfs = map(lambda x: os.path.join(outdir, os.path.splitext(os.path.basename(x))[0]) if x else None, invcfs)
             generated_vcfs = []
             for invcf, outvcf in zip(invcfs, outvcfs):
-                generated_vcfs.append(gen_restricted_vcf(invcf, regions, outvcf, restricted_fasta, samples, flank, short_contig_names))
+                generated_vcfs.append(gen_restricted_vcf(invcf, regions, outvcf, restricted_fasta, samples, flank, short_contig_names, per_sample))
             outvcfs = generated_vcfs
 
     return (restricted_fasta, outvcfs)
@@ -150,10 +444,11 @@ def main():
     parser.add_argument("--flank", type=uint, default=0, help="Ignore variants this close to the edges of a region")
     parser.add_argument("--short_contig_names", action="store_true", help="Generate short contig names instead of the chr_start_end naming")
     parser.add_argument("--samples", nargs="+", default=[], help="Select specific samples. Select all samples if leave empty")
+    parser.add_argument("--per_sample", action="store_true", help="Write one VCF per selected sample, named <vcf>.<sample>.vcf.gz, instead of one VCF with all of them")
 
     args = parser.parse_args()
 
-    gen_restricted_ref_and_vcfs(args.reference, args.vcfs, args.regions, args.samples, args.outdir, args.flank, args.short_contig_names)
+    gen_restricted_ref_and_vcfs(args.reference, args.vcfs, args.regions, args.samples, args.outdir, args.flank, args.short_contig_names, args.per_sample)
 
 
 if __name__ == "__main__":
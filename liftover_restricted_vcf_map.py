@@ -3,13 +3,80 @@
 import os
 import sys
 import argparse
-import vcf
-import pysam
+import itertools
 import logging
-import copy
+import StringIO
 from collections import defaultdict, OrderedDict
-
-def lift_vcfs(vcfs, out_vcf, reference, tabix_index=True):
+import mapindex
+import utils
+
+def get_original_contig(contig):
+  '''
+  :param contig: restricted contig named chrom_start_end
+  :return: (original contig, 0-based start of the restricted contig on it)
+  '''
+  fields = contig.rsplit("_", 2)
+  return fields[0], int(fields[1])
+
+
+class OriginalContigs(dict):
+  '''
+  restricted contig -> get_original_contig of it, computed on first use
+  '''
+  def __missing__(self, contig):
+    self[contig] = get_original_contig(contig)
+    return self[contig]
+
+
+def lift_info(info, start, original_contigs):
+  '''
+  lift END by start and CHR2/POS2/END2 by the restricted contig in CHR2
+  '''
+  entries = info.split(";")
+  chr2_start = None
+  for index, entry in enumerate(entries):
+    if entry.startswith("CHR2="):
+      chr2, chr2_start = original_contigs[entry[5:]]
+      entries[index] = "CHR2=" + chr2
+  for index, entry in enumerate(entries):
+    key, _, value = entry.partition("=")
+    if key == "END":
+      entries[index] = "END=%d" % (int(value) + start)
+    elif key in ("POS2", "END2") and chr2_start is not None:
+      entries[index] = "%s=%d" % (key, int(value) + chr2_start)
+  return ";".join(entries)
+
+
+def lift_vcf_records(lines):
+  '''
+  lift raw records from restricted contigs to the original contigs, only CHROM, POS and the coordinates in INFO change
+  '''
+  logger = logging.getLogger(lift_vcf_records.__name__)
+  original_contigs = OriginalContigs()
+  for line in lines:
+    fields = line.rstrip("\n").split("\t", 8)
+    chrom, start = original_contigs[fields[0]]
+    fields[0] = chrom
+    fields[1] = str(int(fields[1]) + start)
+    if len(fields) > 7 and ("END" in fields[7] or "CHR2" in fields[7]):
+      try:
+        fields[7] = lift_info(fields[7], start, original_contigs)
+      except ValueError:
+        logger.error("Failed to process INFO %s" % fields[7])
+    yield "\t".join(fields) + "\n"
+
+
+def lift_vcfs(vcfs, out_vcf, reference, tabix_index=True, transform=None):
+  '''
+  lift VCFs on restricted contigs over to the original reference, removing the duplicates the liftover creates.
+  Records are streamed from raw lines and sorted with bounded memory, spilling sorted runs next to out_vcf
+  :param reference: original reference, gives the contigs of the header and the order of the records. Contigs are version sorted without it
+  :param tabix_index: write <out_vcf>.gz BGZF compressed with a tabix index instead of out_vcf
+  :param transform: function applied to every header line and lifted record in the same pass, e.g. utils.convert_cn
+  :return: the lifted VCF
+  '''
+  import vcf
+  import pysam
   logger = logging.getLogger(lift_vcfs.__name__)
 
   if not vcfs:
@@ -29,70 +96,50 @@ def lift_vcfs(vcfs, out_vcf, reference, tabix_index=True):
     vcf_template_reader.metadata["reference"] = reference
     vcf_template_reader.contigs = OrderedDict([(contig_name, vcf.parser._Contig(contig_name, contig_length)) for (contig_name, contig_length) in contigs])
 
-  vcf_records = []
-  for index, vcf_ in enumerate(vcfs):
-    with open(vcf_) as vcf_fd:
-      vcf_reader = vcf.Reader(vcf_fd)
-      for record in vcf_reader:
-        original_fields = record.CHROM.rsplit("_", 2)
-        original_chrom = original_fields[0]
-        original_start = int(original_fields[1])
-        info = None
-        try:
-          #info = vcf_template_reader._parse_info(record.INFO)
-          info = copy.deepcopy(record.INFO)
-          if "END" in info:
-            info["END"] += original_start
-          if "CHR2" in info:
-            chr2_fields = info["CHR2"].rsplit("_", 2)
-            chr2_start = int(chr2_fields[1])
-            info["CHR2"] = chr2_fields[0]
-            info["POS2"] += chr2_start
-            info["END2"] += chr2_start
-        except ValueError:
-          logger.error("Failed to process INFO %s" % str(record.INFO))
-
-        new_record = vcf.model._Record(original_chrom, record.POS + original_start, record.ID, record.REF, record.ALT, record.QUAL, record.FILTER, info, record.FORMAT, record._sample_indexes, record.samples)
-        vcf_records.append(new_record)
-
-  vcf_records.sort(key = lambda record: (record.CHROM, record.POS, record.REF, record.ALT))
-
+  # PyVCF only writes the header, records are lifted on their raw lines
+  header = StringIO.StringIO()
+  vcf.Writer(header, vcf_template_reader)
+
+  contig_order = utils.get_contig_order(reference) if reference else None
+  lifted_vcf = "{}.gz".format(out_vcf) if tabix_index else out_vcf
+  header_lines = header.getvalue().splitlines(True)
+  records = lift_vcf_records(utils.iter_vcf_records(vcfs))
+  if transform:
+    header_lines = map(transform, header_lines)
+    records = itertools.imap(transform, records)
+  lines = utils.sort_vcf_records(records, contig_order, tmp_dir=os.path.dirname(os.path.abspath(out_vcf)))
   # Write while removing non-unique entries after liftover
-  vcf_writer = vcf.Writer(open(out_vcf, "w"), vcf_template_reader)
-  for index in xrange(len(vcf_records)):
-      curr_record = vcf_records[index]
-      if index:
-          prev_record = vcf_records[index - 1]
-          if (curr_record.CHROM, curr_record.POS, curr_record.REF, curr_record.ALT) == (prev_record.CHROM, prev_record.POS, prev_record.REF, prev_record.ALT):
-              continue
-      vcf_writer.write_record(curr_record)
-  vcf_writer.close()
-  if tabix_index:
-      pysam.tabix_index(out_vcf, force=True, preset='vcf')
+  utils.write_vcf_records(lifted_vcf, header_lines,
+                          utils.filter_duplicate_records(lines, utils.COMBINE_KEEP_FIRST_DUPLICATE), gzip=tabix_index)
 
   logger.info("Finished liftover of VCF to original reference")
-  return "{}.gz".format(out_vcf) if tabix_index else out_vcf
+  return lifted_vcf
 
 
 def lift_maps(maps, out_map):
+  '''
+  lift text or binary maps over to the original reference
+  :param out_map: binary map if it ends with mapindex.BINARY_MAP_SUFFIX, text map otherwise
+  '''
   logger = logging.getLogger(lift_maps.__name__)
 
   if not maps:
     logger.info("No MAP files to lift")
     return
 
-  with open(out_map, "w") as out_fd:
+  original_contigs = OriginalContigs()
+
+  def lifted_blocks():
     for map_f in maps:
       logger.info("Lifting over " + map_f)
-      with open(map_f) as map_fd:
-        for line in map_fd:
-          if not line.strip():
-            continue
-          fields = line.strip().split("\t")
-          ref_fields = fields[3].split("_")
-          offset = int(ref_fields[-2])
-          original_ref = "_".join(ref_fields[:-2]) #in case _ is in original contig names
-          out_fd.write("\t".join(fields[:3] + [original_ref, str(int(fields[4]) + offset)] + fields[5:]) + "\n")
+      for block in mapindex.read_map(map_f):
+        original_ref, offset = original_contigs[block.ref_chr]
+        yield block._replace(ref_chr=original_ref, ref_loc=block.ref_loc + offset)
+
+  if out_map.endswith(mapindex.BINARY_MAP_SUFFIX):
+    mapindex.write_binary_map(lifted_blocks(), out_map)
+  else:
+    mapindex.write_text_map(lifted_blocks(), out_map)
 
   return out_map
 
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+'''
+Indexed binary form of the vcf2diploid map file (see formats.md) and coordinate lookups on it
+
+Layout (little-endian):
+    header      magic, number of strings, blocks, host contigs and reference contigs
+    strings     contig names, features and variant ids, each as a 4-byte length and the bytes
+    contigs     per host contig then per reference contig: name, first sorted entry, number of entries,
+                level of the root of its interval tree
+    blocks      size, host contig, host location, reference contig, reference location, feature,
+                variant id (32 bits each) and direction, in the order of the text map
+    host index  block numbers, starts and ends of the blocks sorted by host contig and location, and
+                the largest end in the subtree of each block
+    ref index   same, sorted by reference contig and location
+Locations are 1-based as in the text map. INS blocks take no reference bases and DEL blocks no host bases.
+
+The blocks of a contig sorted by location make up an implicit interval tree (as in cgranges): block i is a
+node of level k if its lowest k bits are set and bit k is not, its children are i -/+ 2^(k-1).
+'''
+import argparse
+import gzip
+import logging
+import mmap
+import struct
+import sys
+from array import array
+from collections import namedtuple
+
+MAGIC = 'VSMAP\0\2\0'
+#start of the magic of all versions of the format
+MAGIC_PREFIX = MAGIC[:6]
+HEADER = struct.Struct('<8s4I')
+CONTIG = struct.Struct('<4I')
+BLOCK = struct.Struct('<7IB3x')
+U32 = struct.Struct('<I')
+#subtrees of this level or lower are scanned instead of searched
+SCANNED_LEVEL = 3
+#suffix of binary maps, text maps end with .map
+BINARY_MAP_SUFFIX = '.bmap'
+
+MapBlock = namedtuple('MapBlock', ['size', 'host_chr', 'host_loc', 'ref_chr', 'ref_loc', 'direction', 'feature', 'variant_id'])
+#a location lifted over by a block of the map
+MapHit = namedtuple('MapHit', ['chr', 'loc', 'direction', 'feature', 'variant_id'])
+
+
+def host_length(block):
+    return 0 if block.feature == 'DEL' else block.size
+
+
+def ref_length(block):
+    return 0 if block.feature == 'INS' else block.size
+
+
+def parse_map_line(line):
+    '''
+    :return: MapBlock of a line of a text map, None for an empty line
+    '''
+    fields = line.rstrip('\r\n').split('\t')
+    if not fields[0].strip():
+        return None
+    return MapBlock(int(fields[0]), fields[1], int(fields[2]), fields[3], int(fields[4]), fields[5], fields[6],
+                    fields[7] if len(fields) > 7 else '')
+
+
+def format_map_line(block):
+    fields = [str(block.size), block.host_chr, str(block.host_loc), block.ref_chr, str(block.ref_loc), block.direction, block.feature]
+    if block.variant_id:
+        fields.append(block.variant_id)
+    return '\t'.join(fields) + '\n'
+
+
+def is_binary_map(filename):
+    with open(filename, 'rb') as map_fd:
+        return map_fd.read(len(MAGIC_PREFIX)) == MAGIC_PREFIX
+
+
+def read_map(filename):
+    '''
+    :return: generator of the MapBlocks of a text (gzipped if it ends with .gz) or binary map, in the order of the map
+    '''
+    if is_binary_map(filename):
+        with MapIndex(filename) as map_index:
+            for block in map_index:
+                yield block
+        return
+    with (gzip.open(filename) if filename.endswith('.gz') else open(filename)) as map_fd:
+        for line in map_fd:
+            block = parse_map_line(line)
+            if block is not None:
+                yield block
+
+
+def write_text_map(blocks, filename):
+    with open(filename, 'w') as out_fd:
+        for block in blocks:
+            out_fd.write(format_map_line(block))
+    return filename
+
+
+def interval_tree_max_ends(ends):
+    '''
+    :param ends: ends of the blocks of a contig sorted by start
+    :return: (largest end in the subtree of each block, level of the root)
+    '''
+    n = len(ends)
+    max_ends = array('I', ends)
+    last = ends[n - 1 - (n - 1) % 2]
+    last_i = n - 1 - (n - 1) % 2
+    k = 1
+    #nodes of level k from their children, a missing right child counts as the last node of level k - 1
+    while 1 << k <= n:
+        x = 1 << (k - 1)
+        for i in xrange(2 * x - 1, n, 4 * x):
+            right = max_ends[i + x] if i + x < n else last
+            max_ends[i] = max(ends[i], max_ends[i - x], right)
+        last_i = last_i - x if last_i >> k & 1 else last_i + x
+        if last_i < n:
+            last = max(last, max_ends[last_i])
+        k += 1
+    return max_ends, k - 1
+
+
+def write_binary_map(blocks, filename):
+    '''
+    write MapBlocks as an indexed binary map, the blocks are kept in memory as arrays while indexing
+    '''
+    strings = []
+    string_ids = {}
+
+    def string_id(string):
+        if string not in string_ids:
+            string_ids[string] = len(strings)
+            strings.append(string)
+        return string_ids[string]
+
+    fields = [array('I') for _ in xrange(7)]
+    directions = array('B')
+    host_lengths = array('I')
+    ref_lengths = array('I')
+    for block in blocks:
+        for column, value in enumerate((block.size, string_id(block.host_chr), block.host_loc, string_id(block.ref_chr),
+                                        block.ref_loc, string_id(block.feature), string_id(block.variant_id))):
+            fields[column].append(value)
+        directions.append(ord(block.direction))
+        host_lengths.append(host_length(block))
+        ref_lengths.append(ref_length(block))
+    sizes, host_chrs, host_locs, ref_chrs, ref_locs, features, variant_ids = fields
+
+    def index(chrs, locs, lengths):
+        #blocks of a contig are contiguous, in the order the contigs first appear
+        contig_order = {}
+        for chr in chrs:
+            contig_order.setdefault(chr, len(contig_order))
+        order = sorted(xrange(len(chrs)), key=lambda i: (contig_order[chrs[i]], locs[i], i))
+        contigs = []
+        for position, i in enumerate(order):
+            if not contigs or contigs[-1][0] != chrs[i]:
+                contigs.append([chrs[i], position, 0, 0])
+            contigs[-1][2] += 1
+        ends = array('I', (locs[i] + lengths[i] for i in order))
+        max_ends = array('I')
+        for contig in contigs:
+            contig_max_ends, contig[3] = interval_tree_max_ends(ends[contig[1]:contig[1] + contig[2]])
+            max_ends.extend(contig_max_ends)
+        return contigs, [array('I', order), array('I', (locs[i] for i in order)), ends, max_ends]
+
+    host_contigs, host_index = index(host_chrs, host_locs, host_lengths)
+    ref_contigs, ref_index = index(ref_chrs, ref_locs, ref_lengths)
+
+    with open(filename, 'wb') as out_fd:
+        out_fd.write(HEADER.pack(MAGIC, len(strings), len(sizes), len(host_contigs), len(ref_contigs)))
+        for string in strings:
+            out_fd.write(U32.pack(len(string)))
+            out_fd.write(string)
+        for contig in host_contigs + ref_contigs:
+            out_fd.write(CONTIG.pack(*contig))
+        for i in xrange(len(sizes)):
+            out_fd.write(BLOCK.pack(sizes[i], host_chrs[i], host_locs[i], ref_chrs[i], ref_locs[i], features[i], variant_ids[i], directions[i]))
+        for column in host_index + ref_index:
+            if sys.byteorder != 'little':
+                column.byteswap()
+            column.tofile(out_fd)
+    return filename
+
+
+class U32Array(object):
+    '''
+    read-only sequence of the 32-bit unsigned integers at an offset of a buffer, for bisect
+    '''
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return U32.unpack_from(self.buf, self.offset + 4 * i)[0]
+
+
+class MapIndex(object):
+    '''
+    lookups on a memory-mapped binary map, each a binary search over the blocks of one contig
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = open(filename, 'rb')
+        self.buf = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_strings, self.num_blocks, num_host_contigs, num_ref_contigs = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a binary map of this version'.format(filename))
+        offset = HEADER.size
+        self.strings = []
+        for _ in xrange(num_strings):
+            length = U32.unpack_from(self.buf, offset)[0]
+            self.strings.append(self.buf[offset + 4:offset + 4 + length])
+            offset += 4 + length
+        #contig name -> (first sorted entry, number of entries, level of the root of the interval tree)
+        self.host_contigs = {}
+        self.ref_contigs = {}
+        for contigs, num_contigs in ((self.host_contigs, num_host_contigs), (self.ref_contigs, num_ref_contigs)):
+            for _ in xrange(num_contigs):
+                name, first, count, root_level = CONTIG.unpack_from(self.buf, offset)
+                contigs[self.strings[name]] = (first, count, root_level)
+                offset += CONTIG.size
+        self.blocks_offset = offset
+        offset += BLOCK.size * self.num_blocks
+        self.host_index = []
+        self.ref_index = []
+        for index in (self.host_index, self.ref_index):
+            for _ in xrange(4):
+                index.append(U32Array(self.buf, offset, self.num_blocks))
+                offset += 4 * self.num_blocks
+
+    def __len__(self):
+        return self.num_blocks
+
+    def __getitem__(self, i):
+        '''
+        :return: MapBlock i in the order of the map
+        '''
+        if not 0 <= i < self.num_blocks:
+            raise IndexError(i)
+        size, host_chr, host_loc, ref_chr, ref_loc, feature, variant_id, direction = BLOCK.unpack_from(self.buf, self.blocks_offset + BLOCK.size * i)
+        return MapBlock(size, self.strings[host_chr], host_loc, self.strings[ref_chr], ref_loc, chr(direction),
+                        self.strings[feature], self.strings[variant_id])
+
+    def __iter__(self):
+        for i in xrange(self.num_blocks):
+            yield self[i]
+
+    def overlapping(self, contigs, index, chr, loc):
+        '''
+        search of the interval tree of the contig, subtrees are skipped if they end before loc
+        or (right subtrees) start after loc
+        :return: numbers of the blocks covering loc, in the order of the map
+        '''
+        if chr not in contigs:
+            return []
+        first, count, root_level = contigs[chr]
+        order, starts, ends, max_ends = index
+        found = []
+        #(node, level, left subtree done), node numbers relative to first
+        stack = [((1 << root_level) - 1, root_level, False)]
+        while stack:
+            node, level, left_done = stack.pop()
+            if level <= SCANNED_LEVEL:
+                subtree = node >> level << level
+                for i in xrange(first + subtree, first + min(subtree + (1 << (level + 1)) - 1, count)):
+                    if starts[i] > loc:
+                        break
+                    if ends[i] > loc:
+                        found.append(order[i])
+            elif not left_done:
+                stack.append((node, level, True))
+                left = node - (1 << (level - 1))
+                #missing nodes are on the way to the last blocks
+                if left >= count or max_ends[first + left] > loc:
+                    stack.append((left, level - 1, False))
+            elif node < count and starts[first + node] <= loc:
+                if ends[first + node] > loc:
+                    found.append(order[first + node])
+                stack.append((node + (1 << (level - 1)), level - 1, False))
+        return sorted(found)
+
+    def host_to_ref(self, chr, loc):
+        '''
+        lift a 1-based host location over to the reference
+        :return: list of MapHits, one per block covering loc. Inserted bases give the location the insertion is at
+        '''
+        hits = []
+        for i in self.overlapping(self.host_contigs, self.host_index, chr, loc):
+            block = self[i]
+            hits.append(MapHit(block.ref_chr, lift_location(block, loc, block.host_loc, block.ref_loc, 'INS'), block.direction, block.feature, block.variant_id))
+        return hits
+
+    def ref_to_host(self, chr, loc):
+        '''
+        lift a 1-based reference location over to the host
+        :return: list of MapHits, one per block covering loc (several for duplications). Deleted bases give the location the deletion is at
+        '''
+        hits = []
+        for i in self.overlapping(self.ref_contigs, self.ref_index, chr, loc):
+            block = self[i]
+            hits.append(MapHit(block.host_chr, lift_location(block, loc, block.ref_loc, block.host_loc, 'DEL'), block.direction, block.feature, block.variant_id))
+        return hits
+
+    def close(self):
+        self.buf.close()
+        self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def lift_location(block, loc, from_loc, to_loc, unmapped_feature):
+    if block.feature == unmapped_feature:
+        return to_loc
+    if block.direction == '-':
+        return to_loc + block.size - 1 - (loc - from_loc)
+    return to_loc + loc - from_loc
+
+
+def main():
+    FORMAT = '%(levelname)s %(asctime)-15s %(name)-20s %(message)s'
+    logging.basicConfig(level=logging.INFO, format=FORMAT)
+    logger = logging.getLogger(main.__name__)
+
+    parser = argparse.ArgumentParser(description="Convert vcf2diploid map files between the text and the indexed binary format", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("in_map", help="Text or binary map")
+    parser.add_argument("out_map", help="Output map, binary if it ends with {} and text otherwise".format(BINARY_MAP_SUFFIX))
+
+    args = parser.parse_args()
+
+    if args.out_map.endswith(BINARY_MAP_SUFFIX):
+        write_binary_map(read_map(args.in_map), args.out_map)
+    else:
+        write_text_map(read_map(args.in_map), args.out_map)
+    logger.info("Converted {} to {}".format(args.in_map, args.out_map))
+
+
+if __name__ == "__main__":
+    main()
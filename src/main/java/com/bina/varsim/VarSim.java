@@ -45,6 +45,7 @@ public class VarSim {
                 + "       vcf2diploid    -- Enhanced version of vcf2diploid from alleleseq \n"
                 + "       fastq_liftover -- Lifts over simulated FASTQ files to reference coordinates \n"
                 + "       liftover       -- Lifts a file to desired coordinates \n"
+                + "       worker         -- Keeps VarSim.jar loaded and runs tools for local clients \n"
                 + "\n";
 
         System.err.println(VarSim.class.getSimpleName() + " " + VERSION);
@@ -97,6 +98,9 @@ public class VarSim {
             case LiftOver:
                 new LiftOver(command, description).run(pass_args);
                 break;
+            case Worker:
+                new VarSimWorker(command, description).run(pass_args);
+                break;
             case Help:
                 printUsage();
                 break;
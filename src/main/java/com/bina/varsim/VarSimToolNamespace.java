@@ -14,6 +14,7 @@ public enum VarSimToolNamespace {
     LongISLNDLiftover("longislnd_liftover", "Lift read map files to the right reference", com.bina.varsim.fastqLiftover.LongISLNDReadMapLiftOver.class),
     JSONInserter("json_inserter", "Inserts n JSON files to one HTML to create n HTML files", com.bina.varsim.tools.evaluation.JSONInserter.class),
     LiftOver("liftover", "Lift over a file to desired coordinates", com.bina.varsim.tools.LiftOver.class),
+    Worker("worker", "Keep VarSim.jar loaded and run tools for local clients", com.bina.varsim.VarSimWorker.class),
     Help("-help", null, null, new String[]{"-h"}),
     Version("-version", null, null),
     Unknown("", null, null);
@@ -0,0 +1,319 @@
+package com.bina.varsim;
+
+import org.apache.log4j.ConsoleAppender;
+import org.apache.log4j.Logger;
+import org.kohsuke.args4j.Option;
+
+import java.io.*;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.*;
+import java.nio.file.attribute.PosixFilePermissions;
+import java.security.MessageDigest;
+import java.security.Permission;
+import java.security.SecureRandom;
+import java.util.Enumeration;
+import java.util.concurrent.locks.ReentrantLock;
+
+/**
+ * Long-lived VarSim.jar which runs tools for local clients, so that a tool run does not pay for
+ * JVM startup and JIT warm-up.
+ * <p/>
+ * The worker listens on a loopback port. The port, an access token and the working directory of the
+ * worker are written, one per line, to the address file, which only the user can read.
+ * A request is the token, the number of arguments and the arguments of VarSim.jar (without java options).
+ * Strings are sent as a 4-byte big-endian length followed by UTF-8 bytes. Requests with a longer token,
+ * more arguments or more bytes of arguments than the limits below are dropped before anything is allocated for them.
+ * The reply is a sequence of frames: a 1-byte channel (1 stdout, 2 stderr, 0 exit), the 4-byte length
+ * of the payload and the payload. The exit frame carries the 4-byte exit status of the tool and ends the reply.
+ * <p/>
+ * Connections are read concurrently, one thread per connection, but only one tool runs at a time: the tools keep
+ * state in static fields (random number generators, loggers and options), which requests running together would
+ * share. A request arriving while a tool runs is closed without a reply, so that the client runs it in a JVM of its
+ * own as it does without a worker. System.out and System.err are routed to the client of the running request, and
+ * System.exit in a tool only ends its request. The security manager is only there to trap System.exit, it allows
+ * everything else and does not isolate requests from each other.
+ */
+public class VarSimWorker extends VarSimTool {
+    static final int CHANNEL_EXIT = 0;
+    static final int CHANNEL_STDOUT = 1;
+    static final int CHANNEL_STDERR = 2;
+    static final int MAX_TOKEN_BYTES = 64;
+    static final int MAX_ARGUMENTS = 1 << 16;
+    static final int MAX_ARGUMENTS_BYTES = 1 << 24;
+
+    @Option(name = "-address_file", usage = "File to write port, token and working directory of the worker to [Required]", metaVar = "file", required = true)
+    String addressFile;
+
+    @Option(name = "-port", usage = "Loopback port to listen on, 0 for any free port [0]")
+    int port = 0;
+
+    /**
+     * held while a tool runs
+     */
+    final ReentrantLock toolLock = new ReentrantLock();
+
+    public VarSimWorker(final String command, final String description) {
+        super(command, description);
+    }
+
+    /**
+     * System.exit called by a tool run for a request
+     */
+    static class ExitException extends SecurityException {
+        final int status;
+
+        ExitException(final int status) {
+            super("System.exit(" + status + ")");
+            this.status = status;
+        }
+    }
+
+    /**
+     * Turns System.exit of request threads into ExitException, everything else is allowed
+     */
+    static class ExitTrap extends SecurityManager {
+        final InheritableThreadLocal<Boolean> inRequest = new InheritableThreadLocal<Boolean>() {
+            @Override
+            protected Boolean initialValue() {
+                return false;
+            }
+        };
+
+        @Override
+        public void checkPermission(final Permission permission) {
+        }
+
+        @Override
+        public void checkPermission(final Permission permission, final Object context) {
+        }
+
+        @Override
+        public void checkExit(final int status) {
+            if (inRequest.get()) {
+                throw new ExitException(status);
+            }
+        }
+    }
+
+    /**
+     * PrintStream writing to the stream set for the current thread (and the threads it starts)
+     */
+    static class ThreadPrintStream extends PrintStream {
+        final InheritableThreadLocal<PrintStream> streams;
+
+        ThreadPrintStream(final PrintStream fallback) {
+            super(fallback, true);
+            streams = new InheritableThreadLocal<PrintStream>() {
+                @Override
+                protected PrintStream initialValue() {
+                    return fallback;
+                }
+            };
+        }
+
+        @Override
+        public void write(final int b) {
+            streams.get().write(b);
+        }
+
+        @Override
+        public void write(final byte[] buf, final int off, final int len) {
+            streams.get().write(buf, off, len);
+        }
+
+        @Override
+        public void flush() {
+            streams.get().flush();
+        }
+
+        @Override
+        public void close() {
+            streams.get().close();
+        }
+    }
+
+    /**
+     * Writes data as frames of one channel of the reply
+     */
+    static class FrameOutputStream extends OutputStream {
+        final DataOutputStream reply;
+        final int channel;
+
+        FrameOutputStream(final DataOutputStream reply, final int channel) {
+            this.reply = reply;
+            this.channel = channel;
+        }
+
+        @Override
+        public void write(final int b) throws IOException {
+            write(new byte[]{(byte) b}, 0, 1);
+        }
+
+        @Override
+        public void write(final byte[] buf, final int off, final int len) throws IOException {
+            if (len == 0) {
+                return;
+            }
+            synchronized (reply) {
+                reply.writeByte(channel);
+                reply.writeInt(len);
+                reply.write(buf, off, len);
+                reply.flush();
+            }
+        }
+    }
+
+    static byte[] readBytes(final DataInputStream request, final int maxLength) throws IOException {
+        final int length = request.readInt();
+        if (length < 0 || length > maxLength) {
+            throw new IOException("Request string of " + length + " bytes, at most " + maxLength + " are accepted");
+        }
+        final byte[] bytes = new byte[length];
+        request.readFully(bytes);
+        return bytes;
+    }
+
+    /**
+     * Run a tool in this JVM
+     */
+    void runTool(final String[] args) throws IOException {
+        new VarSim().run(args);
+    }
+
+    /**
+     * Run the tool of one connection and send back its output and exit status,
+     * or close the connection without a reply if another tool is running
+     */
+    void serve(final Socket socket, final String token, final ExitTrap exitTrap,
+               final ThreadPrintStream out, final ThreadPrintStream err) {
+        try {
+            final DataInputStream request = new DataInputStream(new BufferedInputStream(socket.getInputStream()));
+            final DataOutputStream reply = new DataOutputStream(new BufferedOutputStream(socket.getOutputStream()));
+            // constant time comparison, the time taken does not tell how much of the token is right
+            if (!MessageDigest.isEqual(token.getBytes(StandardCharsets.UTF_8), readBytes(request, MAX_TOKEN_BYTES))) {
+                return;
+            }
+            final int numArgs = request.readInt();
+            if (numArgs < 0 || numArgs > MAX_ARGUMENTS) {
+                return;
+            }
+            final String[] args = new String[numArgs];
+            int argsBytes = 0;
+            for (int i = 0; i < args.length; i++) {
+                final byte[] arg = readBytes(request, MAX_ARGUMENTS_BYTES - argsBytes);
+                argsBytes += arg.length;
+                args[i] = new String(arg, StandardCharsets.UTF_8);
+            }
+            if (!toolLock.tryLock()) {
+                return;
+            }
+
+            final PrintStream toolOut = new PrintStream(new BufferedOutputStream(new FrameOutputStream(reply, CHANNEL_STDOUT), 1 << 16), false);
+            final PrintStream toolErr = new PrintStream(new FrameOutputStream(reply, CHANNEL_STDERR), true);
+            out.streams.set(toolOut);
+            err.streams.set(toolErr);
+            exitTrap.inRequest.set(true);
+            int status = 0;
+            try {
+                runTool(args);
+            } catch (ExitException e) {
+                status = e.status;
+            } catch (Throwable e) {
+                e.printStackTrace(toolErr);
+                status = 1;
+            } finally {
+                exitTrap.inRequest.set(false);
+                out.streams.remove();
+                err.streams.remove();
+                toolLock.unlock();
+            }
+            toolOut.flush();
+            toolErr.flush();
+            synchronized (reply) {
+                reply.writeByte(CHANNEL_EXIT);
+                reply.writeInt(4);
+                reply.writeInt(status);
+                reply.flush();
+            }
+        } catch (IOException e) {
+            // the client went away, nothing to report to
+        } finally {
+            try {
+                socket.close();
+            } catch (IOException e) {
+                // already closed
+            }
+        }
+    }
+
+    /**
+     * Write the address file atomically, readable only by the user
+     */
+    void writeAddressFile(final Path address, final int port, final String token) throws IOException {
+        final Path directory = address.toAbsolutePath().getParent();
+        final Path tmp = Files.createTempFile(directory, address.getFileName().toString(), ".tmp",
+                PosixFilePermissions.asFileAttribute(PosixFilePermissions.fromString("rw-------")));
+        final String content = port + "\n" + token + "\n" + new File(".").getCanonicalPath() + "\n";
+        Files.write(tmp, content.getBytes(StandardCharsets.UTF_8));
+        Files.move(tmp, address, StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE);
+    }
+
+    public void run(String[] args) throws IOException {
+        if (!parseArguments(args)) {
+            return;
+        }
+
+        // route tool output, including log4j console output, to the client of each request
+        final ThreadPrintStream out = new ThreadPrintStream(System.out);
+        final ThreadPrintStream err = new ThreadPrintStream(System.err);
+        System.setOut(out);
+        System.setErr(err);
+        final Enumeration appenders = Logger.getRootLogger().getAllAppenders();
+        while (appenders.hasMoreElements()) {
+            final Object appender = appenders.nextElement();
+            if (appender instanceof ConsoleAppender) {
+                ((ConsoleAppender) appender).setFollow(true);
+                ((ConsoleAppender) appender).activateOptions();
+            }
+        }
+        final ExitTrap exitTrap = new ExitTrap();
+        System.setSecurityManager(exitTrap);
+
+        final byte[] secret = new byte[16];
+        new SecureRandom().nextBytes(secret);
+        final StringBuilder token = new StringBuilder();
+        for (final byte b : secret) {
+            token.append(String.format("%02x", b));
+        }
+
+        final ServerSocket server = new ServerSocket(port, 50, InetAddress.getLoopbackAddress());
+        final Path address = Paths.get(addressFile);
+        writeAddressFile(address, server.getLocalPort(), token.toString());
+        Runtime.getRuntime().addShutdownHook(new Thread() {
+            @Override
+            public void run() {
+                try {
+                    Files.deleteIfExists(address);
+                } catch (IOException e) {
+                    // nothing left to do
+                }
+            }
+        });
+        err.println(VERSION + " worker listening on port " + server.getLocalPort());
+
+        while (true) {
+            final Socket socket = server.accept();
+            final Thread thread = new Thread() {
+                @Override
+                public void run() {
+                    serve(socket, token.toString(), exitTrap, out, err);
+                }
+            };
+            thread.setDaemon(true);
+            thread.start();
+        }
+    }
+}
@@ -19,7 +19,7 @@ abstract public class RandVCFgenerator extends VarSimTool {
     static private final long DEFAULT_SEED = 3333;
 
     @Option(name = "-seed", usage = "Seed for random number generator")
-    static protected long seed = DEFAULT_SEED;
+    protected long seed = DEFAULT_SEED;
 
     /**
      * This sets a default seed, ideally different between different runs
@@ -55,7 +55,14 @@ public class VCF2diploid extends VarSimTool {
     File outDir = new File("").getAbsoluteFile();
     @Option(name = "-no_contig_id", usage = "suppress writing contig IDs into VCF headers (useful when number of contigs is large)")
     private boolean noContigID = false;
+    @Option(name = "-contig", usage = "Only build this contig, can be given multiple times. Each contig gets its own map " +
+            "<contig>_<id>.map and <id>.contigs lists the contigs in the order their maps make up the map of all contigs [all contigs]", metaVar = "contig")
+    List<String> contigs = null;
     private Map<ChrString, List<Variant>> variants = new HashMap<>();
+    // contigs given with -contig, null to build all contigs
+    private Set<ChrString> selectedContigs = null;
+    // number of unphased variants of each contig not built, their variants are not kept
+    private Map<ChrString, Integer> skippedUnphasedVariants = new HashMap<>();
 
     /**
      * set seed for random number generation
@@ -109,6 +116,12 @@ public class VCF2diploid extends VarSimTool {
             outDir.mkdirs();
         }
 
+        if (contigs != null) {
+            selectedContigs = new HashSet<>();
+            for (final String contig : contigs) {
+                selectedContigs.add(new ChrString(contig));
+            }
+        }
         parseVCFs(vcfFiles, variants, id, pass);
         makeDiploid();
     }
@@ -148,6 +161,15 @@ public class VCF2diploid extends VarSimTool {
                 }
 
                 ChrString chr = var.getChr();
+                if (selectedContigs != null && !selectedContigs.contains(chr)) {
+                    // only the random haplotype draws of the variants of contigs not built are needed
+                    if (!var.isPhased()) {
+                        skippedUnphasedVariants.put(chr, (skippedUnphasedVariants.containsKey(chr) ? skippedUnphasedVariants.get(chr) : 0) + 1);
+                    }
+                    nVariant++;
+                    nVariantBase += var.variantBases();
+                    continue;
+                }
                 if (!variants.containsKey(chr)) {
                     variants.put(chr, new ArrayList<Variant>());
                 }
@@ -187,12 +209,10 @@ public class VCF2diploid extends VarSimTool {
         idList.add(id);
         final String header = VCFWriter.generateVCFHeader(noContigID? null : allSequences, new ImmutableList.Builder<String>().addAll(idList).build());
 
+        StringBuilder contigOrder = new StringBuilder();
+
         // This is the loop through each chromosome
         for (ChrString chr : allSequences.keySet()) {
-            Sequence referenceSequence = allSequences.getSequence(chr);
-
-            log.info("Working on " + referenceSequence.getName() + "...");
-
             boolean outputPaternal = true;
             boolean outputMaternal = true;
 
@@ -219,8 +239,24 @@ public class VCF2diploid extends VarSimTool {
                 continue;
             }
 
+            contigOrder.append(chr).append('\n');
+            if (selectedContigs != null && !selectedContigs.contains(chr)) {
+                // skipped contigs still draw their random haplotypes with the draw of Variant.randomizeHaplotype,
+                // so the contigs built come out the same as when all contigs are built.
+                // Their sequences are not loaded
+                final int unphased = skippedUnphasedVariants.containsKey(chr) ? skippedUnphasedVariants.get(chr) : 0;
+                for (int i = 0; i < unphased; i++) {
+                    Variant.drawHaplotypeSwap(rand);
+                }
+                continue;
+            }
+
+            log.info("Working on " + chr + "...");
+            Sequence referenceSequence = allSequences.getSequence(chr);
+
             // this is the list of variants for the chromosome of question
             final List<Variant> varList = variants.containsKey(chr) ? variants.get(chr) : Collections.EMPTY_LIST;
+            final StringBuilder contigMapString = selectedContigs == null ? mapString : new StringBuilder();
 
             final List<Boolean> maternalIsVariantAdded = new ArrayList<>();
             final List<Boolean> paternalIsVariantAdded = new ArrayList<>();
@@ -289,7 +325,7 @@ public class VCF2diploid extends VarSimTool {
             if (outputPaternal) {
                 String paternalSequenceName = referenceSequence.getName() + "_" + DIPLOID_CHRS[1];
                 String paternalSequenceFileName = referenceSequence.getName() + "_" + id + "_" + DIPLOID_CHRS[1] + ".fa";
-                makePosMap(mapString, paternalSequenceName, referenceSequence, paternalMaskedSequence, paternalInsertionSeq);
+                makePosMap(contigMapString, paternalSequenceName, referenceSequence, paternalMaskedSequence, paternalInsertionSeq);
                 writeHaploid(paternalMaskedSequence, paternalInsertionSeq, paternalSequenceName, paternalSequenceFileName);
                 log.info("Applied " + nPaternalVariant + " variants "
                         + nPaternalVariantBase + " bases to " + "paternal genome.");
@@ -298,23 +334,41 @@ public class VCF2diploid extends VarSimTool {
             if (outputMaternal) {
                 String maternalSequenceName = referenceSequence.getName() + "_" + DIPLOID_CHRS[0];
                 String maternalSequenceFileName = referenceSequence.getName() + "_" + id + "_" + DIPLOID_CHRS[0] + ".fa";
-                makePosMap(mapString, maternalSequenceName, referenceSequence, maternalMaskedSequence, maternalInsertionSeq);
+                makePosMap(contigMapString, maternalSequenceName, referenceSequence, maternalMaskedSequence, maternalInsertionSeq);
                 writeHaploid(maternalMaskedSequence, maternalInsertionSeq, maternalSequenceName, maternalSequenceFileName);
                 log.info("Applied " + nMaternalVariant + " variants "
                         + nMaternalVariantBase + " bases to " + "maternal genome.");
             }
+
+            if (selectedContigs != null) {
+                writeFile(contigMapString.toString(), new File(outDir, referenceSequence.getName() + "_" + id + ".map"));
+            }
         }
 
+        if (selectedContigs != null) {
+            writeFile(contigOrder.toString(), new File(outDir, id + ".contigs"));
+            return;
+        }
+        mapString.append(System.lineSeparator());
+        if (writeFile(mapString.toString(), new File(outDir, id + ".map"))) {
+            outputMap = new File(outDir, id + ".map");
+        }
+    }
+
+    /**
+     * @return true if the file could be written
+     */
+    private boolean writeFile(final String content, final File file) {
         try {
-            FileWriter fw = new FileWriter(new File(outDir, id + ".map"));
+            FileWriter fw = new FileWriter(file);
             BufferedWriter bw = new BufferedWriter(fw);
-            bw.write(mapString.toString());
-            bw.newLine();
+            bw.write(content);
             bw.close();
             fw.close();
-            outputMap = new File(outDir, id + ".map");
+            return true;
         } catch (IOException ex) {
             log.error(ex.toString());
+            return false;
         }
     }
 
@@ -615,14 +669,32 @@ public class VCF2diploid extends VarSimTool {
         try {
             FileWriter fw = new FileWriter(new File(outDir, sequenceFileName));
             BufferedWriter bw = new BufferedWriter(fw);
-            writeGenome(bw, sequenceName, sequence, insSeq);
+            final long length = writeGenome(bw, sequenceName, sequence, insSeq);
             bw.close();
             fw.close();
+            writeFastaIndex(sequenceName, length, new File(outDir, sequenceFileName + ".fai"));
         } catch (IOException ex) {
             log.error(ex.toString());
         }
     }
 
+    /**
+     * write the .fai of a FASTA written by writeGenome, as samtools faidx would (empty sequences are left out)
+     */
+    private void writeFastaIndex(final String sequenceName, final long length, final File indexFile) throws IOException {
+        final int separatorLength = System.lineSeparator().length();
+        final long lineBases = Math.min(length, LineWidth);
+        final long offset = sequenceName.length() + 1 + separatorLength;
+        FileWriter fw = new FileWriter(indexFile);
+        BufferedWriter bw = new BufferedWriter(fw);
+        if (length > 0) {
+            bw.write(sequenceName + "\t" + length + "\t" + offset + "\t" + lineBases + "\t" + (lineBases + separatorLength));
+            bw.newLine();
+        }
+        bw.close();
+        fw.close();
+    }
+
     /**
      * write specified perturbed haploid genome into output stream
      * with proper line wrapping
@@ -631,10 +703,12 @@ public class VCF2diploid extends VarSimTool {
      * @param name
      * @param genome
      * @param insertPosition2Sequence
+     * @return number of bases written
      * @throws IOException
      */
-    private void writeGenome(final BufferedWriter bw, final String name, final byte[] genome,
+    private long writeGenome(final BufferedWriter bw, final String name, final byte[] genome,
                              final Hashtable<Integer, FlexSeq> insertPosition2Sequence) throws IOException {
+        long length = 0;
 
         // write header
         bw.write(">" + name);
@@ -656,6 +730,7 @@ public class VCF2diploid extends VarSimTool {
                 bw.write(line.toString(), 0, LineWidth);
                 bw.newLine();
                 line.delete(0, LineWidth);
+                length += LineWidth;
             }
         }
         while (line.length() > 0) {
@@ -663,7 +738,9 @@ public class VCF2diploid extends VarSimTool {
             bw.write(line.toString(), 0, n);
             bw.newLine();
             line.delete(0, n);
+            length += n;
         }
+        return length;
     }
 
     /*
@@ -945,6 +945,16 @@ public class Variant implements Comparable<Variant>{
         return alts.length;
     }
 
+    /**
+     * Draw whether the haplotypes of an unphased variant are swapped, one draw per variant
+     *
+     * @param rand random number generator shared by all variants
+     * @return true if the haplotypes are swapped
+     */
+    public static boolean drawHaplotypeSwap(final Random rand) {
+        return rand.nextDouble() <= 0.5;
+    }
+
     /**
      * Randomly swap the haploype
      */
@@ -956,7 +966,7 @@ public class Variant implements Comparable<Variant>{
         }
 
         isPhased = true;
-        if (rand.nextDouble() > 0.5) {
+        if (!drawHaplotypeSwap(rand)) {
             return;
         }
         byte tmp = paternal;
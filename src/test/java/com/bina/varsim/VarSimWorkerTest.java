@@ -0,0 +1,144 @@
+package com.bina.varsim;
+
+import org.junit.After;
+import org.junit.Before;
+import org.junit.Test;
+
+import java.io.*;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.nio.charset.StandardCharsets;
+import java.util.concurrent.CountDownLatch;
+import java.util.concurrent.TimeUnit;
+
+import static org.junit.Assert.assertEquals;
+import static org.junit.Assert.assertNull;
+import static org.junit.Assert.assertTrue;
+
+/**
+ * requests sent to the worker while it runs a tool are closed unanswered, so that clients run them on their own
+ */
+public class VarSimWorkerTest {
+    static final String TOKEN = "0123456789abcdef";
+
+    /**
+     * worker whose "slow" tool runs until released
+     */
+    static class TestWorker extends VarSimWorker {
+        final CountDownLatch started = new CountDownLatch(1);
+        final CountDownLatch release = new CountDownLatch(1);
+
+        TestWorker() {
+            super("worker", "test worker");
+        }
+
+        @Override
+        void runTool(final String[] args) throws IOException {
+            if (args[0].equals("slow")) {
+                started.countDown();
+                try {
+                    release.await();
+                } catch (InterruptedException e) {
+                    throw new InterruptedIOException();
+                }
+            }
+            System.out.print(args[0]);
+        }
+    }
+
+    private TestWorker worker;
+    private ServerSocket server;
+    private Thread acceptor;
+    private PrintStream systemOut;
+
+    @Before
+    public void setup() throws IOException {
+        worker = new TestWorker();
+        server = new ServerSocket(0, 50, InetAddress.getLoopbackAddress());
+        final VarSimWorker.ThreadPrintStream out = new VarSimWorker.ThreadPrintStream(System.out);
+        final VarSimWorker.ThreadPrintStream err = new VarSimWorker.ThreadPrintStream(System.err);
+        systemOut = System.out;
+        System.setOut(out);
+        final VarSimWorker.ExitTrap exitTrap = new VarSimWorker.ExitTrap();
+        acceptor = new Thread() {
+            @Override
+            public void run() {
+                try {
+                    while (true) {
+                        final Socket socket = server.accept();
+                        new Thread() {
+                            @Override
+                            public void run() {
+                                worker.serve(socket, TOKEN, exitTrap, out, err);
+                            }
+                        }.start();
+                    }
+                } catch (IOException e) {
+                    // server closed
+                }
+            }
+        };
+        acceptor.start();
+    }
+
+    @After
+    public void tearDown() throws Exception {
+        server.close();
+        acceptor.join();
+        System.setOut(systemOut);
+    }
+
+    Socket send(final String tool) throws IOException {
+        final Socket socket = new Socket(InetAddress.getLoopbackAddress(), server.getLocalPort());
+        final DataOutputStream request = new DataOutputStream(socket.getOutputStream());
+        final byte[] token = TOKEN.getBytes(StandardCharsets.UTF_8);
+        final byte[] arg = tool.getBytes(StandardCharsets.UTF_8);
+        request.writeInt(token.length);
+        request.write(token);
+        request.writeInt(1);
+        request.writeInt(arg.length);
+        request.write(arg);
+        request.flush();
+        return socket;
+    }
+
+    /**
+     * @return stdout of the reply, null if the connection was closed without a reply
+     */
+    String receive(final Socket socket) throws IOException {
+        final DataInputStream reply = new DataInputStream(socket.getInputStream());
+        final ByteArrayOutputStream stdout = new ByteArrayOutputStream();
+        try {
+            while (true) {
+                final int channel = reply.read();
+                if (channel < 0) {
+                    return null;
+                }
+                final byte[] data = new byte[reply.readInt()];
+                reply.readFully(data);
+                if (channel == VarSimWorker.CHANNEL_EXIT) {
+                    assertEquals(0, new DataInputStream(new ByteArrayInputStream(data)).readInt());
+                    return stdout.toString("UTF-8");
+                }
+                if (channel == VarSimWorker.CHANNEL_STDOUT) {
+                    stdout.write(data);
+                }
+            }
+        } finally {
+            socket.close();
+        }
+    }
+
+    @Test
+    public void parallelRequestsTest() throws Exception {
+        final Socket slow = send("slow");
+        assertTrue(worker.started.await(10, TimeUnit.SECONDS));
+        // the second request is turned away while the first runs
+        assertNull(receive(send("fast")));
+        worker.release.countDown();
+        assertEquals("slow", receive(slow));
+        // and taken once it is done
+        assertEquals("fast", receive(send("fast")));
+    }
+}
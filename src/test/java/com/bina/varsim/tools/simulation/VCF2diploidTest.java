@@ -121,6 +121,78 @@ public class VCF2diploidTest {
         assertTrue(Files.notExists(outputPaternalReferencePath));
         assertTrue(FileUtils.contentEquals(runner.getOutputMap(), new File(map)));
     }
+
+    /**
+     * build each contig in its own run, the outputs and the maps put together in the order
+     * of the contigs list should be the same as building all contigs in one run
+     * @param directory
+     * @throws IOException
+     */
+    public void contigTestMethod(String directory) throws IOException {
+        String reference = new File(directory, "reference.fa").toString();
+        String vcf = new File(directory, "input.vcf").toString();
+        File contigList = null;
+        StringBuilder mapString = new StringBuilder();
+
+        for (String contig : new String[]{"1", "2"}) {
+            File wd = tmpFolder.newFolder("tmp" + contig);
+            VCF2diploid runner = new VCF2diploid();
+            String[] args = new String[]{
+                    "-chr", reference, "-outdir", wd.getCanonicalPath(),
+                    "-seed", Integer.toString(this.seed), "-id", "test",
+                    "-t", "MALE", "-vcf", vcf, "-contig", contig
+            };
+            runner.run(args);
+            assertTrue(FileUtils.contentEquals(new File(wd, contig + "_test.vcf"), new File(directory, contig + ".vcf")));
+            assertTrue(FileUtils.contentEquals(new File(wd, contig + "_test_maternal.fa"), new File(directory, "maternal." + contig + ".fa")));
+            assertTrue(FileUtils.contentEquals(new File(wd, contig + "_test_paternal.fa"), new File(directory, "paternal." + contig + ".fa")));
+            assertTrue(Files.notExists(Paths.get(wd.getCanonicalPath(), "test.map")));
+            contigList = new File(wd, "test.contigs");
+        }
+        for (String contig : FileUtils.readLines(contigList)) {
+            mapString.append(FileUtils.readFileToString(new File(tmpFolder.getRoot(), "tmp" + contig + "/" + contig + "_test.map")));
+        }
+        mapString.append(System.lineSeparator());
+        assertTrue(mapString.toString().equals(FileUtils.readFileToString(new File(directory, "expected.map"))));
+    }
+
+    /**
+     * build each contig in its own run and all contigs in one run, the outputs should be the same.
+     * The unphased variants of the contigs skipped by a run still take their random haplotype draws
+     * @param directory
+     * @param contigs contigs in the reference
+     * @throws IOException
+     */
+    public void shardedContigTestMethod(String directory, String[] contigs) throws IOException {
+        String reference = new File(directory, "reference.fa").toString();
+        String vcf = new File(directory, "input.vcf").toString();
+        File all = tmpFolder.newFolder("all");
+        new VCF2diploid().run(new String[]{
+                "-chr", reference, "-outdir", all.getCanonicalPath(),
+                "-seed", Integer.toString(this.seed), "-id", "test",
+                "-t", "MALE", "-vcf", vcf
+        });
+        File contigList = null;
+        StringBuilder mapString = new StringBuilder();
+
+        for (String contig : contigs) {
+            File wd = tmpFolder.newFolder("sharded" + contig);
+            new VCF2diploid().run(new String[]{
+                    "-chr", reference, "-outdir", wd.getCanonicalPath(),
+                    "-seed", Integer.toString(this.seed), "-id", "test",
+                    "-t", "MALE", "-vcf", vcf, "-contig", contig
+            });
+            for (String output : new String[]{"_test.vcf", "_test_maternal.fa", "_test_paternal.fa"}) {
+                assertTrue(FileUtils.contentEquals(new File(wd, contig + output), new File(all, contig + output)));
+            }
+            contigList = new File(wd, "test.contigs");
+        }
+        for (String contig : FileUtils.readLines(contigList)) {
+            mapString.append(FileUtils.readFileToString(new File(tmpFolder.getRoot(), "sharded" + contig + "/" + contig + "_test.map")));
+        }
+        mapString.append(System.lineSeparator());
+        assertTrue(mapString.toString().equals(FileUtils.readFileToString(new File(all, "test.map"))));
+    }
     @Rule
     public TemporaryFolder tmpFolder = new TemporaryFolder();
 
@@ -250,4 +322,12 @@ public class VCF2diploidTest {
     public void dupDelTest() throws IOException {
         universalTestMethod2("src/test/resources/simulationTests/dupDelTest");
     }
+    @Test
+    public void contigTest() throws IOException {
+        contigTestMethod("src/test/resources/TranslocationTest/BalancedReciprocalTranslocationTest/balancedReciprocalTranslocationInterchromosomal");
+    }
+    @Test
+    public void unphasedContigTest() throws IOException {
+        shardedContigTestMethod("src/test/resources/contigTest/unphased", new String[]{"1", "2", "3"});
+    }
 }
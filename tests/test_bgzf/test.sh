@@ -0,0 +1,65 @@
+#!/bin/bash
+set -euo pipefail
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
+
+# BGZF and gzip files read back whole, truncated ones raise IOError instead of reading back shorter
+python - "$DIR/../.." <<'PYTHON'
+import gzip
+import sys
+sys.path.insert(0, sys.argv[1])
+import bgzf
+import utils
+
+text = "".join("1\t{}\t.\tA\tC\t.\tPASS\tDP={}\n".format(i, i % 97) for i in xrange(1, 200001))
+writer = bgzf.BgzfWriter("input.bgzf.gz")
+writer.write(text)
+writer.close()
+gzip_fd = gzip.open("input.gzip.gz", "w")
+gzip_fd.write(text)
+gzip_fd.close()
+
+test_fail = False
+for filename in ["input.bgzf.gz", "input.gzip.gz"]:
+    with utils.versatile_open(filename, "r") as fd:
+        if fd.read() != text:
+            print filename, "differs"
+            test_fail = True
+    data = open(filename, "rb").read()
+    # cut within a block or member, within the trailer and within the header
+    for cut in [len(data) // 2, len(data) - 1, len(data) - 40, 10]:
+        with open("truncated.gz", "wb") as truncated_fd:
+            truncated_fd.write(data[:cut])
+        try:
+            with utils.versatile_open("truncated.gz", "r") as fd:
+                fd.read()
+            print filename, "truncated to", cut, "bytes read without error"
+            test_fail = True
+        except IOError:
+            pass
+
+# a gzip member ending right before the end of a read chunk is followed by the next member
+member_texts = ["".join(chr(ord("a") + (i * j) % 26) for j in xrange(1000)) for i in xrange(1, 3)]
+members = []
+for member_text in member_texts:
+    gzip_fd = gzip.open("member.gz", "w")
+    gzip_fd.write(member_text)
+    gzip_fd.close()
+    members.append(open("member.gz", "rb").read())
+with open("members.gz", "wb") as members_fd:
+    members_fd.write("".join(members))
+read_chunk_size = bgzf.READ_CHUNK_SIZE
+for chunk_size in [len(members[0]) - 1, len(members[0]), len(members[0]) + 1, len(members[0]) + 2]:
+    bgzf.READ_CHUNK_SIZE = chunk_size
+    with open("members.gz", "rb") as members_fd:
+        if "".join(bgzf.inflate_stream(members_fd)) != "".join(member_texts):
+            print "members read in chunks of", chunk_size, "bytes differ"
+            test_fail = True
+bgzf.READ_CHUNK_SIZE = read_chunk_size
+
+# readers are iterators and free their threads on close
+with utils.versatile_open("input.bgzf.gz", "r") as fd:
+    if next(fd) != text[:text.index("\n") + 1]:
+        print "next() differs"
+        test_fail = True
+print "test fail" if test_fail else "test pass"
+PYTHON
@@ -0,0 +1,78 @@
+#!/bin/bash
+set -euo pipefail
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
+
+# combined VCFs hold the sorted records of all inputs, sorted or not, with duplicates kept, kept once or dropped
+python - "$DIR/../.." <<'PYTHON'
+import os
+import random
+import subprocess
+import sys
+sys.path.insert(0, sys.argv[1])
+import utils
+
+random.seed(4)
+header = "##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+def record(i):
+    return "\t".join([random.choice(["1", "2", "10", "X"]), str(random.randint(1, 300)), ".", random.choice("ACGT"), random.choice(["C", "T", "<DEL>"]), ".", "PASS", "N={}".format(i)]) + "\n"
+records = [record(i) for i in xrange(3000)]
+#duplicates within and across inputs, differing only in INFO
+records += [l.replace("\tN=", "\tN=9") for l in random.sample(records, 300)]
+random.shuffle(records)
+
+def gnu_sort(lines):
+    sort = subprocess.Popen(["sort", "-k1,1V", "-k2,2n", "-k4,4d", "-k5,5d"], stdin = subprocess.PIPE, stdout = subprocess.PIPE, env = dict(os.environ, LC_ALL = "C"))
+    return sort.communicate("".join(lines))[0].splitlines(True)
+
+def write_inputs(name, pieces):
+    inputs = []
+    for i, piece in enumerate(pieces):
+        with open("{}{}.vcf".format(name, i), "w") as vcf_fd:
+            vcf_fd.write(header + "".join(piece))
+        inputs.append(vcf_fd.name)
+    return inputs
+
+def expected_records(lines, mode):
+    counts = {}
+    for l in lines:
+        variant = tuple(l.split("\t")[i] for i in [0, 1, 3, 4])
+        counts[variant] = counts.get(variant, 0) + 1
+    kept = []
+    seen = set()
+    for l in gnu_sort(lines):
+        variant = tuple(l.split("\t")[i] for i in [0, 1, 3, 4])
+        if mode == utils.COMBINE_KEEP_NO_DUPLICATE and counts[variant] > 1 or mode == utils.COMBINE_KEEP_FIRST_DUPLICATE and variant in seen:
+            continue
+        seen.add(variant)
+        kept.append(l)
+    return kept
+
+#count the full sorts done when an input is not sorted
+full_sorts = []
+sort_vcf_records = utils.sort_vcf_records
+def count_full_sorts(*args, **kwargs):
+    full_sorts.append(args)
+    return sort_vcf_records(*args, **kwargs)
+utils.sort_vcf_records = count_full_sorts
+
+test_fail = False
+sorted_inputs = write_inputs("sorted", [gnu_sort(records[i::3]) for i in xrange(3)])
+unsorted_inputs = write_inputs("unsorted", [gnu_sort(records[0::3]), records[1::3], gnu_sort(records[2::3])])
+for inputs, expected_full_sorts in [(sorted_inputs, 0), (unsorted_inputs, 1)]:
+    for mode in [utils.COMBINE_KEEP_ALL_DUPLICATE, utils.COMBINE_KEEP_FIRST_DUPLICATE, utils.COMBINE_KEEP_NO_DUPLICATE]:
+        for gzip in [True, False]:
+            del full_sorts[:]
+            combined = utils.combine_vcf("combined.vcf", inputs, mode, gzip)
+            with utils.versatile_open(combined, "r") as combined_fd:
+                lines = combined_fd.readlines()
+            if lines != header.splitlines(True) + expected_records(records, mode):
+                print inputs[1], "combined with mode", mode, "gzip", gzip, "differs"
+                test_fail = True
+            if len(full_sorts) != expected_full_sorts:
+                print inputs[1], "combined with", len(full_sorts), "full sorts instead of", expected_full_sorts
+                test_fail = True
+            if gzip and not os.path.isfile(combined + ".tbi"):
+                print combined, "is not indexed"
+                test_fail = True
+print "test fail" if test_fail else "test pass"
+PYTHON
@@ -0,0 +1,39 @@
+#!/bin/bash
+set -euo pipefail
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
+
+# false calls are only paired with the companion variants vcfeval matched with them, not with those of a neighbouring call
+python - "$DIR/../.." <<'PYTHON'
+import sys
+sys.path.insert(0, sys.argv[1])
+import compare_vcf
+
+header = "##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n"
+def write_vcf(filename, variants):
+    with open(filename, "w") as vcf_fd:
+        vcf_fd.write(header)
+        for chrom, pos, ref, alt, info in variants:
+            vcf_fd.write("\t".join([chrom, str(pos), ".", ref, alt, ".", "PASS", info, "GT", "0/1"]) + "\n")
+    return filename
+
+# adjacent false calls: 1000 was matched with 1002, 1010 was not matched.
+# 1500 and 1506 were both matched, with 1503 and 1505
+companion = [("1", 1002, "A", "C", "AD=1,1"), ("1", 1011, "A", "T", "AD=2,2"), ("1", 1503, "G", "T", "AD=3,3"),
+             ("1", 1505, "C", "A", "AD=4,4"), ("2", 1010, "A", "G", "AD=5,5")]
+calls = [("1", 1000, "A", "G", "."), ("1", 1010, "A", "G", "."), ("1", 1500, "G", "T", "."), ("1", 1506, "C", "A", "."),
+         ("2", 1010, "A", "G", ".")]
+pairing = compare_vcf.FalseCallPairing(write_vcf("matched.vcf", [companion[0], companion[2], companion[3]]),
+                                       write_vcf("matched_calls.vcf", [calls[0], calls[2], calls[3]]),
+                                       write_vcf("companion.vcf", companion))
+expected = [1002, None, 1503, 1505, 1010]
+
+test_fail = False
+for call, expected_pos in zip(calls, expected):
+    variant = [call[0], str(call[1]), ".", call[2], call[3], ".", "PASS", call[4], "GT", "0/1"]
+    paired = pairing.get_closest_variant(variant) or pairing.get_matching_alt_ref(variant)
+    paired_pos = int(paired[1]) if paired else None
+    if paired_pos != expected_pos:
+        print "call", call[:2], "paired with", paired_pos, "instead of", expected_pos
+        test_fail = True
+print "test fail" if test_fail else "test pass"
+PYTHON
@@ -0,0 +1,58 @@
+#!/bin/bash
+set -euo pipefail
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
+
+# closest and matching variant lookups on indexed VCFs return what a scan of the VCF returns
+python - "$DIR/../.." <<'PYTHON'
+import random
+import sys
+sys.path.insert(0, sys.argv[1])
+import utils
+
+def scan_closest_variant(variant, lines):
+    closest_variant = None
+    min_dist = utils.CLOSEST_VARIANT_DISTANCE
+    for line_split in lines:
+        if line_split[0] == variant[0]:
+            dist = abs(int(line_split[1]) - int(variant[1]))
+            if dist < min_dist:
+                min_dist = dist
+                closest_variant = line_split[:]
+    return closest_variant
+
+def scan_matching_alt_ref(variant, lines):
+    for line_split in lines:
+        if variant[0] == line_split[0] and variant[1] == line_split[1] and variant[3] == line_split[3] and variant[4] == line_split[4]:
+            return line_split[:]
+    return None
+
+random.seed(6)
+def write_vcf(count):
+    #unsorted, with several variants and identical alleles at a position
+    lines = [["1" if random.random() < 0.7 else "2", str(random.randint(1, 3000)), "v{}".format(i), random.choice("AC"), random.choice("GT"), ".", "PASS", ".", "GT", "0/1"]
+             for i in xrange(count)]
+    with open("variants.vcf", "w") as vcf_fd:
+        vcf_fd.write("##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n")
+        vcf_fd.write("".join("\t".join(line) + "\n" for line in lines))
+    return lines
+
+test_fail = False
+def check(lines):
+    global test_fail
+    variant_index = utils.VariantIndex("variants.vcf")
+    for i in xrange(2000):
+        variant = [random.choice(["1", "2", "3"]), str(random.randint(1, 3200)), ".", random.choice("AC"), random.choice("GT"), ".", "PASS", ".", "GT", "0/1"]
+        expected_closest, expected_matching = scan_closest_variant(variant, lines), scan_matching_alt_ref(variant, lines)
+        for vcf in ["variants.vcf", variant_index]:
+            if utils.get_closest_variant(variant, vcf) != expected_closest:
+                print "closest variant to", variant[:5], "differs"
+                test_fail = True
+            if utils.get_matching_alt_ref(variant, vcf) != expected_matching:
+                print "matching variant of", variant[:5], "differs"
+                test_fail = True
+
+check(write_vcf(400))
+#indexes of changed files are not reused
+check(write_vcf(401))
+print "test fail" if test_fail else "test pass"
+PYTHON
@@ -3,6 +3,9 @@ set -euo pipefail
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
 
 time ../../flip_map.py flipped input.map 
+# binary maps converted back to text match the text maps
+time ../../flip_map.py --binary flipped_binary input.map
+python ../../mapindex.py flipped_binary.bmap flipped_binary.map
 
 TEST_FAIL=0
 compare() {
@@ -27,6 +30,7 @@ compare() {
 for i in expected/*.map;do
     compare $i $(basename $i)
 done
+compare expected/flipped.map flipped_binary.map
 if [[ $TEST_FAIL -ne 0 ]] ;then
     echo test fail
 else    
@@ -0,0 +1,78 @@
+#!/bin/bash
+set -euo pipefail
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
+
+# restricted VCFs written from raw lines are byte-identical to records restricted and written with PyVCF
+python - "$DIR/../.." "$DIR" <<'PYTHON'
+import gzip
+import os
+import shutil
+import sys
+sys.path.insert(0, sys.argv[1])
+import pysam
+import pybedtools
+import vcf
+import generate_small_test_ref
+
+test_dir = sys.argv[2]
+out_dir = os.path.join(test_dir, "out")
+shutil.rmtree(out_dir, True)
+os.makedirs(out_dir)
+in_vcf = os.path.join(out_dir, "input.vcf")
+shutil.copyfile(os.path.join(test_dir, "input.vcf"), in_vcf)
+in_vcf = pysam.tabix_index(in_vcf, preset="vcf", force=True)
+regions = os.path.join(test_dir, "regions.bed")
+reference = generate_small_test_ref.gen_restricted_reference(os.path.join(test_dir, "ref.fa"), regions, os.path.join(out_dir, "ref.fa"))
+
+def pyvcf_restricted_vcf(out_vcf, samples, flank):
+    '''
+    restrict the records as PyVCF records and write them with vcf.Writer
+    '''
+    reader = vcf.Reader(open(in_vcf, "r"))
+    reader.metadata["reference"] = reference
+    reference_handle = pysam.Fastafile(reference)
+    reader.contigs = vcf.parser.OrderedDict((name, vcf.parser._Contig(name, length)) for name, length in zip(reference_handle.references, reference_handle.lengths))
+    reference_handle.close()
+    if samples:
+        reader.samples = sorted(samples)
+    writer = vcf.Writer(open(out_vcf, "w"), reader)
+    reader = vcf.Reader(open(in_vcf, "r"))
+    for region in pybedtools.BedTool(regions):
+        try:
+            records = list(reader.fetch(str(region.chrom), region.start, region.end))
+        except ValueError:
+            continue
+        for record in records:
+            if record.POS <= region.start + flank or record.POS + len(record.REF) + flank - 1 >= region.end: continue
+            if 'SVTYPE' in record.INFO and record.INFO['SVTYPE'] in ['DEL','INV','DUP'] and record.POS + max(map(abs, record.INFO['SVLEN'])) >= region.end + flank: continue
+            record.CHROM = "%s_%d_%d" % (str(region.chrom), region.start, region.end)
+            record.POS = record.POS - region.start
+            if samples:
+                calls = [call for call in record.samples if call.sample in samples]
+                record = vcf.model._Record(record.CHROM, record.POS, record.ID, record.REF, record.ALT, record.QUAL, record.FILTER, record.INFO, record.FORMAT,
+                                           dict((call.sample, i) for i, call in enumerate(calls)), calls)
+            writer.write_record(record)
+    writer.close()
+    return out_vcf
+
+def read(filename):
+    with (gzip.open(filename) if filename.endswith(".gz") else open(filename)) as fd:
+        return fd.read()
+
+test_fail = False
+def compare(expected, restricted):
+    global test_fail
+    if read(expected) != read(restricted):
+        print expected, restricted, "differ"
+        test_fail = True
+    else:
+        print expected, restricted, "match"
+
+for name, samples, flank in [("all", [], 0), ("flank", [], 5), ("subset", ["S3", "S1"], 0)]:
+    restricted = generate_small_test_ref.gen_restricted_vcf(in_vcf, regions, os.path.join(out_dir, name + ".vcf"), reference, samples, flank)
+    compare(pyvcf_restricted_vcf(os.path.join(out_dir, name + ".expected.vcf"), samples, flank), restricted)
+restricted = generate_small_test_ref.gen_restricted_vcf(in_vcf, regions, os.path.join(out_dir, "per_sample.vcf"), reference, [], per_sample=True)
+for sample, sample_vcf in restricted.iteritems():
+    compare(pyvcf_restricted_vcf(os.path.join(out_dir, "per_sample.{}.expected.vcf".format(sample)), [sample], 0), sample_vcf)
+print "test fail" if test_fail else "test pass"
+PYTHON
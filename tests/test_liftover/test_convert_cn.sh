@@ -0,0 +1,46 @@
+#!/bin/bash
+set -euo pipefail
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
+
+# copy numbers converted per line, alone or fused into the liftover, match those of converting whole VCFs before and after lifting (expected_cn.vcf)
+python - "$DIR/../.." "$DIR" <<'PYTHON'
+import sys
+sys.path.insert(0, sys.argv[1])
+import utils
+from liftover_restricted_vcf_map import lift_vcfs
+
+test_dir = sys.argv[2]
+test_fail = False
+
+restore_cn = lambda line: utils.convert_cn(utils.convert_cn(line, "two2one"), "one2two")
+lifted = lift_vcfs([test_dir + "/restricted.vcf"], "lifted_cn.vcf", None, tabix_index = False, transform = restore_cn)
+if open(lifted).read() != open(test_dir + "/expected_cn.vcf").read():
+    print lifted, "differs from expected_cn.vcf"
+    test_fail = True
+
+record = "1\t10\t.\tA\tC\t.\tPASS\t.\t{}\t{}\t{}\n"
+for line, operation, expected in [
+        ('##FORMAT=<ID=CN,Number=1,Type=String,Description="Copy number">\n', "two2one", '##FORMAT=<ID=CN,Number=1,Type=Integer,Description="Copy number">\n'),
+        ('##FORMAT=<ID=CN,Number=1,Type=Integer,Description="Copy number">\n', "one2two", '##FORMAT=<ID=CN,Number=1,Type=String,Description="Copy number">\n'),
+        ("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\n", "two2one", "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\n"),
+        (record.format("GT:CN", "0|1:1|3", "1/1:2/2"), "two2one", record.format("GT:CN", "0|1:3", "1/1:2")),
+        (record.format("CN:GT", "0|2:1|0", "1:1|1"), "two2one", record.format("CN:GT", "2:1|0", "1:1|1")),
+        (record.format("GT:CN", "0|1:3", "1/1:2"), "one2two", record.format("GT:CN", "0|1:1|3", "1/1:2/2")),
+        (record.format("CN:GT", "2:1|0", "0:0/1"), "one2two", record.format("CN:GT", "2|1:1|0", "1/0:0/1")),
+        #copy numbers already given per allele are kept
+        (record.format("GT:CN", "0|1:1|3", "1/1:2/2"), "one2two", record.format("GT:CN", "0|1:1|3", "1/1:2/2")),
+        #records without CN are kept
+        (record.format("GT", "0|1", "1|1"), "two2one", record.format("GT", "0|1", "1|1")),
+        (record.format("GT:DP", "0|1:5", "1|1:3"), "one2two", record.format("GT:DP", "0|1:5", "1|1:3"))]:
+    converted = utils.convert_cn(line, operation)
+    if converted != expected:
+        print operation, repr(line), "converted to", repr(converted), "instead of", repr(expected)
+        test_fail = True
+try:
+    utils.convert_cn(record.format("GT:CN", "0|1:1", "1|1:2"), "one2one")
+    print "unknown operation accepted"
+    test_fail = True
+except ValueError:
+    pass
+print "test fail" if test_fail else "test pass"
+PYTHON
@@ -0,0 +1,78 @@
+#!/bin/bash
+set -euo pipefail
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
+
+# lookups on binary maps give the blocks a scan of the text map finds, at and around the edges of every block
+python - "$DIR/../.." "$DIR" <<'PYTHON'
+import random
+import sys
+sys.path.insert(0, sys.argv[1])
+import mapindex
+
+test_dir = sys.argv[2]
+random.seed(5)
+test_fail = False
+
+#largest end of each subtree of the implicit interval tree, as the largest end of the blocks it spans
+for n in xrange(1, 300):
+    ends = [random.randint(1, 1000) for _ in xrange(n)]
+    max_ends, root_level = mapindex.interval_tree_max_ends(ends)
+    if (1 << root_level) - 1 >= n or (1 << (root_level + 1)) - 1 < n:
+        print n, "blocks with a root of level", root_level
+        test_fail = True
+    for i in xrange(n):
+        level = 0
+        while i >> level & 1:
+            level += 1
+        if max_ends[i] != max(ends[max(0, i - (1 << level) + 1):i + (1 << level)]):
+            print n, "blocks: largest end", max_ends[i], "of block", i, "differs"
+            test_fail = True
+
+def scan(blocks, chr, loc, to_host):
+    '''
+    hits of a linear scan of the blocks
+    '''
+    hits = []
+    for block in blocks:
+        if to_host:
+            from_chr, from_loc, length, to_chr, to_loc, unmapped = block.ref_chr, block.ref_loc, mapindex.ref_length(block), block.host_chr, block.host_loc, 'DEL'
+        else:
+            from_chr, from_loc, length, to_chr, to_loc, unmapped = block.host_chr, block.host_loc, mapindex.host_length(block), block.ref_chr, block.ref_loc, 'INS'
+        if from_chr != chr or not from_loc <= loc < from_loc + length:
+            continue
+        if block.feature != unmapped:
+            to_loc += block.size - 1 - (loc - from_loc) if block.direction == '-' else loc - from_loc
+        hits.append(mapindex.MapHit(to_chr, to_loc, block.direction, block.feature, block.variant_id))
+    return hits
+
+def check(text_map):
+    global test_fail
+    blocks = list(mapindex.read_map(text_map))
+    with mapindex.MapIndex(mapindex.write_binary_map(blocks, "test.bmap")) as map_index:
+        if list(map_index) != blocks:
+            print text_map, "blocks differ"
+            test_fail = True
+        for to_host, lookup in [(False, map_index.host_to_ref), (True, map_index.ref_to_host)]:
+            locations = set()
+            for block in blocks:
+                chr, loc = (block.ref_chr, block.ref_loc) if to_host else (block.host_chr, block.host_loc)
+                end = loc + (mapindex.ref_length(block) if to_host else mapindex.host_length(block))
+                locations.update((chr, l) for l in [loc - 1, loc, loc + 1, end - 1, end, end + 1] if l > 0)
+            locations.add(("missing", 1))
+            for chr, loc in sorted(locations):
+                if lookup(chr, loc) != scan(blocks, chr, loc, to_host):
+                    print text_map, "to host" if to_host else "to reference", chr, loc, "differs"
+                    test_fail = True
+
+check(test_dir + "/restricted.map")
+check(test_dir + "/expected.map")
+#many, long and overlapping blocks search subtrees above the scanned levels
+with open("random.map", "w") as map_fd:
+    for i in xrange(500):
+        feature = random.choice(["SEQ", "SEQ", "INS", "DEL", "DUP_TANDEM", "INV"])
+        block = mapindex.MapBlock(random.choice([1, 2, 50, 1000, 20000]), random.choice(["h1", "h2"]), random.randint(1, 100000),
+                                  random.choice(["1", "2", "3"]), random.randint(1, 100000), "-" if feature == "INV" else "+", feature, str(i))
+        map_fd.write(mapindex.format_map_line(block))
+check("random.map")
+print "test fail" if test_fail else "test pass"
+PYTHON
@@ -0,0 +1,58 @@
+#!/bin/bash
+set -euo pipefail
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
+
+# sort_and_compress writes the sorted, indexed VCF where each mode puts it and keeps the input unless in mode 1
+python - "$DIR/../.." <<'PYTHON'
+import os
+import sys
+sys.path.insert(0, sys.argv[1])
+import pysam
+import utils
+
+header = "##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+records = ["\t".join([chrom, str(pos), ".", "A", "C", ".", "PASS", "."]) + "\n" for chrom, pos in [("2", 5), ("10", 3), ("1", 9), ("2", 1), ("1", 2)]]
+sorted_records = [records[i] for i in [4, 2, 3, 0, 1]]
+
+test_fail = False
+def check(mode, output_prefix, expected_vcf, input_kept):
+    global test_fail
+    with open("input.vcf", "w") as vcf_fd:
+        vcf_fd.write(header + "".join(records))
+    for filename in [expected_vcf, expected_vcf + ".tbi"]:
+        if os.path.isfile(filename):
+            os.remove(filename)
+    gz_vcf = utils.sort_and_compress("input.vcf", output_prefix, mode)
+    if gz_vcf != expected_vcf:
+        print "mode", mode, "wrote", gz_vcf, "instead of", expected_vcf
+        test_fail = True
+    with utils.versatile_open(gz_vcf, "r") as gz_fd:
+        if gz_fd.read() != header + "".join(sorted_records):
+            print "mode", mode, "output differs"
+            test_fail = True
+    tabix_file = pysam.TabixFile(gz_vcf)
+    if [l + "\n" for l in tabix_file.fetch("2")] != [records[3], records[0]]:
+        print "mode", mode, "index differs"
+        test_fail = True
+    tabix_file.close()
+    if os.path.isfile("input.vcf") != input_kept:
+        print "mode", mode, "input kept" if os.path.isfile("input.vcf") else "input removed"
+        test_fail = True
+
+check(1, None, "input.vcf.gz", False)
+check(2, None, "input.sorted.vcf.gz", True)
+check(3, "prefix", "prefix.sorted.vcf.gz", True)
+
+#modes 2 and 3 do not overwrite unless asked to, mode 3 needs a prefix
+for mode, output_prefix in [(2, None), (3, "prefix"), (3, None)]:
+    try:
+        utils.sort_and_compress("input.vcf", output_prefix, mode)
+        print "mode", mode, "with prefix", output_prefix, "did not raise"
+        test_fail = True
+    except ValueError:
+        pass
+if utils.sort_and_compress("input.vcf", None, 2, overwrite = True) != "input.sorted.vcf.gz" or not os.path.isfile("input.vcf"):
+    print "mode 2 did not overwrite"
+    test_fail = True
+print "test fail" if test_fail else "test pass"
+PYTHON
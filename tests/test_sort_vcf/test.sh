@@ -0,0 +1,85 @@
+#!/bin/bash
+set -euo pipefail
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
+
+# VCFs sorted in memory, sorted with spills to temporary runs and merged from sorted pieces are in the order of sort -k1,1V -k2,2n
+python - "$DIR/../.." <<'PYTHON'
+import os
+import random
+import subprocess
+import sys
+sys.path.insert(0, sys.argv[1])
+import utils
+
+random.seed(3)
+contigs = ["1", "2", "10", "X", "chr1", "chr2", "chr10", "chr1_gl000191_random", "chrUn_gl000220", "chrM", "GL000192.1",
+           "GL000192.2", "GL000192.10", "hs37d5", "NC_007605", "HLA-A*01:01:01:01", "HLA-A*01:01:01:02N", "HLA-B*07:02:01"]
+alleles = ["A", "C", "G", "T", "AC", "CA", "GTT", "<DEL>", "<DUP:TANDEM>", "<INS>", "N"]
+header = "##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+records = ["\t".join([random.choice(contigs), str(random.randint(1, 500)), "id{}".format(i), random.choice(alleles), random.choice(alleles), ".", "PASS", "."]) + "\n"
+           for i in xrange(6000)]
+with open("input.vcf", "w") as vcf_fd:
+    vcf_fd.write(header + "".join(records))
+
+def gnu_sort(lines, options):
+    sort = subprocess.Popen(["sort"] + options, stdin = subprocess.PIPE, stdout = subprocess.PIPE, env = dict(os.environ, LC_ALL = "C"))
+    return sort.communicate("".join(lines))[0].splitlines(True)
+expected = gnu_sort(records, ["-k1,1V", "-k2,2n", "-k4,4d", "-k5,5d"])
+
+def read_records(filename):
+    return [l for l in open(filename) if not l.startswith("#")]
+
+test_fail = False
+def check(name, lines, expected_lines):
+    global test_fail
+    if lines != expected_lines:
+        print name, "differs from sort"
+        test_fail = True
+
+check("contigs", [c + "\n" for c in sorted(contigs, key = utils.version_sort_key)], gnu_sort([c + "\n" for c in contigs], ["-V"]))
+
+#small buffers spill the records to many sorted runs
+spill_sorted_run = utils.spill_sorted_run
+runs = []
+def count_spills(lines, tmp_dir = None):
+    runs.append(spill_sorted_run(lines, tmp_dir))
+    return runs[-1]
+utils.spill_sorted_run = count_spills
+check("in memory", list(utils.sort_vcf_records(iter(records))), expected)
+if runs:
+    print "records were spilled with the default buffer"
+    test_fail = True
+utils.SORT_BUFFER_BYTES = 4000
+check("spilled", read_records(utils.sort_vcf(["input.vcf"], "spilled.vcf", gzip = False)), expected)
+if len(runs) < 50:
+    print "only", len(runs), "runs were spilled"
+    test_fail = True
+utils.spill_sorted_run = spill_sorted_run
+
+#contigs of the .fai come first in its order, the missing ones after them in version order
+fai_contigs = ["chr2", "X", "chrM", "GL000192.10", "1", "chr10"]
+with open("ref.fa.fai", "w") as fai_fd:
+    fai_fd.write("".join("{}\t1000\t0\t60\t61\n".format(c) for c in fai_contigs))
+fai_expected = sorted(expected, key = lambda l: fai_contigs.index(l.split("\t")[0]) if l.split("\t")[0] in fai_contigs else len(fai_contigs))
+check("spilled in .fai order", read_records(utils.sort_vcf(["input.vcf"], "fai.vcf", reference = "ref.fa", gzip = False)), fai_expected)
+contig_order = utils.get_contig_order("ref.fa")
+check("in memory in .fai order", list(utils.sort_vcf_records(iter(records), contig_order, buffer_bytes = 1 << 20)), fai_expected)
+
+#sorted pieces are merged, unsorted ones raise UnsortedVcfError
+for order, order_expected in [(None, expected), (contig_order, fai_expected)]:
+    pieces = []
+    for i in xrange(3):
+        with open("piece{}.vcf".format(i), "w") as piece_fd:
+            piece_fd.write(header + "".join(order_expected[i::3]))
+        pieces.append(piece_fd.name)
+    check("merged", list(utils.merge_sorted_vcfs(pieces, order)), order_expected)
+try:
+    list(utils.merge_sorted_vcfs(["piece0.vcf", "input.vcf"]))
+    print "unsorted input merged without error"
+    test_fail = True
+except utils.UnsortedVcfError as e:
+    if e.vcf != "input.vcf":
+        print "unsorted", e.vcf, "instead of input.vcf"
+        test_fail = True
+print "test fail" if test_fail else "test pass"
+PYTHON
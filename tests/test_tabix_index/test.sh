@@ -0,0 +1,70 @@
+#!/bin/bash
+set -euo pipefail
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
+
+# indexes written by IndexedVcfWriter and concatenate_indexed_vcfs are the indexes tabix writes for the same files
+python - "$DIR/../.." <<'PYTHON'
+import gzip
+import random
+import sys
+sys.path.insert(0, sys.argv[1])
+import pysam
+import bgzf
+
+random.seed(12)
+header = "##fileformat=VCFv4.1\n##contig=<ID=1>\n##contig=<ID=2>\n##contig=<ID=3>\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+def records(chrom, count, step):
+    '''
+    sorted records, with long REF alleles, END= in the INFO and several records at one position
+    '''
+    pos = 1
+    for i in xrange(count):
+        pos += random.randint(0, step)
+        ref = "A" * random.choice([1, 1, 1, 5, 300])
+        info = random.choice(["DP=3", "END={}".format(pos + random.randint(1, 70000)), "SVTYPE=DEL;END={};DP=1".format(pos + 40)])
+        yield "\t".join([chrom, str(pos), ".", ref, "C", ".", "PASS", info]) + "\n"
+contigs = [("1", list(records("1", 20000, 60))), ("2", list(records("2", 300, 9000))), ("3", list(records("3", 5, 3)))]
+
+def write_vcf(filename, contig_records, separate_header = False):
+    with bgzf.IndexedVcfWriter(filename, separate_header = separate_header) as writer:
+        writer.write(header)
+        for _, lines in contig_records:
+            for line in lines:
+                writer.write(line)
+    return filename
+
+def read_index(filename):
+    with gzip.open(filename, "rb") as index_fd:
+        return index_fd.read()
+
+test_fail = False
+def check(filename, contig_records):
+    '''
+    compare the index of filename with the one tabix writes and query it
+    '''
+    global test_fail
+    pysam.tabix_index(filename, preset = "vcf", force = True, index = filename + ".expected.tbi")
+    if read_index(filename + ".tbi") != read_index(filename + ".expected.tbi"):
+        print filename, "index differs from the tabix index"
+        test_fail = True
+    tabix_file = pysam.TabixFile(filename)
+    for chrom, lines in contig_records:
+        intervals = [bgzf.vcf_interval(line) for line in lines]
+        last_end = max(end for _, _, end in intervals)
+        for start, end in [(0, 1), (0, last_end + 1), (1000, 1001), (16383, 16385), (70000, 140000), (last_end // 2, last_end // 2 + 5000)]:
+            expected = [line for line, (_, beg, line_end) in zip(lines, intervals) if beg < end and max(line_end, beg + 1) > start]
+            fetched = [line + "\n" for line in tabix_file.fetch(chrom, start, end)]
+            if fetched != expected:
+                print filename, chrom, start, end, "fetched", len(fetched), "records instead of", len(expected)
+                test_fail = True
+    tabix_file.close()
+
+check(write_vcf("whole.vcf.gz", contigs), contigs)
+pieces = [write_vcf("piece{}.vcf.gz".format(i), [contig], True) for i, contig in enumerate(contigs)]
+check(bgzf.concatenate_indexed_vcfs(pieces, "concatenated.vcf.gz"), contigs)
+with gzip.open("concatenated.vcf.gz", "rb") as concatenated_fd:
+    if concatenated_fd.read() != header + "".join("".join(lines) for _, lines in contigs):
+        print "concatenated.vcf.gz differs"
+        test_fail = True
+print "test fail" if test_fail else "test pass"
+PYTHON
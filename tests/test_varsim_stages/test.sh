@@ -0,0 +1,74 @@
+#!/bin/bash
+set -euo pipefail
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
+
+# stages run after the stages they depend on and within the budgets, a failing stage kills the running ones and stops the rest
+python - "$DIR/../.." <<'PYTHON'
+import logging
+import os
+import sys
+import time
+sys.path.insert(0, sys.argv[1])
+import varsim
+
+logging.basicConfig()
+
+test_fail = False
+def check(condition, message):
+    global test_fail
+    if not condition:
+        print message
+        test_fail = True
+
+def overlap(first, second):
+    return first.started < second.finished and second.started < first.finished
+
+# a -> b and a -> c -> d: b and c run together within 2 cores, d waits for the memory b uses
+scheduler = varsim.StageScheduler(cores=2, memory="3k")
+memories = []
+a = scheduler.add("a", [("sleep 0.2", None, "a.err")])
+b = scheduler.add("b", [("sleep 0.5", "b.out", "b.err"), ("sleep 0.3", None, "b2.err")], depends=[a], memory=2048)
+c = scheduler.add("c", function=lambda: time.sleep(0.2), depends=[a])
+d = scheduler.add("d", lambda memory: memories.append(memory) or [("echo %d" % memory, "d.out", "d.err")], depends=[c],
+                  memory=lambda: memories.append(c.finished) or 2048)
+scheduler.run()
+check(all(stage.finished for stage in [a, b, c, d]), "stages did not finish")
+check(b.started >= a.finished and c.started >= a.finished and d.started >= c.finished, "stages started before their dependencies")
+check(overlap(b, c), "b and c did not run together")
+check(d.started >= b.finished, "d started within the memory b used")
+check(memories[0] is not None and memories[-1] == 2048, "memory of d computed before c finished or not given to its commands")
+check(open("d.out").read() == "2048\n", "d wrote {}".format(open("d.out").read()))
+
+# one core: no two stages run together
+scheduler = varsim.StageScheduler()
+stages = [scheduler.add(name, [("sleep 0.2", None, name + ".err")]) for name in ["e", "f", "g"]]
+scheduler.run()
+check(not any(overlap(first, second) for first in stages for second in stages if first is not second), "stages ran together on one core")
+
+# a failing command or function kills the running stages, the stages depending on it never start
+for failing in [dict(commands=[("sleep 0.3; exit 3", None, "fail.err")]), dict(function=lambda: 1 / 0)]:
+    scheduler = varsim.StageScheduler(cores=4)
+    for done in ["long.done", "after.done"]:
+        if os.path.exists(done):
+            os.remove(done)
+    long_stage = scheduler.add("long", [("sleep 1; touch long.done", None, "long.err")])
+    fail = scheduler.add("fail", **failing)
+    after = scheduler.add("after", [("touch after.done", None, "after.err")], depends=[fail])
+    started = time.time()
+    try:
+        scheduler.run()
+        check(False, "failing stage did not raise")
+    except Exception:
+        pass
+    check(time.time() - started < 0.9, "failure was not reported before the running stages finished")
+    time.sleep(1.5)
+    check(not os.path.exists("long.done") and not os.path.exists("after.done"), "stages ran on after the failure")
+    check(long_stage.finished is None and after.started is None, "stages finished or started after the failure")
+
+try:
+    varsim.StageScheduler().add("orphan", function=lambda: None, depends=[a])
+    check(False, "stage depending on a stage of another scheduler added")
+except ValueError:
+    pass
+print "test fail" if test_fail else "test pass"
+PYTHON
@@ -0,0 +1,134 @@
+#!/bin/bash
+set -euo pipefail
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P)"
+
+# fastq_liftover commands of all lanes run together and get the simulated reads of their lane, from compressed
+# files or streamed from the simulator FIFOs. A stand-in for the java command pairs the reads with their alignments
+# as fastq_liftover does
+python - "$DIR/../.." <<'PYTHON'
+import gzip
+import logging
+import os
+import shutil
+import stat
+import sys
+sys.path.insert(0, sys.argv[1])
+import varsim
+
+logging.basicConfig()
+NLANES = 2
+
+with open("java", "w") as java_fd:
+    java_fd.write('''#!/usr/bin/env python
+import sys
+import time
+args = sys.argv[1:]
+inputs = dict((option, [args[i + 1] for i in range(len(args) - 1) if args[i] == option]) for option in ["-fastq", "-aln", "-maf", "-out"])
+reads = [open(name) for name in inputs["-fastq"]]
+alignments = [open(name) for name in inputs["-aln"] or inputs["-maf"]]
+outs = [open(name, "w") for name in inputs["-out"]]
+time.sleep(0.5)
+#read the inputs of both ends in turns, as fastq_liftover reads pairs
+while True:
+    lines = [fd.readline() for fd in reads + alignments]
+    if not any(lines):
+        break
+    for end, out in enumerate(outs):
+        out.write(lines[end].rstrip("\\n") + ("\\t" + lines[len(reads) + end].rstrip("\\n") if alignments else "") + "\\n")
+for fd in reads + alignments + outs:
+    fd.close()
+''')
+os.chmod("java", os.stat("java").st_mode | stat.S_IEXEC)
+java = os.path.abspath("java")
+
+with open("simulator", "w") as simulator_fd:
+    simulator_fd.write('''#!/usr/bin/env python
+import sys
+#write the lines of the simulated files of a lane to their FIFOs in turns, as a simulator writes both ends
+sources = [open(name) for name in sys.argv[1::2]]
+fifos = [open(name, "w") for name in sys.argv[2::2]]
+while True:
+    lines = [fd.readline() for fd in sources]
+    if not any(lines):
+        break
+    for line, fifo in zip(lines, fifos):
+        fifo.write(line)
+for fd in sources + fifos:
+    fd.close()
+''')
+os.chmod("simulator", os.stat("simulator").st_mode | stat.S_IEXEC)
+simulator_exe = os.path.abspath("simulator")
+
+def simulated_files(simulator):
+    names = ["simulated.lane%d.read%d.%s" % (lane, end, suffix) for lane in xrange(NLANES) for end in [1, 2]
+             for suffix in (["fq", "aln"] if simulator == "art" else ["fq"])]
+    #larger than pipe buffers, so that readers and writers of FIFOs have to take turns
+    return dict((name, "".join("%s %d\n" % (name, i) for i in xrange(30000))) for name in names)
+
+def expected_reads(simulator, lane, end):
+    files = simulated_files(simulator)
+    reads = files["simulated.lane%d.read%d.fq" % (lane, end)].splitlines()
+    if simulator != "art":
+        return "".join(read + "\n" for read in reads)
+    return "".join(read + "\t" + aln + "\n" for read, aln in zip(reads, files["simulated.lane%d.read%d.aln" % (lane, end)].splitlines()))
+
+test_fail = False
+def read_lane(out_dir, lane, end):
+    with gzip.open(os.path.join(out_dir, "lane%d.read%d.fq.gz" % (lane, end))) as lifted_fd:
+        return lifted_fd.read()
+
+def check_lanes(out_dir, simulator, stages):
+    global test_fail
+    for lane in xrange(NLANES):
+        for end in [1, 2]:
+            if read_lane(out_dir, lane, end) != expected_reads(simulator, lane, end):
+                print out_dir, "lane", lane, "read", end, "differs"
+                test_fail = True
+    if len(stages) > 1 and not all(first.started < second.finished and second.started < first.finished for first in stages for second in stages if first is not second):
+        print out_dir, "lanes were lifted one after the other"
+        test_fail = True
+
+for simulator in ["art", "dwgsim"]:
+    #the simulated reads are compressed first, then each lane is lifted over in its own stage
+    out_dir = os.path.abspath("files_" + simulator)
+    shutil.rmtree(out_dir, True)
+    os.makedirs(out_dir)
+    for name, content in simulated_files(simulator).iteritems():
+        with gzip.open(os.path.join(out_dir, name + ".gz"), "w") as simulated_fd:
+            simulated_fd.write(content)
+    scheduler = varsim.StageScheduler(cores=NLANES)
+    stages = [scheduler.add("fastq_liftover lane%d" % (lane), [(varsim.get_fastq_liftover_command(java, "truth.map", lane, out_dir, simulator), None, os.path.join(out_dir, "liftover%d.log" % (lane)))])
+              for lane in xrange(NLANES)]
+    scheduler.run()
+    check_lanes(out_dir, simulator, stages)
+
+    #the simulator writes to FIFOs read by the liftover of its lane, all in one stage as with --stream_liftover
+    stream_dir = os.path.abspath("stream_" + simulator)
+    shutil.rmtree(stream_dir, True)
+    os.makedirs(stream_dir)
+    fifos = {}
+    for name, content in simulated_files(simulator).iteritems():
+        #dwgsim writes .fastq files
+        fifos[name] = os.path.join(stream_dir, name[:-len(".fq")] + ".fastq" if simulator == "dwgsim" else name)
+        os.mkfifo(fifos[name])
+        with open(os.path.join(stream_dir, name + ".source"), "w") as source_fd:
+            source_fd.write(content)
+    commands = []
+    for lane in xrange(NLANES):
+        lane_fifos = [(os.path.join(stream_dir, name + ".source"), fifo) for name, fifo in sorted(fifos.iteritems()) if name.startswith("simulated.lane%d." % (lane))]
+        commands.append((varsim.get_fastq_liftover_command(java, "truth.map", lane, stream_dir, simulator, fifos=fifos), None, os.path.join(stream_dir, "liftover%d.log" % (lane))))
+        commands.append((" ".join([simulator_exe] + [path for pair in lane_fifos for path in pair]), None, os.path.join(stream_dir, "simulator%d.log" % (lane))))
+    scheduler = varsim.StageScheduler(cores=NLANES)
+    scheduler.add("read simulation", commands, cores=NLANES)
+    scheduler.run()
+    check_lanes(stream_dir, simulator, [])
+    for lane in xrange(NLANES):
+        for end in [1, 2]:
+            if read_lane(stream_dir, lane, end) != read_lane(out_dir, lane, end):
+                print stream_dir, "lane", lane, "read", end, "differs from", out_dir
+                test_fail = True
+    if any(os.path.exists(os.path.join(stream_dir, name + ".gz")) for name in fifos):
+        print stream_dir, "has compressed simulated reads"
+        test_fail = True
+print "test fail" if test_fail else "test pass"
+PYTHON
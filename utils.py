@@ -4,7 +4,23 @@ import os
 import sys
 import re
 import warnings
-import pysam
+import heapq
+import bisect
+import itertools
+import gzip
+import tempfile
+import signal
+import struct
+import shlex
+import StringIO
+import json
+import argparse
+import hashlib
+import fcntl
+import errno
+import shutil
+import bgzf
+from distutils.spawn import find_executable
 from distutils.version import LooseVersion
 # Check java version to make sure it is Java 8
 MY_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -19,6 +35,30 @@ DEFAULT_PYTHON = os.path.realpath(os.path.join(MY_DIR, "opt", "miniconda2", "bin
 COMBINE_KEEP_ALL_DUPLICATE = 1
 COMBINE_KEEP_FIRST_DUPLICATE = 2
 COMBINE_KEEP_NO_DUPLICATE = 3
+VERSION_RUNS = re.compile(r'(\D*)(\d*)')
+#file suffixes as recognized by GNU filevercmp
+VERSION_SUFFIX = re.compile(r'(\.[A-Za-z~][A-Za-z0-9~]*)*$')
+#characters ignored by sort -d
+NON_DICTIONARY = re.compile(r'[^A-Za-z0-9 \t]')
+#bytes of records sorted in memory before spilling to disk, the sort keys take about as much again
+SORT_BUFFER_BYTES = 1 << 27
+#separators of the copy numbers of the alleles
+CN_DELIMITER = re.compile('[/|]')
+#threads decompressing a BGZF file being read, fewer on machines with fewer cores
+MAX_DECOMPRESS_THREADS = 4
+#variants within this distance can be closest to a variant
+CLOSEST_VARIANT_DISTANCE = 100
+#VariantIndexes of the files read last, kept for further lookups
+VARIANT_INDEX_CACHE_SIZE = 4
+#address file of a running "VarSim.jar worker", jobs fall back to new JVMs without it
+VARSIM_WORKER = "VARSIM_WORKER"
+#commands using these are left to the shell
+SHELL_SPECIAL = re.compile(r'[|&;<>()$`*?\[\]{}~#\n]')
+WORKER_EXIT = 0
+WORKER_STDOUT = 1
+WORKER_STDERR = 2
+#results of java and VarSim.jar probes, so that they do not start a JVM every time
+PROBE_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "varsim", "probes.json")
 
 def get_java(java = "java"):
     '''
@@ -49,10 +89,52 @@ def count_variants(vcf):
                 count += 1
     return count
 
+def get_probe_key(name, files):
+    '''
+    :param name: name of the probe
+    :param files: programs or files whose result depends on, e.g. java and VarSim.jar
+    :return: cache key of the probe made of the paths and modification times of the files, None if one is missing
+    '''
+    key = [name]
+    for f in files:
+        path = find_executable(f)
+        if path is None:
+            return None
+        path = os.path.realpath(path)
+        key += [path, str(os.path.getmtime(path))]
+    return "\t".join(key)
+
+def cached_probe(key, probe):
+    '''
+    :param key: cache key from get_probe_key, None to not use the cache
+    :param probe: function computing the result (str) if it is not cached
+    :return: result of probe
+    '''
+    if key is None:
+        return probe()
+    try:
+        with open(PROBE_CACHE) as cache_fd:
+            cache = json.load(cache_fd)
+    except (IOError, ValueError):
+        cache = {}
+    if key in cache:
+        return cache[key]
+    cache[key] = probe()
+    try:
+        makedirs([os.path.dirname(PROBE_CACHE)])
+        #concurrent writers replace the cache atomically, the last one wins
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(PROBE_CACHE), delete=False) as tmp_fd:
+            json.dump(cache, tmp_fd)
+        os.rename(tmp_fd.name, PROBE_CACHE)
+    except (IOError, OSError):
+        pass
+    return cache[key]
+
 def check_java(java="java"):
     logger = logging.getLogger(check_java.__name__)
     try:
-        jv = subprocess.check_output("{} -Xmx100m -version".format(java), stderr=subprocess.STDOUT, shell=True)
+        jv = cached_probe(get_probe_key("java -version", [java]),
+                          lambda: subprocess.check_output("{} -Xmx100m -version".format(java), stderr=subprocess.STDOUT, shell=True))
         if "openjdk" in jv or "OpenJDK" in jv:
             raise EnvironmentError("Please replace OpenJDK with Oracle JDK")
         jv = filter(lambda x: x.startswith("java version"), jv.split("\n"))[0].split()[2].replace("\"", "")
@@ -64,11 +146,119 @@ def check_java(java="java"):
 
 def get_version(java="java"):
     java = get_java(java)
-    return subprocess.check_output("{} -jar {} -version".format(java, VARSIMJAR), shell=True).strip()
+
+    def probe():
+        version = StringIO.StringIO()
+        if run_varsim_worker(["-version"], version, sys.stderr) == 0:
+            return version.getvalue().strip()
+        return subprocess.check_output("{} -jar {} -version".format(java, VARSIMJAR), shell=True).strip()
+
+    return cached_probe(get_probe_key("VarSim.jar -version", [java, VARSIMJAR]), probe)
+
+class VersionAction(argparse.Action):
+    '''
+    --version printing get_version(), which is only called when the option is given
+    '''
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help="show program's version number and exit"):
+        super(VersionAction, self).__init__(option_strings=option_strings, dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        parser.exit(message=get_version() + "\n")
+
+def get_varsim_worker_args(cmd):
+    '''
+    :param cmd: shell command (str)
+    :return: VarSim.jar arguments if cmd is a plain "java [options] -jar VarSim.jar ..." command, otherwise None
+    '''
+    if SHELL_SPECIAL.search(cmd):
+        return None
+    try:
+        tokens = shlex.split(cmd)
+    except ValueError:
+        return None
+    if "-jar" not in tokens:
+        return None
+    jar = tokens.index("-jar")
+    if jar + 1 >= len(tokens) or os.path.realpath(tokens[jar + 1]) != VARSIMJAR:
+        return None
+    if not all(token.startswith("-") for token in tokens[1:jar]):
+        return None
+    return tokens[jar + 2:]
+
+def get_varsim_worker(cmd_dir=None):
+    '''
+    :param cmd_dir: working directory of the job, None if it does not matter
+    :return: (port, token) of the worker named by $VARSIM_WORKER if it can run the job, otherwise None.
+             Relative paths are resolved in the directory of the worker, so it only takes jobs run there
+    '''
+    address_file = os.environ.get(VARSIM_WORKER)
+    if not address_file:
+        return None
+    try:
+        with open(address_file) as address_fd:
+            port, token, worker_dir = address_fd.read().split("\n")[:3]
+        port = int(port)
+    except (IOError, ValueError):
+        return None
+    if cmd_dir is not None and os.path.realpath(cmd_dir) != os.path.realpath(worker_dir):
+        return None
+    return port, token
+
+def run_varsim_worker(args, cmd_stdout, cmd_stderr, cmd_dir=None):
+    '''
+    run VarSim.jar in the worker named by $VARSIM_WORKER (see VarSimWorker.java for the protocol)
+    :param args: VarSim.jar arguments
+    :param cmd_stdout: file object for the output of the job, None for sys.stdout
+    :param cmd_stderr: file object for the log of the job, None for sys.stderr
+    :param cmd_dir: working directory of the job, None if it does not matter
+    :return: exit status of the job, None if no worker took it, e.g. because it runs another job
+    '''
+    logger = logging.getLogger(run_varsim_worker.__name__)
+    worker = get_varsim_worker(cmd_dir)
+    if worker is None:
+        return None
+    port, token = worker
+    import socket
+    outputs = {WORKER_STDOUT: cmd_stdout or sys.stdout, WORKER_STDERR: cmd_stderr or sys.stderr}
+    if not all(hasattr(output, "write") for output in outputs.values()):
+        return None
+    try:
+        connection = socket.create_connection(("127.0.0.1", port))
+    except socket.error:
+        logger.warning("VarSim worker on port {} is not running".format(port))
+        return None
+
+    def pack(string):
+        if isinstance(string, unicode):
+            string = string.encode("utf-8")
+        return struct.pack(">i", len(string)) + string
+
+    received = False
+    try:
+        connection.sendall(pack(token) + struct.pack(">i", len(args)) + "".join(map(pack, args)))
+        reply = connection.makefile("rb")
+        while True:
+            frame = reply.read(5)
+            if len(frame) < 5:
+                #a worker busy with another job, or gone before answering, is as good as none
+                if received:
+                    raise Exception("VarSim worker stopped while running {}".format(" ".join(args)))
+                return None
+            received = True
+            channel, length = struct.unpack(">bi", frame)
+            data = reply.read(length)
+            if channel == WORKER_EXIT:
+                return struct.unpack(">i", data)[0]
+            outputs[channel].write(data)
+    finally:
+        connection.close()
+        for output in outputs.values():
+            output.flush()
 
 def run_shell_command(cmd, cmd_stdout, cmd_stderr, cmd_dir="."):
     '''
-    run command (list of str or str), redirect stdout, stderr to user-specified file handles
+    run command (list of str or str), redirect stdout, stderr to user-specified file handles.
+    VarSim.jar commands are run in the VarSim worker if one is running
     :param cmd:
     :param cmd_stdout:
     :param cmd_stderr:
@@ -79,6 +269,14 @@ def run_shell_command(cmd, cmd_stdout, cmd_stderr, cmd_dir="."):
     if type(cmd) == list:
         cmd = ' '.join(cmd)
     logger.info('running ' + cmd + '\n')
+    worker_args = get_varsim_worker_args(cmd)
+    if worker_args is not None:
+        retcode = run_varsim_worker(worker_args, cmd_stdout, cmd_stderr, cmd_dir)
+        if retcode is not None:
+            logger.info('ran in VarSim worker\n')
+            if retcode != 0:
+                raise Exception('{0} failed'.format(cmd))
+            return(retcode)
     subproc = subprocess.Popen(cmd, stdout=cmd_stdout, stderr=cmd_stderr, cwd=cmd_dir, shell=True, preexec_fn=os.setsid, close_fds=True)
     logger.info('PID ' + str(subproc.pid) + '\n')
     try:
@@ -92,6 +290,108 @@ def run_shell_command(cmd, cmd_stdout, cmd_stderr, cmd_dir="."):
         raise Exception('{0} failed'.format(cmd))
     return(retcode)
 
+def parse_memory(string):
+    '''
+    :param string: memory size as given to java -Xmx, e.g. 10g, 512m
+    :return: number of bytes
+    '''
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    string = string.strip().lower()
+    if string and string[-1] in units:
+        return int(float(string[:-1]) * units[string[-1]])
+    return int(string)
+
+def get_java_memory():
+    '''
+    :return: bytes of memory taken by each Java step, i.e. the heap size given in JAVA_XMX
+    '''
+    return parse_memory(JAVA_XMX[len("-Xmx"):] or "0")
+
+def get_checksum(filename):
+    '''
+    :return: SHA-1 of the content of filename, remembered in the probe cache until the file changes
+    '''
+    def probe():
+        checksum = hashlib.sha1()
+        with open(filename, "rb") as file_fd:
+            for block in iter(lambda: file_fd.read(1 << 20), ""):
+                checksum.update(block)
+        return checksum.hexdigest()
+
+    return cached_probe(get_probe_key("sha1", [filename]), probe)
+
+def get_cache_key(name, files, params):
+    '''
+    :param files: input files, None for inputs not given
+    :param params: JSON-serializable parameters the result depends on
+    :return: key of the result, made of the checksums of the files and the parameters
+    '''
+    checksums = [get_checksum(f) if f else None for f in files]
+    return hashlib.sha1(json.dumps([name, checksums, params], sort_keys=True)).hexdigest()
+
+def cached_build(cache_dir, name, files, params, build, out_dir):
+    '''
+    build derived files once for all runs with the same inputs.
+    The first run builds them in a cache entry under a lock while concurrent runs wait, and the entry
+    is only used by later runs once it is complete
+    :param cache_dir: cache directory, None to build in out_dir without cache
+    :param name: name of the build
+    :param files: input files (see get_cache_key)
+    :param params: parameters (see get_cache_key)
+    :param build: function taking the directory to build in and returning the JSON-serializable result
+    :param out_dir: directory to build in without cache
+    :return: result of build
+    '''
+    logger = logging.getLogger(cached_build.__name__)
+    if not cache_dir:
+        makedirs([out_dir])
+        return build(out_dir)
+    entry = os.path.join(cache_dir, "{}-{}".format(name, get_cache_key(name, files, params)))
+    done = os.path.join(entry, ".done")
+    if not os.path.isfile(done):
+        makedirs([cache_dir])
+        with open(entry + ".lock", "a") as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                if not os.path.isfile(done):
+                    logger.info("Building {} in {}".format(name, entry))
+                    #partial entry of a run that died while building it
+                    shutil.rmtree(entry, ignore_errors=True)
+                    makedirs([entry])
+                    result = build(entry)
+                    with open(done + ".tmp", "w") as done_fd:
+                        json.dump(result, done_fd)
+                    os.rename(done + ".tmp", done)
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    logger.info("Using {} from {}".format(name, entry))
+    with open(done) as done_fd:
+        return json.load(done_fd)
+
+def publish(path, build):
+    '''
+    create path once, even with concurrent runs. It is built next to path under a lock and renamed into place,
+    so path either does not exist or is complete
+    :param build: function creating the file or directory given to it
+    :return: path
+    '''
+    if os.path.exists(path):
+        return path
+    with open(path + ".lock", "a") as lock_fd:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(path):
+                tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp")
+                try:
+                    tmp_path = os.path.join(tmp_dir, os.path.basename(path))
+                    build(tmp_path)
+                    os.rename(tmp_path, path)
+                finally:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    return path
+
 def makedirs(dirs):
     if type(dirs) == list:
         for d in dirs:
@@ -101,15 +401,88 @@ def makedirs(dirs):
         if not os.path.exists(dirs):
             os.makedirs(dirs)
 
-def versatile_open(filename, mode):
+def get_sendfile():
+    '''
+    :return: sendfile(out_fd, in_fd, offset, count) copying in the kernel, None where not available
+    '''
+    if hasattr(os, "sendfile"):
+        return os.sendfile
+    if not sys.platform.startswith("linux"):
+        return None
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc_sendfile = getattr(libc, "sendfile64", None) or libc.sendfile
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        c_offset = ctypes.c_int64(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+        if sent < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return sent
+    return sendfile
+
+#get_sendfile(), looked up on the first copy_file_data
+SENDFILE = []
+#largest number of bytes sendfile copies at once on Linux
+SENDFILE_MAX_BYTES = 0x7ffff000
+
+def copy_file_data(in_fd, out_fd, offset, count):
     '''
-    open regular file, gzipped files
+    copy count bytes of a file from offset to the current position of another without going through user space
+    where the kernel can, by reads and writes otherwise
+    :param in_fd: file descriptor of the regular file copied
+    :param out_fd: file descriptor written
+    '''
+    if not SENDFILE:
+        SENDFILE.append(get_sendfile())
+    sendfile = SENDFILE[0]
+    while count > 0 and sendfile is not None:
+        try:
+            sent = sendfile(out_fd, in_fd, offset, min(count, SENDFILE_MAX_BYTES))
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            sendfile = None
+            break
+        if not sent:
+            raise IOError("file is shorter than expected")
+        offset += sent
+        count -= sent
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    while count > 0:
+        data = os.read(in_fd, min(count, 1 << 20))
+        if not data:
+            raise IOError("file is shorter than expected")
+        while data:
+            written = os.write(out_fd, data)
+            data = data[written:]
+            count -= written
+
+def versatile_open(filename, mode, threads = None):
+    '''
+    open regular file, gzipped files. Files read are recognized as gzipped by their magic bytes
+    and decompressed in background threads, files written are gzipped if they end with .gz
     :param filename: filename string
     :param mode: mode string
+    :param threads: threads decompressing BGZF blocks, up to MAX_DECOMPRESS_THREADS depending on the cores if None
     :return: file handle
     '''
+    if mode.startswith('r') and '+' not in mode:
+        with open(filename, 'rb') as fd:
+            magic = fd.read(len(bgzf.GZIP_MAGIC))
+        if magic == bgzf.GZIP_MAGIC:
+            if threads is None:
+                import multiprocessing
+                threads = min(MAX_DECOMPRESS_THREADS, multiprocessing.cpu_count())
+            return bgzf.GzipReader(filename, threads)
+        return open(filename, mode)
     if filename.endswith('.gz'):
-        import gzip
         return gzip.open(filename, mode)
     else:
         return open(filename, mode)
@@ -152,12 +525,291 @@ def get_loglevel(string):
         return logging.DEBUG
     return logging.INFO
 
-def combine_vcf(combined_vcf, vcfs, duplicate_handling_mode = COMBINE_KEEP_ALL_DUPLICATE, gzip = True):
+class UnsortedVcfError(ValueError):
+    '''
+    raised when a VCF expected to be sorted is out of order
+    '''
+    def __init__(self, vcf, line):
+        ValueError.__init__(self, '{} is not sorted at {}'.format(vcf, line))
+        self.vcf = vcf
+
+def version_order(c):
+    '''
+    order of a non-digit character in GNU version sort
+    '''
+    if c.isalpha():
+        return ord(c)
+    if c == '~':
+        return -1
+    return ord(c) + 256
+
+def version_key(string):
+    '''
+    sort key equivalent to comparing by GNU version sort (sort -V)
+    non-digit and digit runs alternate, every non-digit run ends with 0,
+    the order of end-of-string
+    '''
+    key = []
+    for non_digit, digit in VERSION_RUNS.findall(string):
+        if not non_digit and not digit:
+            continue
+        key.append(tuple(version_order(c) for c in non_digit) + (0,))
+        key.append(int(digit) if digit else 0)
+    key.append((0,))
+    return key
+
+def version_sort_key(string):
+    '''
+    sort key for sort -V, file suffixes are compared last like in GNU filevercmp
+    '''
+    suffix = VERSION_SUFFIX.search(string)
+    return (version_key(string[:suffix.start()]), version_key(string))
+
+def get_contig_order(reference):
+    '''
+    :return: dict of contig name to its index in the reference .fai, the reference is indexed if it has none.
+    None (version sort) if it cannot be indexed, e.g. if it is gzipped but not BGZF
+    '''
+    if not os.path.isfile("{}.fai".format(reference)):
+        import pysam
+        try:
+            pysam.faidx(reference)
+        except Exception as e:
+            logging.getLogger(get_contig_order.__name__).warn("cannot index {}, contigs are version sorted: {}".format(reference, e))
+            return None
+    with open("{}.fai".format(reference)) as fai_file:
+        return dict((line.split('\t', 1)[0], i) for i, line in enumerate(fai_file) if line.strip())
+
+def vcf_sort_key(line, contig_order = None):
+    '''
+    sort key of a VCF record, same order as src/sort_vcf.sh
+    (sort -k1,1V -k2,2n -k4,4d -k5,5d, ties broken by the whole line)
+    :param contig_order: from get_contig_order, contigs are version sorted if None.
+    contigs missing from the reference go last
+    '''
+    fields = line.split('\t', 5)
+    if contig_order is None:
+        contig_key = version_sort_key(fields[0])
+    elif fields[0] in contig_order:
+        contig_key = (contig_order[fields[0]],)
+    else:
+        contig_key = (len(contig_order), version_sort_key(fields[0]))
+    return (contig_key, int(fields[1]),
+            NON_DICTIONARY.sub('', fields[3]), NON_DICTIONARY.sub('', fields[4]), line.rstrip('\n'))
+
+def read_vcf_header(vcf):
+    '''
+    :return: list of header lines
+    '''
+    header = []
+    with versatile_open(vcf, 'r') as fh:
+        for l in fh:
+            if not l.startswith('#'):
+                break
+            header.append(l)
+    return header
+
+def iter_vcf_records(vcfs):
+    '''
+    generate records (lines ending with newline) of VCFs, skipping header and empty lines
+    '''
+    for vcf in vcfs:
+        with versatile_open(vcf, 'r') as fh:
+            for l in fh:
+                if l.startswith('#') or not l.rstrip():
+                    continue
+                yield l if l.endswith('\n') else l + '\n'
+
+def iter_sorted_vcf_records(vcf, contig_order = None):
+    '''
+    generate (sort key, line) of each record, assuming the VCF is sorted
+    :raise UnsortedVcfError: if a record is out of order
+    '''
+    previous_key = None
+    for l in iter_vcf_records([vcf]):
+        key = vcf_sort_key(l, contig_order)
+        if previous_key is not None and key < previous_key:
+            raise UnsortedVcfError(vcf, l.rstrip())
+        previous_key = key
+        yield key, l
+
+def merge_sorted_vcfs(vcfs, contig_order = None):
+    '''
+    k-way merge of records from sorted VCFs
+    :return: generator of lines in sorted order
+    :raise UnsortedVcfError: if any input turns out to be unsorted
+    '''
+    for key, line in heapq.merge(*[iter_sorted_vcf_records(vcf, contig_order) for vcf in vcfs]):
+        yield line
+
+def spill_sorted_run(lines, tmp_dir = None):
+    '''
+    write sorted records to a temporary fast-compressed file
+    :return: file name
+    '''
+    fd, run = tempfile.mkstemp(suffix = '.vcf.gz', dir = tmp_dir)
+    os.close(fd)
+    with gzip.GzipFile(run, 'wb', compresslevel = 1) as output:
+        for l in lines:
+            output.write(l)
+    return run
+
+def sort_vcf_records(lines, contig_order = None, buffer_bytes = None, tmp_dir = None):
+    '''
+    external merge sort of VCF records: records are sorted in memory and spilled
+    to a temporary run every buffer_bytes bytes of records, runs are then merged
+    :param contig_order: see vcf_sort_key
+    :param buffer_bytes: SORT_BUFFER_BYTES if None
+    :return: generator of sorted lines
+    '''
+    logger = logging.getLogger(sort_vcf_records.__name__)
+    if buffer_bytes is None:
+        buffer_bytes = SORT_BUFFER_BYTES
+    key = lambda l: vcf_sort_key(l, contig_order)
+    runs = []
+    try:
+        records = []
+        buffered = 0
+        for l in lines:
+            records.append(l)
+            buffered += len(l)
+            if buffered >= buffer_bytes:
+                records.sort(key = key)
+                runs.append(spill_sorted_run(records, tmp_dir))
+                records = []
+                buffered = 0
+        records.sort(key = key)
+        if runs:
+            logger.info('merging {} sorted runs'.format(len(runs) + 1))
+        streams = [((key(l), l) for l in gzip.open(run, 'rb')) for run in runs]
+        streams.append(((key(l), l) for l in records))
+        for sort_key, l in heapq.merge(*streams):
+            yield l
+    finally:
+        for run in runs:
+            os.remove(run)
+
+def sort_vcf(vcfs, sorted_vcf, reference = None, gzip = True, threads = 1, transform = None):
+    '''
+    sort VCFs into one VCF without intermediate uncompressed copy
+    header is taken from the first VCF
+    :param reference: FASTA with .fai giving the contig order, version sort if None
+    :param gzip: output BGZF compressed and tabix indexed if True
+    :param threads: number of BGZF compression threads
+    :param transform: function applied to every header line and record on the way, e.g. convert_cn
+    :return: output file name
+    '''
+    contig_order = get_contig_order(reference) if reference else None
+    header = read_vcf_header(vcfs[0])
+    records = iter_vcf_records(vcfs)
+    if transform:
+        header = map(transform, header)
+        records = itertools.imap(transform, records)
+    return write_vcf_records(sorted_vcf, header, sort_vcf_records(records, contig_order), gzip, threads)
+
+def convert_cn(line, operation):
+    '''
+    convert the copy numbers of a VCF line
+    two2one turns '2/1'-like copy numbers into the largest number, one2two gives the number to every
+    non-reference allele of GT (1 for reference alleles) if there is only one. Header lines get the type of CN changed
+    :param line: header line or record
+    :param operation: "two2one" or "one2two"
+    :return: converted line, ending with a newline
+    '''
+    if operation != "two2one" and operation != "one2two":
+        raise ValueError("Only two2one or one2two allowed")
+    two2one = operation == "two2one"
+    line = line.rstrip()
+    if line.startswith("#"):
+        if line.startswith('##FORMAT=<ID=CN'):
+            if two2one:
+                line = line.replace("Type=String", "Type=Integer")
+            else:
+                line = line.replace("Type=Integer", "Type=String")
+        return line + "\n"
+    fields = line.split("\t")
+    if len(fields) < 10 or 'CN' not in fields[8]:
+        return line + "\n"
+    info = fields[8].split(':')
+    if 'CN' not in info or (not two2one and 'GT' not in info):
+        return line + "\n"
+    cn_index = info.index('CN')
+    #two2one does not look at GT
+    gt_index = info.index('GT') if 'GT' in info else cn_index
+    #change CN field in all samples
+    for sample_index in xrange(9, len(fields)):
+        sample_info = fields[sample_index].split(':')
+        if len(sample_info) <= max(cn_index, gt_index):
+            continue
+        cn = CN_DELIMITER.split(sample_info[cn_index])
+        if two2one:
+            if all(c.isdigit() for c in cn):
+                sample_info[cn_index] = str(max(map(int, cn)))
+        elif len(cn) == 1:
+            #only split when there is only one number
+            gt = ['1' if allele == '0' else cn[0] for allele in CN_DELIMITER.split(sample_info[gt_index])]
+            sample_info[cn_index] = ('/' if '/' in sample_info[gt_index] else '|').join(gt)
+        fields[sample_index] = ":".join(sample_info)
+    return "\t".join(fields) + "\n"
+
+def filter_duplicate_records(lines, duplicate_handling_mode = COMBINE_KEEP_ALL_DUPLICATE):
+    '''
+    handle adjacent duplicate records (same chr+pos+ref+alt) in sorted lines
+    :param lines: iterable of sorted records
+    :param duplicate_handling_mode: COMBINE_KEEP_*_DUPLICATE
+    :return: generator of lines
+    '''
+    logger = logging.getLogger(filter_duplicate_records.__name__)
+    if duplicate_handling_mode != COMBINE_KEEP_FIRST_DUPLICATE and duplicate_handling_mode != COMBINE_KEEP_NO_DUPLICATE:
+        for l in lines:
+            yield l
+        return
+    previous_line = None
+    previous_variant = None
+    current_count = 0
+    for l in lines:
+        #assume no empty field
+        chr1, pos1, id1, ref1, alt1 = l.rstrip().split()[0:5]
+        if previous_line and previous_variant == (chr1, pos1, ref1, alt1):
+            #duplicate
+            current_count += 1
+            continue
+        if previous_line:
+            if duplicate_handling_mode == COMBINE_KEEP_FIRST_DUPLICATE or current_count == 1:
+                yield previous_line
+            else:
+                logger.debug('{0} duplicated {1} times, are discarded'.format(previous_line, current_count))
+        previous_line = l
+        previous_variant = (chr1, pos1, ref1, alt1)
+        current_count = 1
+    #process last variant record
+    if previous_line:
+        if duplicate_handling_mode == COMBINE_KEEP_FIRST_DUPLICATE or current_count == 1:
+            yield previous_line
+
+def write_vcf_records(vcf, header, lines, gzip = True, threads = 1):
+    '''
+    write header and sorted records, BGZF compressed and tabix indexed if gzip
+    :param threads: number of BGZF compression threads
+    :return: output file name
+    '''
+    with (bgzf.IndexedVcfWriter(vcf, threads = threads) if gzip else open(vcf, 'w')) as output:
+        for l in header:
+            output.write(l)
+        for l in lines:
+            output.write(l)
+    return vcf
+
+def combine_vcf(combined_vcf, vcfs, duplicate_handling_mode = COMBINE_KEEP_ALL_DUPLICATE, gzip = True, reference = None, threads = 1):
     '''
     combine multiple VCFs, sort, optionally remove duplicate
+    sorted inputs are merged in a single streaming pass, a full sort is only
+    done if some input turns out to be unsorted
     :param combined_vcf:
     :param vcfs:
     :param rm_duplicate: if true, remove duplicate variants (by chr+pos+ref+alt)
+    :param reference: FASTA with .fai giving the contig order, version sort if None
+    :param threads: number of BGZF compression threads
     :return: output file name
     '''
     logger = logging.getLogger(combine_vcf.__name__)
@@ -165,114 +817,57 @@ def combine_vcf(combined_vcf, vcfs, duplicate_handling_mode = COMBINE_KEEP_ALL_D
     if not vcfs or len(vcfs) < 2:
         raise ValueError('at least 2 VCFs required')
 
-    sort_command = [SORT_VCF]
-    sort_command.extend(vcfs)
-    gz_vcf = "{}.gz".format(combined_vcf)
-    with open(combined_vcf, "w") as sorted_out:
-        run_shell_command(sort_command, cmd_stdout=sorted_out, cmd_stderr=sys.stderr)
-    if duplicate_handling_mode == COMBINE_KEEP_FIRST_DUPLICATE or duplicate_handling_mode == COMBINE_KEEP_NO_DUPLICATE:
-        previous_line = None
-        current_count = 0
-        uniq_vcf = combined_vcf + '.uniq'
-        with open(combined_vcf, "r") as input, open(uniq_vcf, 'w') as output:
-            for l in input:
-                if l.startswith('#'):
-                    output.write(l)
-                elif previous_line:
-                    #assume no empty field
-                    chr0, pos0, id0, ref0, alt0 = previous_line.rstrip().split()[0:5]
-                    chr1, pos1, id1, ref1, alt1 = l.rstrip().split()[0:5]
-                    if (chr0, pos0, ref0, alt0) == (chr1, pos1, ref1, alt1):
-                        #duplicate
-                        current_count += 1
-                    else:
-                        if duplicate_handling_mode == COMBINE_KEEP_FIRST_DUPLICATE or\
-                                (duplicate_handling_mode == COMBINE_KEEP_NO_DUPLICATE and current_count == 1):
-                            output.write(previous_line)
-                        elif current_count > 1:
-                            logger.debug('{0} duplicated {1} times, are discarded'.format(previous_line, current_count))
-                        previous_line = l
-                        current_count = 1
-                else:
-                    previous_line = l
-                    current_count = 1
-            #process last variant record
-            if previous_line:
-                if duplicate_handling_mode == COMBINE_KEEP_FIRST_DUPLICATE or \
-                    (duplicate_handling_mode == COMBINE_KEEP_NO_DUPLICATE and current_count == 1):
-                    output.write(previous_line)
-        os.rename(uniq_vcf, combined_vcf)
-    if gzip:
-        run_shell_command([BGZIP, "--force", combined_vcf], cmd_stdout=sys.stdout, cmd_stderr=sys.stderr)
-        index_vcf_gz(gz_vcf)
-        return gz_vcf
-    else:
-        return combined_vcf
+    output_vcf = "{}.gz".format(combined_vcf) if gzip else combined_vcf
+    header = read_vcf_header(vcfs[0])
+    contig_order = get_contig_order(reference) if reference else None
+    try:
+        write_vcf_records(output_vcf, header,
+                          filter_duplicate_records(merge_sorted_vcfs(vcfs, contig_order), duplicate_handling_mode), gzip, threads)
+    except UnsortedVcfError as e:
+        logger.info("{}, falling back to full sort".format(e))
+        write_vcf_records(output_vcf, header,
+                          filter_duplicate_records(sort_vcf_records(iter_vcf_records(vcfs), contig_order), duplicate_handling_mode), gzip, threads)
+    return output_vcf
 
 def index_vcf_gz(vcf_gz):
+    import pysam
     pysam.tabix_index(vcf_gz, force = True, preset = 'vcf')
 
-def sort_and_compress(vcf, output_prefix = None, mode = 1, overwrite = False):
+def sort_and_compress(vcf, output_prefix = None, mode = 1, overwrite = False, reference = None, threads = 1, transform = None):
     '''
     sort and compress vcf and return compressed filename
+    the sorted records go straight into BGZF with the tabix index built in the same pass
     Params:
         vcf: input
-        mode: 1 for backward compatibility, 2 for more reasonable behavior,
+        mode: 1 for backward compatibility (input is removed), 2 for more reasonable behavior,
               3 for saving temp files based on output_prefix
+        reference: FASTA with .fai giving the contig order, version sort if None
+        threads: number of BGZF compression threads
+        transform: function applied to every line while sorting, e.g. convert_cn
     Returns:
         gzipped vcf filename
     '''
     logger = logging.getLogger(sort_and_compress.__name__)
     if mode == 1:
         gz_vcf = "{}.gz".format(vcf)
-        sorted_vcf = "{}.sorted".format(vcf)
-
-        sort_command = [SORT_VCF, vcf]
-        with open(sorted_vcf, "w") as sorted_out:
-            run_shell_command(sort_command, cmd_stdout=sorted_out, cmd_stderr=sys.stderr)
-        os.rename(sorted_vcf, vcf)
-        pysam.tabix_index(vcf, force=True, preset='vcf')
-        return gz_vcf
     elif mode == 2:
         suffix_index = vcf.rfind('.vcf')
-        sorted_vcf = vcf[:suffix_index] + ".sorted" + vcf[suffix_index:]
-        gz_vcf = "{}.gz".format(sorted_vcf)
-
-        sort_command = [SORT_VCF, vcf]
-        logger.info('sorting {}'.format(vcf))
-        if (not overwrite) and os.path.isfile(sorted_vcf):
-            raise ValueError("{} exists".format(sorted_vcf))
-        with open(sorted_vcf, "w") as sorted_out:
-            run_shell_command(sort_command, cmd_stdout=sorted_out, cmd_stderr=sys.stderr)
-        logger.info('compressing {}'.format(sorted_vcf))
-        if (not overwrite) and os.path.isfile(gz_vcf):
-            raise ValueError("{} exists".format(gz_vcf))
-        with open(gz_vcf, "w") as out:
-            run_shell_command([BGZIP, "--force", "--stdout", sorted_vcf], cmd_stdout=out, cmd_stderr=sys.stderr)
-        index_vcf_gz(gz_vcf)
-        return gz_vcf
+        gz_vcf = vcf[:suffix_index] + ".sorted" + vcf[suffix_index:] + ".gz"
     elif mode == 3:
         if output_prefix is None:
             raise ValueError('Expecting output_prefix for this mode')
-        sorted_vcf = output_prefix + ".sorted.vcf"
-        gz_vcf = "{}.gz".format(sorted_vcf)
-
-        sort_command = [SORT_VCF, vcf]
-        logger.info('sorting {}'.format(vcf))
-        if (not overwrite) and os.path.isfile(sorted_vcf):
-            raise ValueError("{} exists".format(sorted_vcf))
-        with open(sorted_vcf, "w") as sorted_out:
-            run_shell_command(sort_command, cmd_stdout=sorted_out, cmd_stderr=sys.stderr)
-        logger.info('compressing {}'.format(sorted_vcf))
-        if (not overwrite) and os.path.isfile(gz_vcf):
-            raise ValueError("{} exists".format(gz_vcf))
-        with open(gz_vcf, "w") as out:
-            run_shell_command([BGZIP, "--force", sorted_vcf], cmd_stdout=out, cmd_stderr=sys.stderr)
-        index_vcf_gz(gz_vcf)
-        return gz_vcf
+        gz_vcf = output_prefix + ".sorted.vcf.gz"
     else:
         raise ValueError
 
+    if mode != 1 and (not overwrite) and os.path.isfile(gz_vcf):
+        raise ValueError("{} exists".format(gz_vcf))
+    logger.info('sorting {} into {}'.format(vcf, gz_vcf))
+    sort_vcf([vcf], gz_vcf, reference, threads = threads, transform = transform)
+    if mode == 1:
+        os.remove(vcf)
+    return gz_vcf
+
 def write_vcf(lines, vcf):
     """Create a file from the provided list"""
 
@@ -298,47 +893,101 @@ def write_filtered_vcf(vcf, chrm, out_vcf):
     return write_vcf(content, out_vcf)
 
 
-def get_closest_variant(variant, vcf):
-    """Return the variant in a vcf closest to a variant"""
-
-    closest_variant = None
-
-    with versatile_open(vcf, "r") as vcf_handle:
-        min_dist = 100
-
-        for line in vcf_handle:
-            line_split = str(line).strip().split()
+class VariantIndex(object):
+    '''
+    variants of a vcf in memory, sorted by position per contig and keyed by their alleles,
+    for the lookups of get_closest_variant and get_matching_alt_ref by binary search
+    '''
+    def __init__(self, vcf):
+        self.vcf = vcf
+        #contig -> sorted positions, and the variants and their numbers in file order in the same order
+        self.positions = {}
+        self.variants = {}
+        self.numbers = {}
+        #(contig, position, ref, alt) -> first variant in file order
+        self.alleles = {}
+        with versatile_open(vcf, "r") as vcf_handle:
+            for number, line in enumerate(vcf_handle):
+                line_split = line.strip().split()
+                if not line_split or line_split[0][0] == "#":
+                    continue
+                self.positions.setdefault(line_split[0], []).append(int(line_split[1]))
+                self.variants.setdefault(line_split[0], []).append(line_split)
+                self.numbers.setdefault(line_split[0], []).append(number)
+                self.alleles.setdefault((line_split[0], line_split[1], line_split[3], line_split[4]), line_split)
+        for chrom, positions in self.positions.iteritems():
+            #stable sort keeps file order for variants at the same position
+            order = sorted(xrange(len(positions)), key=positions.__getitem__)
+            self.positions[chrom] = [positions[i] for i in order]
+            self.variants[chrom] = [self.variants[chrom][i] for i in order]
+            self.numbers[chrom] = [self.numbers[chrom][i] for i in order]
 
-            if line_split[0][0] == "#":
-                continue
+    def get_closest_variant(self, variant, max_distance = CLOSEST_VARIANT_DISTANCE):
+        '''
+        :param variant: vcf line split by whitespace
+        :param max_distance: variants at this distance or farther are not considered
+        :return: variant (split) closest to variant, the first in file order of the closest ones, None if there is none
+        '''
+        positions = self.positions.get(variant[0])
+        if not positions:
+            return None
+        pos = int(variant[1])
+        numbers = self.numbers[variant[0]]
+        candidates = []
+        #nearest position on either side, the first variant in file order at it
+        right = bisect.bisect_right(positions, pos)
+        if right > 0:
+            candidates.append(bisect.bisect_left(positions, positions[right - 1]))
+        if right < len(positions):
+            candidates.append(right)
+        closest = None
+        for i in candidates:
+            dist = abs(positions[i] - pos)
+            if dist < max_distance and (closest is None or (dist, numbers[i]) < closest[:2]):
+                closest = (dist, numbers[i], i)
+        return self.variants[variant[0]][closest[2]][:] if closest else None
 
-            if line_split[0] == variant[0]:
-                dist = abs(int(line_split[1])-int(variant[1]))
+    def get_matching_alt_ref(self, variant):
+        '''
+        :param variant: vcf line split by whitespace
+        :return: first variant (split) at the same position with matching alt and ref, None if there is none
+        '''
+        matching_alt_ref = self.alleles.get((variant[0], variant[1], variant[3], variant[4]))
+        return matching_alt_ref[:] if matching_alt_ref else None
 
-                if dist < min_dist:
-                    min_dist = dist
-                    closest_variant = line_split[:]
 
-    return closest_variant
+#(file, modification time, size) and VariantIndex, least recently used first
+VARIANT_INDEX_CACHE = []
 
+def get_variant_index(vcf):
+    '''
+    :param vcf: vcf file name or VariantIndex
+    :return: VariantIndex of vcf, cached until the file changes
+    '''
+    if isinstance(vcf, VariantIndex):
+        return vcf
+    stat = os.stat(vcf)
+    key = (os.path.realpath(vcf), stat.st_mtime, stat.st_size)
+    for i, (cached_key, index) in enumerate(VARIANT_INDEX_CACHE):
+        if cached_key == key:
+            VARIANT_INDEX_CACHE.append(VARIANT_INDEX_CACHE.pop(i))
+            return index
+    index = VariantIndex(vcf)
+    VARIANT_INDEX_CACHE.append((key, index))
+    del VARIANT_INDEX_CACHE[:-VARIANT_INDEX_CACHE_SIZE]
+    return index
 
-def get_matching_alt_ref(variant, vcf):
-    """Return the variant in a vcf at the same position with matching alt and ref"""
 
-    matching_alt_ref = None
+def get_closest_variant(variant, vcf):
+    """Return the variant in a vcf (file name or VariantIndex) closest to a variant"""
 
-    with versatile_open(vcf, "r") as vcf_handle:
-        for line in vcf_handle:
-            line_split = str(line).strip().split()
+    return get_variant_index(vcf).get_closest_variant(variant)
 
-            if line_split[0][0] == "#":
-                continue
 
-            if variant[0] == line_split[0] and variant[1] == line_split[1] and variant[3] == line_split[3] and variant[4] == line_split[4]:
-                matching_alt_ref = line_split[:]
-                break
+def get_matching_alt_ref(variant, vcf):
+    """Return the variant in a vcf (file name or VariantIndex) at the same position with matching alt and ref"""
 
-    return matching_alt_ref
+    return get_variant_index(vcf).get_matching_alt_ref(variant)
 
 
 def get_info(var, entry):
@@ -369,7 +1018,7 @@ def get_info(var, entry):
     return ret_val
 
 
-def make_clean_vcf(vcf, path=None):
+def make_clean_vcf(vcf, path=None, threads=1):
     """Make a clean vcf retaining essential fields"""
     vcf_path = os.path.split(vcf)
 
@@ -407,6 +1056,6 @@ def make_clean_vcf(vcf, path=None):
 
     clean_vcf_handle.close()
 
-    clean_vcf = sort_and_compress(clean_vcf)
+    clean_vcf = sort_and_compress(clean_vcf, threads = threads)
 
     return clean_vcf
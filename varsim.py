@@ -9,18 +9,27 @@ import logging
 import shutil
 import time
 import signal
+import errno
+import threading
+import Queue
 import itertools
+import functools
+import heapq
 import glob
 import tempfile
-import re
-import pysam
 from liftover_restricted_vcf_map import lift_vcfs, lift_maps
 from generate_small_test_ref import gen_restricted_ref_and_vcfs 
 from utils import makedirs, run_shell_command, versatile_open, get_loglevel, check_java, MY_DIR, VARSIMJAR, get_version
 import utils
+import bgzf
 
 REQUIRE_VARSIMJAR = not os.path.isfile(VARSIMJAR)
 if REQUIRE_VARSIMJAR: VARSIMJAR = None
+#heap of a vcf2diploid JVM building part of the contigs: the JVM, the variants of its contigs,
+#the reference of its contigs and both haplotypes of the longest one
+VCF2DIPLOID_BASE_MEMORY = 1 << 30
+VCF2DIPLOID_HAPLOTYPE_BYTES_PER_BASE = 4
+VCF2DIPLOID_VARIANT_BYTES_PER_VCF_BYTE = 4
 
 def convertCN(filenames, operation):
     """
@@ -33,45 +42,12 @@ def convertCN(filenames, operation):
     logger.info("convertCN started")
     if operation != "two2one" and operation != "one2two":
         raise ValueError("Only two2one or one2two allowed")
-    two2one = operation == "two2one"
-    delimiter = re.compile('[/|]')
     for name in filenames:
         logger.info("processing {}".format(name))
         with versatile_open(name, 'r') as file_fd:
             output = tempfile.NamedTemporaryFile(mode = 'r+w', delete = False)
             for l in file_fd:
-                l = l.rstrip()
-                fields = l.split("\t")
-                if l.startswith("#") or 'CN' not in fields[8]:
-                    if l.startswith('##FORMAT=<ID=CN'):
-                        if two2one:
-                            l = l.replace("Type=String","Type=Integer")
-                        else:
-                            l = l.replace("Type=Integer", "Type=String")
-                    output.write(l + "\n")
-                else:
-                    info = fields[8].split(':')
-                    cnIndex = info.index('CN')
-                    gtIndex = info.index('GT')
-                    #change CN field in all samples
-                    for sampleIndex in range(9,len(fields)):
-                        sampleInfo = fields[sampleIndex].split(':')
-                        if two2one:
-                            cn = delimiter.split(sampleInfo[cnIndex])
-                            #here cn is list of strings
-                            sampleInfo[cnIndex] = str(max(map(int, cn)))
-                        elif len(delimiter.split(sampleInfo[cnIndex])) == 1:
-                            #only split when there is only one number
-                            gt = delimiter.split(sampleInfo[gtIndex])
-                            cn = sampleInfo[cnIndex]
-                            for i in range(len(gt)):
-                                gt[i] = '1' if gt[i] == '0' else cn
-                            if sampleInfo[gtIndex].find('/') >= 0:
-                                sampleInfo[cnIndex] = '/'.join(gt)
-                            else:
-                                sampleInfo[cnIndex] = '|'.join(gt)
-                        fields[sampleIndex] = ":".join(sampleInfo)
-                    output.write("\t".join(fields) + "\n")
+                output.write(utils.convert_cn(l, operation))
             output.close()
             shutil.copyfile(output.name, name)
             os.remove(output.name)
@@ -85,52 +61,397 @@ def get_contigs_list(reference):
     return contigs
 
 
+def get_contig_lengths(reference):
+    with open("%s.fai" % (reference)) as fai_file:
+        return [(fields[0], int(fields[1])) for fields in (line.split() for line in fai_file) if fields]
+
+
+def shard_contigs(contig_lengths, shards):
+    '''
+    group contigs for separate vcf2diploid runs, longest contig first into the group with the fewest bases
+    :param contig_lengths: list of (contig, length) in reference order
+    :return: non-empty lists of (contig, length) in reference order
+    '''
+    groups = [[] for _ in xrange(max(shards, 1))]
+    # (bases, group)
+    loads = [(0, i) for i in xrange(len(groups))]
+    order = dict((contig, i) for i, (contig, _) in enumerate(contig_lengths))
+    for contig, length in sorted(contig_lengths, key=lambda (contig, length): (-length, order[contig])):
+        bases, i = heapq.heappop(loads)
+        groups[i].append((contig, length))
+        heapq.heappush(loads, (bases + length, i))
+    return [sorted(group, key=lambda (contig, length): order[contig]) for group in groups if group]
+
+
+def compress_contig_vcfs(contigs, directory, sample_id):
+    '''
+    compress the per-contig VCFs of vcf2diploid into <contig>_<id>.vcf.gz pieces with tabix indexes
+    for bgzf.concatenate_indexed_vcfs, removing the VCFs
+    '''
+    logger = logging.getLogger(compress_contig_vcfs.__name__)
+    for contig in contigs:
+        vcf = os.path.join(directory, "%s_%s.vcf" % (contig, sample_id))
+        if not os.path.isfile(vcf):
+            continue
+        try:
+            with open(vcf) as vcf_fd, bgzf.IndexedVcfWriter(vcf + ".gz", separate_header=True) as piece:
+                for line in vcf_fd:
+                    if line.strip():
+                        piece.write(line)
+        except ValueError as e:
+            # records are in the order of their start before the reference base vcf2diploid adds to indels
+            logger.info("{}, sorting {}".format(e, vcf))
+            with bgzf.IndexedVcfWriter(vcf + ".gz", separate_header=True) as piece:
+                for line in utils.read_vcf_header(vcf):
+                    piece.write(line)
+                for line in utils.sort_vcf_records(utils.iter_vcf_records([vcf])):
+                    piece.write(line)
+        os.remove(vcf)
+
+
+def get_contig_variant_bytes(vcfs):
+    '''
+    :return: dict of contig -> bytes of the variant lines of vcfs on the contig
+    '''
+    variant_bytes = {}
+    for vcf in vcfs:
+        with versatile_open(vcf, "r") as vcf_fd:
+            for line in vcf_fd:
+                if line.startswith("#"):
+                    continue
+                contig = line[:line.find("\t")]
+                variant_bytes[contig] = variant_bytes.get(contig, 0) + len(line)
+    return variant_bytes
+
+
+def get_vcf2diploid_memory(contig_lengths, contig_variant_bytes={}, max_memory=0):
+    '''
+    :param contig_lengths: list of (contig, length) built by one vcf2diploid run
+    :param contig_variant_bytes: dict of contig -> bytes of its variant lines, see get_contig_variant_bytes
+    :param max_memory: heap of a vcf2diploid run over all contigs, no limit if 0
+    :return: heap size in bytes
+    '''
+    lengths = [length for _, length in contig_lengths]
+    variant_bytes = sum(contig_variant_bytes.get(contig, 0) for contig, _ in contig_lengths)
+    memory = VCF2DIPLOID_BASE_MEMORY + sum(lengths) + VCF2DIPLOID_HAPLOTYPE_BYTES_PER_BASE * max(lengths) + \
+             VCF2DIPLOID_VARIANT_BYTES_PER_VCF_BYTE * variant_bytes
+    return min(memory, max_memory) if max_memory else memory
+
+
+class ExitEvents(object):
+    '''
+    exits of child processes and of functions run in threads, reported by helper threads.
+    get blocks on a pipe until something exits, there is no polling
+    '''
+    def __init__(self):
+        self.events = Queue.Queue()
+        self.read_fd, self.write_fd = os.pipe()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def put(self, key, status):
+        with self.lock:
+            #exits after close, e.g. of killed processes, are not waited for
+            if self.closed:
+                return
+            self.events.put((key, status))
+            os.write(self.write_fd, "x")
+
+    def get(self):
+        '''
+        :return: (key, exit status) of the next exit, status 0 on success
+        '''
+        while True:
+            try:
+                os.read(self.read_fd, 1)
+                break
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+        return self.events.get_nowait()
+
+    def watch_process(self, key, process):
+        thread = threading.Thread(target=lambda: self.put(key, process.wait()))
+        thread.daemon = True
+        thread.start()
+
+    def watch_function(self, key, function):
+        def run():
+            try:
+                function()
+            except Exception:
+                logging.getLogger(ExitEvents.__name__).exception("{} failed".format(getattr(function, "__name__", function)))
+                self.put(key, 1)
+                return
+            self.put(key, 0)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+
+
 def monitor_processes(processes):
     logger = logging.getLogger(monitor_processes.__name__)
-    while processes:
-        time.sleep(1)
-        kill_all = False
-        processes_running = []
+    events = ExitEvents()
+    try:
         for p in processes:
-            status = p.poll()
-            if status is not None:
-                logger.info("Process %s exited with code %d" % (p.pid, status))
-                if status != 0:
-                    kill_all = True
-                    logger.error("Process %s failed. Will kill the remaining processes." % p.pid)
-            else:
-                processes_running.append(p)
-        if kill_all:
-            for p in processes:
-                status = p.poll()
-                if status is None:
-                    try:
-                        os.killpg(p.pid, signal.SIGTERM)
-                    except OSError, e:
-                        try:
-                            os.killpg(p.pid, signal.SIGKILL)
-                        except OSError, ex:
-                            logger.error("Could not kill the process " + str(p.pid))
-            raise Exception('Aborting... Please check log for details.')
-        processes = processes_running
+            events.watch_process(p, p)
+        for _ in processes:
+            p, status = events.get()
+            logger.info("Process %s exited with code %d" % (p.pid, status))
+            if status != 0:
+                logger.error("Process %s failed. Will kill the remaining processes." % p.pid)
+                kill_processes(processes)
+                raise Exception('Aborting... Please check log for details.')
+    finally:
+        events.close()
     return []
 
 
-def concatenate_files(files, merged, header_str="", simple_cat=True, remove_original=False):
+def kill_processes(processes):
+    logger = logging.getLogger(kill_processes.__name__)
+    for p in processes:
+        status = p.poll()
+        if status is None:
+            try:
+                os.killpg(p.pid, signal.SIGTERM)
+            except OSError, e:
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except OSError, ex:
+                    logger.error("Could not kill the process " + str(p.pid))
+
+
+def run_command(command, stdout, stderr, cwd):
+    '''
+    run a stage command with run_shell_command, e.g. in the VarSim worker
+    '''
+    stdout_fd = open(stdout, "w") if stdout else None
+    try:
+        with open(stderr, "w") as stderr_fd:
+            run_shell_command(command, stdout_fd, stderr_fd, cwd)
+    finally:
+        if stdout_fd:
+            stdout_fd.close()
+
+
+class Stage(object):
+    '''
+    pipeline step: shell commands started together, or a function run in a thread
+    '''
+    def __init__(self, name, commands, function, depends, cores, memory, cwd):
+        self.name = name
+        self.commands = commands
+        self.function = function
+        self.depends = depends
+        self.cores = cores
+        self.memory = memory
+        self.cwd = cwd
+        self.started = None
+        self.finished = None
+
+
+class StageScheduler(object):
+    '''
+    run pipeline stages as soon as the stages they depend on are done, within cores and memory budgets.
+    A stage larger than a budget runs without other stages using that resource.
+    As in monitor_processes, everything still running is killed as soon as a stage fails
+    '''
+    def __init__(self, cores=1, memory=None):
+        '''
+        :param cores: number of cores
+        :param memory: memory budget (e.g. 64g), None for no memory limit
+        '''
+        self.cores = cores
+        self.memory = utils.parse_memory(memory) if memory else None
+        self.stages = []
+
+    def add(self, name, commands=None, function=None, depends=[], cores=1, memory=0, cwd="."):
+        '''
+        :param commands: list of (command, stdout file or None, stderr file), all started together,
+                         or a function of the memory of the stage returning the list
+        :param function: called without argument if no commands are given
+        :param depends: stages to finish first, added before
+        :param cores: cores used
+        :param memory: memory used in bytes, or a function returning it called once the stages depended on are done
+        :param cwd: working directory of the commands
+        :return: the stage
+        '''
+        if any(stage not in self.stages for stage in depends):
+            raise ValueError("stage {} depends on stages not added before".format(name))
+        stage = Stage(name, commands or [], function, list(depends), cores, memory, cwd)
+        self.stages.append(stage)
+        return stage
+
+    def start(self, stage, events, processes):
+        '''
+        :return: number of exits to wait for
+        '''
+        logger = logging.getLogger(StageScheduler.__name__)
+        logger.info("Starting stage {}".format(stage.name))
+        stage.started = time.time()
+        if callable(stage.commands):
+            stage.commands = stage.commands(stage.memory)
+        if not stage.commands:
+            events.watch_function(stage, stage.function)
+            return 1
+        for command, stdout, stderr in stage.commands:
+            if type(command) == list:
+                command = " ".join(command)
+            if utils.get_varsim_worker_args(command) is not None and utils.get_varsim_worker(stage.cwd):
+                logger.info("Executing command {} in the VarSim worker".format(command))
+                events.watch_function(stage, functools.partial(run_command, command, stdout, stderr, stage.cwd))
+                continue
+            stdout_fd = open(stdout, "w") if stdout else None
+            with open(stderr, "w") as stderr_fd:
+                #own process group so that whole pipelines can be killed
+                process = subprocess.Popen(command, stdout=stdout_fd, stderr=stderr_fd, cwd=stage.cwd, shell=True, close_fds=True, preexec_fn=os.setsid)
+            if stdout_fd:
+                stdout_fd.close()
+            logger.info("Executing command {} with pid {}".format(command, process.pid))
+            processes.append(process)
+            events.watch_process(stage, process)
+        return len(stage.commands)
+
+    def run(self):
+        logger = logging.getLogger(StageScheduler.__name__)
+        waiting = list(self.stages)
+        running = {}
+        processes = []
+        used_cores = 0
+        used_memory = 0
+        events = ExitEvents()
+        try:
+            while waiting or running:
+                for stage in list(waiting):
+                    if not all(dependency.finished for dependency in stage.depends):
+                        continue
+                    if callable(stage.memory):
+                        stage.memory = stage.memory()
+                    if (used_cores and used_cores + stage.cores > self.cores) or \
+                            (self.memory is not None and used_memory and used_memory + stage.memory > self.memory):
+                        continue
+                    waiting.remove(stage)
+                    running[stage] = self.start(stage, events, processes)
+                    used_cores += stage.cores
+                    used_memory += stage.memory
+                stage, status = events.get()
+                if status != 0:
+                    logger.error("Stage {} failed with code {}. Will kill the remaining processes.".format(stage.name, status))
+                    kill_processes(processes)
+                    raise Exception('Aborting... Please check log for details.')
+                running[stage] -= 1
+                if running[stage]:
+                    continue
+                del running[stage]
+                stage.finished = time.time()
+                used_cores -= stage.cores
+                used_memory -= stage.memory
+                logger.info("Stage {} took {:g} seconds".format(stage.name, stage.finished - stage.started))
+        except KeyboardInterrupt:
+            kill_processes(processes)
+            raise
+        finally:
+            events.close()
+
+
+def get_fastq_liftover_command(java, merged_map, lane, out_dir, simulator, force_five_base_encoding=False, fifos=None):
+    '''
+    build the fastq_liftover command of a lane, lifted reads are written to out_dir/lane<lane>.read<1,2>.fq.gz
+    :param fifos: simulated file name (e.g. simulated.lane0.read1.fq) -> FIFO the simulator writes it to.
+                  If given, the FIFOs are read directly instead of the gzipped simulated files
+    :return: command to run with the shell
+    '''
+    def simulated(name):
+        if fifos:
+            return "<(cat %s)" % (fifos[name])
+        return "<(gunzip -c %s.gz)" % (os.path.join(out_dir, name))
+
+    fastq_liftover_command = "%s -server %s -jar %s fastq_liftover -map %s -id %d " \
+                             "-fastq %s " \
+                             "-fastq %s " \
+                             "-out >(gzip -1 > %s/lane%d.read1.fq.gz) " \
+                             "-out >(gzip -1 > %s/lane%d.read2.fq.gz)" % (
+                                 java,
+                                 utils.JAVA_XMX,
+                                 VARSIMJAR, merged_map, lane,
+                                 simulated("simulated.lane%d.read1.fq" % (lane)),
+                                 simulated("simulated.lane%d.read2.fq" % (lane)),
+                                 out_dir, lane, out_dir, lane)
+    if force_five_base_encoding:
+        fastq_liftover_command += " -force_five_base_encoding "
+    if simulator == "art":
+        fastq_liftover_command += " -type art " \
+                                  "-aln %s " \
+                                  "-aln %s" % (
+                                      simulated("simulated.lane%d.read1.aln" % (lane)),
+                                      simulated("simulated.lane%d.read2.aln" % (lane)))
+    elif simulator == "pbsim":
+        fastq_liftover_command += " -type pbsim " \
+                                  "-maf %s " \
+                                  "-ref %s/simulated.lane%d.ref " % (simulated("simulated.lane%d.read1.maf" % (lane)), out_dir, lane)
+    return "bash -c \"%s\"" % (fastq_liftover_command)
+
+
+def get_body_offset(fd, header_str=""):
+    '''
+    :param fd: file opened at its beginning
+    :param header_str: header lines to skip as well as empty lines, None to skip empty lines only
+    :return: offset of the first line that is not skipped
+    '''
+    offset = 0
+    for line in iter(fd.readline, ""):
+        if line.strip() and (header_str is None or not header_str or not line.startswith(header_str)):
+            break
+        offset += len(line)
+    return offset
+
+
+def get_fasta_index(fasta):
+    '''
+    :return: lines of the .fai of fasta, indexed with samtools if it has none
+    '''
+    if not os.path.isfile(fasta + ".fai"):
+        import pysam
+        pysam.faidx(fasta)
+    with open(fasta + ".fai") as fai_fd:
+        return [line.rstrip("\n").split("\t") for line in fai_fd if line.strip()]
+
+
+def concatenate_files(files, merged, header_str="", simple_cat=True, remove_original=False, fasta_index=False):
+    '''
+    concatenate files, the data is copied by the kernel
+    :param header_str: without simple_cat, leading lines starting with header_str are only kept from the first file
+    :param simple_cat: copy whole files, otherwise the body of each file is copied once its leading empty and header lines are skipped
+    :param fasta_index: write <merged>.fai from the .fai of the FASTA files, as the copies are made
+    '''
     logger = logging.getLogger(concatenate_files.__name__)
     logger.info("Concatenating " + " ".join(files) + " as " + merged)
-    with open(merged, "w") as merged_fd:
+    fai_entries = []
+    with open(merged, "wb") as merged_fd:
+        position = 0
         for index, f in enumerate(files):
-            with open(f) as fd:
-                if simple_cat:
-                    shutil.copyfileobj(fd, merged_fd)
-                else:
-                    for line in fd:
-                        if line.strip() and (not index or not header_str or not line.startswith(header_str)):
-                            merged_fd.write(line)
+            with open(f, "rb") as fd:
+                start = 0 if simple_cat else get_body_offset(fd, None if not index else header_str)
+                size = os.fstat(fd.fileno()).st_size - start
+                if fasta_index:
+                    for name, length, offset, line_bases, line_width in get_fasta_index(f):
+                        fai_entries.append((name, length, str(int(offset) - start + position), line_bases, line_width))
+                utils.copy_file_data(fd.fileno(), merged_fd.fileno(), start, size)
+                position += size
             if remove_original:
                 logger.info("Removing " + f)
                 os.remove(f)
+                if fasta_index:
+                    os.remove(f + ".fai")
+    if fasta_index:
+        with open(merged + ".fai", "w") as fai_fd:
+            fai_fd.writelines("\t".join(entry) + "\n" for entry in fai_entries)
 
 
 def check_executable(fpath):
@@ -143,32 +464,54 @@ def check_executable(fpath):
         sys.exit(os.EX_NOINPUT)
 
 
-def fill_missing_sequences(vcf, id, seq_file, reference, work_dir, log_dir, java = "java"):
-    logger = logging.getLogger(fill_missing_sequences.__name__)
-
+def get_fill_missing_sequences_command(vcf, id, seq_file, reference, work_dir, log_dir, java = "java"):
+    '''
+    :return: (command, output VCF, log file)
+    '''
     out_vcf = os.path.join(work_dir, os.path.basename(vcf))
     if out_vcf.endswith(".gz"):
         out_vcf = out_vcf[:-3]
     out_log = os.path.join(log_dir, "%s_fill_missing.log" % (os.path.basename(vcf)))
 
     command = [java, utils.JAVA_XMX, "-jar", VARSIMJAR, "randsequencevcf", "-id", id, "-in_vcf", vcf, "-seq", seq_file, "-out_vcf", out_vcf, "-ref", reference]
+    return command, out_vcf, out_log
+
+
+def fill_missing_sequences(vcf, id, seq_file, reference, work_dir, log_dir, java = "java"):
+    logger = logging.getLogger(fill_missing_sequences.__name__)
+
+    command, out_vcf, out_log = get_fill_missing_sequences_command(vcf, id, seq_file, reference, work_dir, log_dir, java)
     with open(out_log, "w") as log_fd:
         logger.info("Running command " + " ".join(command))
         run_shell_command(" ".join(command), cmd_stdout=None, cmd_stderr=log_fd)
     return out_vcf
         
 
+def get_vcfstats_command(in_vcf, out_dir, log_dir, java = "java"):
+    '''
+    :return: (command, stats file, log file)
+    '''
+    out_prefix = os.path.basename(in_vcf)
+    vcfstats_command = [java, utils.JAVA_XMX, "-jar", VARSIMJAR, "vcfstats", "-vcf",
+                    in_vcf]
+    return vcfstats_command, os.path.join(out_dir, "%s.stats" % (out_prefix)), os.path.join(log_dir, "%s.vcfstats.err" % (out_prefix))
+
+
 def run_vcfstats(vcfs, out_dir, log_dir, java = "java"):
+    '''
+    start vcfstats for all VCFs in the background
+    :return: running processes, to be waited for with monitor_processes
+    '''
     logger = logging.getLogger(run_vcfstats.__name__)
     processes = []
     for in_vcf in vcfs:
-        out_prefix = os.path.basename(in_vcf)
-        vcfstats_stdout = open(os.path.join(out_dir, "%s.stats" % (out_prefix)), "w")
-        vcfstats_stderr = open(os.path.join(log_dir, "%s.vcfstats.err" % (out_prefix)), "w")
-        vcfstats_command = [java, utils.JAVA_XMX, "-jar", VARSIMJAR, "vcfstats", "-vcf",
-                        in_vcf]
-        logger.info("Executing command " + " ".join(vcfstats_command))
-        run_shell_command(vcfstats_command, cmd_stdout=vcfstats_stdout, cmd_stderr=vcfstats_stderr)
+        vcfstats_command, vcfstats_out, vcfstats_err = get_vcfstats_command(in_vcf, out_dir, log_dir, java)
+        vcfstats_command = " ".join(vcfstats_command)
+        with open(vcfstats_out, "w") as vcfstats_stdout, open(vcfstats_err, "w") as vcfstats_stderr:
+            #own process group so that monitor_processes can kill it
+            process = subprocess.Popen(vcfstats_command, stdout=vcfstats_stdout, stderr=vcfstats_stderr, shell=True, close_fds=True, preexec_fn=os.setsid)
+        logger.info("Executing command {} with pid {}".format(vcfstats_command, process.pid))
+        processes.append(process)
     return processes
 
 
@@ -218,9 +561,7 @@ def randdgv_options2randvcf_options(randdgv_options):
         num_inv = randdgv_options.num_inv
     )
 
-def run_randvcf(sampling_vcf, out_vcf_fd, log_file_fd, seed, sex, randvcf_options, reference, sample_id, java = "java"):
-    logger = logging.getLogger(run_randvcf.__name__)
-
+def get_randvcf_command(sampling_vcf, seed, sex, randvcf_options, reference, sample_id, java = "java"):
     rand_vcf_command = [java, utils.JAVA_XMX, "-jar", VARSIMJAR, "randvcf2vcf",
                         "-seed", str(seed),
                         "-t", sex,
@@ -238,15 +579,19 @@ def run_randvcf(sampling_vcf, out_vcf_fd, log_file_fd, seed, sex, randvcf_option
                         "-ref", os.path.realpath(reference),
                         "-id", "'" + str(sample_id) + "'",
                         "-vcf", sampling_vcf]
+    return rand_vcf_command
+
 
+def run_randvcf(sampling_vcf, out_vcf_fd, log_file_fd, seed, sex, randvcf_options, reference, sample_id, java = "java"):
+    logger = logging.getLogger(run_randvcf.__name__)
+
+    rand_vcf_command = get_randvcf_command(sampling_vcf, seed, sex, randvcf_options, reference, sample_id, java)
     logger.info("Executing command " + " ".join(rand_vcf_command))
     run_shell_command(rand_vcf_command, cmd_stdout=out_vcf_fd, cmd_stderr=log_file_fd)
     return
 
 
-def run_randdgv(dgv_file, out_vcf_fd, log_file_fd, seed, sex, options, reference, insert_seq_file, sample_id, java = "java"):
-    logger = logging.getLogger(run_randdgv.__name__)
-
+def get_randdgv_command(dgv_file, seed, sex, options, reference, insert_seq_file, sample_id, java = "java"):
     rand_dgv_command = [java, utils.JAVA_XMX, "-jar", VARSIMJAR, "randdgv2vcf",
                         "-t", sex,
                         "-seed", str(seed),
@@ -264,7 +609,13 @@ def run_randdgv(dgv_file, out_vcf_fd, log_file_fd, seed, sex, options, reference
                         "-dgv", os.path.realpath(dgv_file)]
     if len(options.output_all.strip()) > 0:
         rand_dgv_command.append(options.output_all)
+    return rand_dgv_command
+
 
+def run_randdgv(dgv_file, out_vcf_fd, log_file_fd, seed, sex, options, reference, insert_seq_file, sample_id, java = "java"):
+    logger = logging.getLogger(run_randdgv.__name__)
+
+    rand_dgv_command = get_randdgv_command(dgv_file, seed, sex, options, reference, insert_seq_file, sample_id, java)
     logger.info("Executing command " + " ".join(rand_dgv_command))
     run_shell_command(rand_dgv_command, cmd_stdout=out_vcf_fd, cmd_stderr=log_file_fd)
 
@@ -292,7 +643,12 @@ def varsim_main(reference,
                 force_five_base_encoding=False,
                 lift_ref=False,
                 disable_vcf2diploid=False,
-                java="java"):
+                vcf2diploid_shards=1,
+                java="java",
+                cores=1,
+                memory=None,
+                stream_liftover=False,
+                original_reference=None):
 
     check_java(java)
 
@@ -307,33 +663,37 @@ def varsim_main(reference,
             raise NotImplementedError("Simulation method {} not implemented".format(simulator))
         check_executable(simulator_exe)
 
-    processes = []
-
     t_s = time.time()
 
+    # every step is a stage started as soon as the stages producing its inputs are done
+    scheduler = StageScheduler(cores, memory)
+    java_memory = utils.get_java_memory()
+
     variant_vcfs = map(os.path.realpath, variant_vcfs)
+    # fill_missing_sequences, RandVCF2VCF and RandDGV2VCF are independent JVMs seeded from their command lines
+    # (randsequencevcf uses its fixed default seed), running them concurrently gives the same VCFs as running them in turn.
+    # stage producing each variant VCF, None for the input VCFs used as they are
+    variant_stages = [None] * len(variant_vcfs)
 
     if sv_insert_seq:
-        in_vcfs = []
         for i, vcf in enumerate(variant_vcfs):
             tool_work_dir = os.path.join(out_dir, "filled_in", str(i))
             makedirs([tool_work_dir])
-            in_vcfs.append(fill_missing_sequences(vcf, sample_id, os.path.realpath(sv_insert_seq), reference, tool_work_dir, tool_work_dir, java))
-        variant_vcfs = map(os.path.realpath, in_vcfs)
+            command, filled_vcf, fill_log = get_fill_missing_sequences_command(vcf, sample_id, os.path.realpath(sv_insert_seq), reference, tool_work_dir, tool_work_dir, java)
+            variant_vcfs[i] = os.path.realpath(filled_vcf)
+            variant_stages[i] = scheduler.add("fill_missing_sequences %d" % (i), [(command, None, fill_log)], memory=java_memory)
     else:
         logger.warn("Not filling in SV sequences since no insert sequence file provided")
 
-    open_fds = []
     if randvcf_options:
         if not sampling_vcf:
             logger.error("Need to provide the VCF for random sampling")
             raise ValueError("Sampling VCF missing")
 
-        rand_vcf_out_fd = open(os.path.join(out_dir, "random.vc.vcf"), "w")
-        rand_vcf_log_fd = open(os.path.join(log_dir, "RandVCF2VCF.err"), "w")
-        variant_vcfs.append(os.path.realpath(rand_vcf_out_fd.name))
-        run_randvcf(os.path.realpath(sampling_vcf), rand_vcf_out_fd, rand_vcf_log_fd, seed, sex, randvcf_options, reference, sample_id, java)
-        open_fds += [rand_vcf_out_fd, rand_vcf_log_fd]
+        rand_vcf_out = os.path.realpath(os.path.join(out_dir, "random.vc.vcf"))
+        rand_vcf_command = get_randvcf_command(os.path.realpath(sampling_vcf), seed, sex, randvcf_options, reference, sample_id, java)
+        variant_vcfs.append(rand_vcf_out)
+        variant_stages.append(scheduler.add("RandVCF2VCF", [(rand_vcf_command, rand_vcf_out, os.path.join(log_dir, "RandVCF2VCF.err"))], memory=java_memory))
 
     if randdgv_options:
         if not sv_insert_seq:
@@ -343,78 +703,133 @@ def varsim_main(reference,
             logger.error("Need to provide the DGV file for random sampling")
             raise ValueError("DGV file missing")
 
-        rand_dgv_stdout = open(os.path.join(out_dir, "random.sv.vcf"), "w")
-        rand_dgv_stderr = open(os.path.join(log_dir, "RandDGV2VCF.err"), "w")
-        variant_vcfs.append(os.path.realpath(rand_dgv_stdout.name))
-        run_randdgv(dgv_file, rand_dgv_stdout, rand_dgv_stderr, seed, sex, randdgv_options, reference, sv_insert_seq, sample_id, java)
-        open_fds += [rand_dgv_stdout, rand_dgv_stderr]
-
-    processes = monitor_processes(processes)
-    for open_fd in open_fds:
-        open_fd.close()
+        rand_dgv_out = os.path.realpath(os.path.join(out_dir, "random.sv.vcf"))
+        rand_dgv_command = get_randdgv_command(dgv_file, seed, sex, randdgv_options, reference, sv_insert_seq, sample_id, java)
+        variant_vcfs.append(rand_dgv_out)
+        variant_stages.append(scheduler.add("RandDGV2VCF", [(rand_dgv_command, rand_dgv_out, os.path.join(log_dir, "RandDGV2VCF.err"))], memory=java_memory))
 
     merged_reference = os.path.join(out_dir, "%s.fa" % (sample_id))
-    merged_truth_vcf = os.path.join(out_dir, "%s.truth.vcf" % (sample_id))
+    merged_truth_vcf = os.path.join(out_dir, "%s.truth.vcf.gz" % (sample_id))
     merged_map = os.path.join(out_dir, "%s.map" % (sample_id))
 
-    processes = run_vcfstats(variant_vcfs, out_dir, log_dir, java)
+    # vcfstats only produces reports, it runs in the background next to the other stages
+    # without taking one of their cores, the run still waits for it and fails with it
+    for vcf, stage in zip(variant_vcfs, variant_stages):
+        vcfstats_command, vcfstats_out, vcfstats_err = get_vcfstats_command(vcf, out_dir, log_dir, java)
+        scheduler.add("vcfstats %s" % (os.path.basename(vcf)), [(vcfstats_command, vcfstats_out, vcfstats_err)],
+                      depends=[stage] if stage else [], cores=0, memory=java_memory)
 
+    # stages the simulated genome and the map depend on
+    genome_stages = []
     if not disable_vcf2diploid:
-        logger.info("vcf2diploid started")
-        vcf2diploid_stdout = open(os.path.join(out_dir, "vcf2diploid.out"), "w")
-        vcf2diploid_stderr = open(os.path.join(log_dir, "vcf2diploid.err"), "w")
         vcf_arg_list = sum([["-vcf", v] for v in variant_vcfs], [])
         filter_arg_list = ["-pass"] if remove_filtered else []
-        vcf2diploid_command = [java, utils.JAVA_XMX, "-jar", VARSIMJAR, "vcf2diploid",
-                               "-t", sex,
-                               "-id", sample_id,
-                               "-chr", os.path.realpath(reference)] + filter_arg_list + vcf_arg_list + ["-no_contig_id"]
-
-        logger.info("Executing command " + " ".join(vcf2diploid_command))
-        run_shell_command(vcf2diploid_command, cmd_stdout=vcf2diploid_stdout, cmd_stderr=vcf2diploid_stderr,
-                                         cmd_dir=out_dir)
-
-        processes = monitor_processes(processes)
-
-        # Now concatenate the .fa from vcf2diploid
-        contigs = get_contigs_list(reference)
-        contig_fastas = map(lambda (x, y): os.path.join(out_dir, "%s_%s_%s.fa" % (x, sample_id, y)), itertools.product(contigs, ["maternal", "paternal"]))
-        fastas_to_cat = filter(os.path.isfile, contig_fastas)
-        concatenate_files(fastas_to_cat, merged_reference, remove_original=True)
-
-        if os.path.getsize(merged_reference) == 0:
-            logger.error("Merged FASTA is empty. Something bad happened. Exiting")
-            raise RuntimeError("Empty FASTA generated by vcf2diploid")
-
-        # contatenate the vcfs
-        vcfs_to_cat = filter(os.path.isfile, map(lambda x: os.path.join(out_dir, "%s_%s.vcf" % (x, sample_id)), contigs))
-        concatenate_files(vcfs_to_cat, merged_truth_vcf, header_str="#", simple_cat=False, remove_original=True)
-
-        run_vcfstats([merged_truth_vcf], out_dir, log_dir, java)
-        logger.info("vcf2diploid done")
+        vcf2diploid_args = ["-jar", VARSIMJAR, "vcf2diploid",
+                            "-t", sex,
+                            "-id", sample_id,
+                            "-chr", os.path.realpath(reference)] + filter_arg_list + vcf_arg_list + ["-no_contig_id"]
+        vcf2diploid_depends = [stage for stage in variant_stages if stage]
+        # output directory of the per-contig outputs of each contig
+        contig_dirs = {}
+        # stages compressing the per-contig VCFs
+        compress_stages = []
+        if vcf2diploid_shards > 1:
+            # each run builds its group of contigs and only draws the random numbers of the others,
+            # so the outputs put together are the same as those of a single run
+            vcf2diploid_stages = []
+            # the variants of each contig are counted once, when the variant VCFs are there
+            contig_variant_bytes = []
+
+            def get_shard_memory(shard):
+                if not contig_variant_bytes:
+                    contig_variant_bytes.append(get_contig_variant_bytes(variant_vcfs))
+                return get_vcf2diploid_memory(shard, contig_variant_bytes[0], java_memory)
+
+            def get_shard_commands(i, shard, shard_dir, shard_memory):
+                vcf2diploid_command = [java, "-Xmx%dm" % (shard_memory >> 20)] + vcf2diploid_args + ["-outdir", shard_dir] + \
+                                      sum([["-contig", contig] for contig, _ in shard], [])
+                return [(vcf2diploid_command, os.path.join(shard_dir, "vcf2diploid.out"), os.path.join(log_dir, "vcf2diploid.%d.err" % (i)))]
+
+            for i, shard in enumerate(shard_contigs(get_contig_lengths(reference), vcf2diploid_shards)):
+                shard_dir = os.path.join(out_dir, "vcf2diploid_shards", str(i))
+                makedirs([shard_dir])
+                vcf2diploid_stages.append(scheduler.add("vcf2diploid %d" % (i), functools.partial(get_shard_commands, i, shard, shard_dir),
+                                                        depends=vcf2diploid_depends, memory=functools.partial(get_shard_memory, shard), cwd=shard_dir))
+                contig_dirs.update((contig, shard_dir) for contig, _ in shard)
+                compress_stages.append(scheduler.add("compress vcf2diploid VCFs %d" % (i),
+                                                     function=functools.partial(compress_contig_vcfs, [contig for contig, _ in shard], shard_dir, sample_id),
+                                                     depends=[vcf2diploid_stages[-1]]))
+        else:
+            vcf2diploid_command = [java, utils.JAVA_XMX] + vcf2diploid_args
+            vcf2diploid_stages = [scheduler.add("vcf2diploid", [(vcf2diploid_command, os.path.join(out_dir, "vcf2diploid.out"), os.path.join(log_dir, "vcf2diploid.err"))],
+                                                depends=vcf2diploid_depends, memory=java_memory, cwd=out_dir)]
+            for i, group in enumerate(shard_contigs(get_contig_lengths(reference), cores)):
+                compress_stages.append(scheduler.add("compress vcf2diploid VCFs %d" % (i),
+                                                     function=functools.partial(compress_contig_vcfs, [contig for contig, _ in group], out_dir, sample_id),
+                                                     depends=vcf2diploid_stages))
+
+        # merged_map is the lifted map after lift_ref
+        vcf2diploid_map = merged_map
+
+        def merge_vcf2diploid_outputs():
+            # Now concatenate the .fa from vcf2diploid
+            contigs = get_contigs_list(reference)
+            contig_fastas = map(lambda (x, y): os.path.join(contig_dirs.get(x, out_dir), "%s_%s_%s.fa" % (x, sample_id, y)), itertools.product(contigs, ["maternal", "paternal"]))
+            fastas_to_cat = filter(os.path.isfile, contig_fastas)
+            concatenate_files(fastas_to_cat, merged_reference, remove_original=True, fasta_index=True)
+
+            if os.path.getsize(merged_reference) == 0:
+                logger.error("Merged FASTA is empty. Something bad happened. Exiting")
+                raise RuntimeError("Empty FASTA generated by vcf2diploid")
+
+            # contatenate the compressed vcfs, with the header of the first one
+            vcfs_to_cat = filter(os.path.isfile, map(lambda x: os.path.join(contig_dirs.get(x, out_dir), "%s_%s.vcf.gz" % (x, sample_id)), contigs))
+            logger.info("Concatenating " + " ".join(vcfs_to_cat) + " as " + merged_truth_vcf)
+            bgzf.concatenate_indexed_vcfs(vcfs_to_cat, merged_truth_vcf)
+            for vcf in vcfs_to_cat:
+                os.remove(vcf)
+                os.remove(vcf + ".tbi")
+
+            if contig_dirs:
+                # the maps of the contigs go in the order a single run builds the contigs, every run lists it
+                with open(os.path.join(contig_dirs[contigs[0]], "%s.contigs" % (sample_id))) as contigs_fd:
+                    built_contigs = [line.rstrip("\n") for line in contigs_fd]
+                maps_to_cat = filter(os.path.isfile, map(lambda x: os.path.join(contig_dirs[x], "%s_%s.map" % (x, sample_id)), built_contigs))
+                concatenate_files(maps_to_cat, vcf2diploid_map, remove_original=True)
+                with open(vcf2diploid_map, "a") as merged_map_fd:
+                    merged_map_fd.write("\n")
+            logger.info("vcf2diploid done")
+
+        merge_stage = scheduler.add("merge vcf2diploid outputs", function=merge_vcf2diploid_outputs, depends=vcf2diploid_stages + compress_stages)
+        vcfstats_command, vcfstats_out, vcfstats_err = get_vcfstats_command(merged_truth_vcf, out_dir, log_dir, java)
+        scheduler.add("vcfstats %s" % (os.path.basename(merged_truth_vcf)), [(vcfstats_command, vcfstats_out, vcfstats_err)],
+                      depends=[merge_stage], cores=0, memory=java_memory)
+        genome_stages = [merge_stage]
 
         if lift_ref:
             lifted_dir = os.path.join(out_dir, "lifted")
             makedirs([lifted_dir])
-            #quick fix for issue of CN
-            convertCN([merged_truth_vcf], "two2one")
-            merged_truth_vcf = lift_vcfs([merged_truth_vcf], os.path.join(lifted_dir, "truth.vcf"), None, tabix_index=False)
-            #quick fix for issue of CN
-            convertCN([merged_truth_vcf], "one2two")
-            pysam.tabix_index(merged_truth_vcf, force=True, preset='vcf')
-            merged_map = lift_maps([merged_map], os.path.join(lifted_dir, "truth.map"))
+            unlifted_map = merged_map
+            merged_map = os.path.join(lifted_dir, "truth.map")
+
+            def restore_cn(line):
+                #copy numbers as converting to a single number and back leaves them
+                return utils.convert_cn(utils.convert_cn(line, "two2one"), "one2two")
+
+            def lift_truth():
+                # one streaming pass from the merged truth VCF to the indexed lifted truth.vcf.gz
+                # the original reference gives the contigs and their order, version sorted without it
+                lift_vcfs([merged_truth_vcf], os.path.join(lifted_dir, "truth.vcf"), original_reference, transform=restore_cn)
+                lift_maps([unlifted_map], merged_map)
 
-    if processes:
-        processes = monitor_processes(processes)
+            genome_stages = [scheduler.add("lift_ref", function=lift_truth, depends=[merge_stage])]
 
     # Now generate the reads using art/pbsim/dwgsim
     tmp_files = []
     if simulator:
         fifos = []
         fastqs = []
-        sim_ts = time.time()
         coverage_per_lane = total_coverage * 0.5 / nlanes
-        processes = []
 
         fifo_src_dst = []
         if simulator == "dwgsim":
@@ -429,97 +844,73 @@ def varsim_main(reference,
         else: # simulator == "longislnd":
             pass
 
+        # the simulators, the processes reading their FIFOs and streamed liftovers all run together
+        simulation_commands = []
+        simulation_memory = 0
+        stream_liftover = stream_liftover and simulator != "longislnd"
         for fifo_name, dst in fifo_src_dst:
             fifos.append(os.path.join(out_dir, fifo_name))
             if os.path.exists(fifos[-1]): os.remove(fifos[-1])
             os.mkfifo(fifos[-1])
+            if stream_liftover:
+                continue
 
-            gzip_stderr = open(os.path.join(log_dir, "gzip.%s" % (fifo_name)), "w")
             gzip_command = "cat %s | gzip -2 > %s" % (fifos[-1], os.path.join(out_dir, dst))
-            logger.info("Executing command %s" % (gzip_command) )
-            gzip_p = subprocess.Popen(gzip_command, stdout = None, stderr = gzip_stderr, shell = True)
-            logger.info( " with pid " + str(gzip_p.pid))
-            processes.append(gzip_p)
+            simulation_commands.append((gzip_command, None, os.path.join(log_dir, "gzip.%s" % (fifo_name))))
             tmp_files.append(os.path.join(out_dir, dst))
 
-        simulator_commands_files = []
+        if stream_liftover:
+            # fastq_liftover reads the simulator FIFOs directly, only the lifted reads get compressed.
+            # All lanes are simulated at once, so all lanes are lifted over at once
+            fifos_by_name = {dst[:-len(".gz")]: os.path.join(out_dir, fifo_name) for fifo_name, dst in fifo_src_dst}
+            for i in xrange(nlanes):
+                fastq_liftover_command = get_fastq_liftover_command(java, merged_map, i, out_dir, simulator, force_five_base_encoding, fifos_by_name)
+                simulation_commands.append((fastq_liftover_command, os.path.join(log_dir, "lane%d.out" % (i)), os.path.join(log_dir, "liftover%d.log" % (i))))
+                simulation_memory += java_memory
+                fastqs += [os.path.join(out_dir, "lane%d.read%d.fq.gz" % (i, end)) for end in [1, 2]]
+
         if simulator == "dwgsim":
             for i in xrange(nlanes):
                 simulator_command = "{} {} -C {} -z {} {} {}".format(os.path.realpath(simulator_exe), simulator_options, coverage_per_lane, seed + i, merged_reference, os.path.join(out_dir, "simulated.lane%d" % (i)))
-                simulator_commands_files.append((simulator_command, os.path.join(log_dir, "dwgsim.lane%d.out" % (i)), os.path.join(log_dir, "dwgsim.lane%d.err" % (i))))
+                simulation_commands.append((simulator_command, os.path.join(log_dir, "dwgsim.lane%d.out" % (i)), os.path.join(log_dir, "dwgsim.lane%d.err" % (i))))
         elif simulator == "art":
             for i in xrange(nlanes):
                 simulator_command = "{} {} -i {} -f {} -rs {} -o {}".format(simulator_exe, simulator_options, merged_reference, coverage_per_lane, seed + i, os.path.join(out_dir, "simulated.lane%d.read" % (i)))
-                simulator_commands_files.append((simulator_command, os.path.join(log_dir, "art.lane%d.out" % (i)), os.path.join(log_dir, "art.lane%d.err" % (i))))
+                simulation_commands.append((simulator_command, os.path.join(log_dir, "art.lane%d.out" % (i)), os.path.join(log_dir, "art.lane%d.err" % (i))))
         else: # simulator == "longislnd":
             simulator_command = "{} {} --coverage {} --out {} --fasta {}".format(simulator_exe, simulator_options, total_coverage * 0.5, os.path.join(out_dir, "longislnd_sim"), merged_reference)
-            simulator_commands_files.append((simulator_command, os.path.join(log_dir, "longislnd.out"), os.path.join(log_dir, "longislnd.err")))
+            simulation_commands.append((simulator_command, os.path.join(log_dir, "longislnd.out"), os.path.join(log_dir, "longislnd.err")))
 
-        simulator_fds = []
-        for command, stdout, stderr in simulator_commands_files:
-            stdout_fd = open(stdout, "w")
-            stderr_fd = open(stderr, "w")
-            process = subprocess.Popen(command, stdout=stdout_fd, stderr=stderr_fd, shell=True, close_fds=True)
-            logger.info("Executing command {} with pid {}".format(command, process.pid))
-            processes.append(process)
-            simulator_fds += [stdout_fd, stderr_fd]
-
-        monitor_processes(processes)
-
-        for fd in simulator_fds:
-            fd.close()
-
-        processes = []
-
-        logger.info("Read generation took %g seconds" % (time.time() - sim_ts))
-
-        sim_t_liftover = time.time()
+        simulation_stage = scheduler.add("read simulation", simulation_commands, depends=genome_stages,
+                                         cores=nlanes if simulator != "longislnd" else 1, memory=simulation_memory)
 
         # Now start lifting over the gzipped files
-        if simulator != "longislnd":
+        if stream_liftover:
+            logger.info("Reads are lifted over during simulation")
+        elif simulator != "longislnd":
             for i in xrange(nlanes):
-                liftover_stdout = open(os.path.join(log_dir, "lane%d.out" % (i)), "w")
-                liftover_stderr = open(os.path.join(log_dir, "liftover%d.log" % (i)), "w")
-                fastq_liftover_command = "%s -server %s -jar %s fastq_liftover -map %s -id %d " \
-                                         "-fastq <(gunzip -c %s/simulated.lane%d.read1.fq.gz) " \
-                                         "-fastq <(gunzip -c %s/simulated.lane%d.read2.fq.gz) " \
-                                         "-out >(gzip -1 > %s/lane%d.read1.fq.gz) " \
-                                         "-out >(gzip -1 > %s/lane%d.read2.fq.gz)" % (
-                                             java,
-                                             utils.JAVA_XMX, 
-                                             VARSIMJAR, merged_map, i, out_dir, i,
-                                             out_dir, i, out_dir, i,
-                                             out_dir, i)
-                if force_five_base_encoding:
-                    fastq_liftover_command += " -force_five_base_encoding "
-                if simulator == "art":
-                    fastq_liftover_command += " -type art " \
-                                              "-aln <(gunzip -c %s/simulated.lane%d.read1.aln.gz) " \
-                                              "-aln <(gunzip -c %s/simulated.lane%d.read2.aln.gz)" % (
-                                                  out_dir, i, out_dir, i)
-                elif simulator == "pbsim":
-                    fastq_liftover_command += " -type pbsim " \
-                                              "-maf <(gunzip -c %s/simulated.lane%d.read1.maf.gz) " \
-                                              "-ref %s/simulated.lane%d.ref " % (out_dir, i, out_dir, i)
-                fastq_liftover_command = "bash -c \"%s\"" % (fastq_liftover_command)
-                logger.info("Executing command " + fastq_liftover_command)
-                run_shell_command(fastq_liftover_command, cmd_stdout = liftover_stdout, cmd_stderr = liftover_stderr)
-                fastqs.append(os.path.join(out_dir, "lane%d.read%d.fq.gz" % (i, end)))
+                fastq_liftover_command = get_fastq_liftover_command(java, merged_map, i, out_dir, simulator, force_five_base_encoding)
+                scheduler.add("fastq_liftover lane%d" % (i), [(fastq_liftover_command, os.path.join(log_dir, "lane%d.out" % (i)), os.path.join(log_dir, "liftover%d.log" % (i)))],
+                              depends=[simulation_stage], memory=java_memory)
+                fastqs += [os.path.join(out_dir, "lane%d.read%d.fq.gz" % (i, end)) for end in [1, 2]]
         else:
             # liftover the read map files
-            read_map_files = list(glob.glob(os.path.join(out_dir, "longislnd_sim", "*.bed")))
             merged_raw_readmap = os.path.join(out_dir, "longislnd_sim", "merged_readmap.bed")
-            concatenate_files(read_map_files, merged_raw_readmap)
-            read_maps = "-longislnd %s" % merged_raw_readmap 
-            read_map_liftover_command = "%s %s -server -jar %s longislnd_liftover " % (java, utils.JAVA_XMX, VARSIMJAR) + read_maps + " -map %s " % merged_map + " -out %s" % (os.path.join(out_dir, sample_id + ".truth.map"))
-            read_map_liftover_stderr = open(os.path.join(log_dir, "longislnd_liftover.err"), "w")
-            logger.info("Executing command " + read_map_liftover_command )
-            run_shell_command(read_map_liftover_command, cmd_stdout = None, cmd_stderr = read_map_liftover_stderr)
 
-        monitor_processes(processes)
+            def merge_read_maps():
+                read_map_files = list(glob.glob(os.path.join(out_dir, "longislnd_sim", "*.bed")))
+                concatenate_files(read_map_files, merged_raw_readmap)
 
-        logger.info("Liftover took %g seconds" % (time.time() - sim_t_liftover))
+            merge_read_maps_stage = scheduler.add("merge read maps", function=merge_read_maps, depends=[simulation_stage])
+            read_maps = "-longislnd %s" % merged_raw_readmap
+            read_map_liftover_command = "%s %s -server -jar %s longislnd_liftover " % (java, utils.JAVA_XMX, VARSIMJAR) + read_maps + " -map %s " % merged_map + " -out %s" % (os.path.join(out_dir, sample_id + ".truth.map"))
+            scheduler.add("longislnd_liftover", [(read_map_liftover_command, None, os.path.join(log_dir, "longislnd_liftover.err"))],
+                          depends=[merge_read_maps_stage], memory=java_memory)
+
+    scheduler.run()
 
+    if simulator:
+        sim_ts = simulation_stage.started
         sim_te = max(sim_ts + 1, time.time())
         bytes_written = sum([os.path.getsize(fastq) for fastq in fastqs])
         logger.info("Took %g seconds, %ld Mbytes written, %g MB/s" % (
@@ -578,8 +969,12 @@ if __name__ == "__main__":
     main_parser.add_argument("--filter", action="store_true", help="Only use PASS variants for simulation")
     main_parser.add_argument("--keep_temp", action="store_true", help="Keep temporary files after simulation")
     main_parser.add_argument("--lift_ref", action="store_true", help="Liftover chromosome names from restricted reference")
+    main_parser.add_argument("--stream_liftover", action="store_true", help="Feed the simulated reads to fastq_liftover as they are generated instead of compressing them to disk first. All lanes are then lifted over at once")
     main_parser.add_argument("--java_max_mem", metavar="XMX", help="max java memory", default="10g", type = str)
-    main_parser.add_argument('--version', action='version', version=get_version())
+    main_parser.add_argument("--cores", metavar="INTEGER", help="Number of cores available for running independent pipeline steps concurrently", default=1, type=int)
+    main_parser.add_argument("--memory", metavar="MEM", help="Total memory available for concurrent pipeline steps (e.g. 64g), each Java step takes --java_max_mem. Not limited if not specified", default=None, type=str)
+    main_parser.add_argument("--vcf2diploid_shards", metavar="INTEGER", help="Build the diploid genome with up to this many concurrent vcf2diploid runs over groups of contigs, each with a heap sized to its contigs (at most --java_max_mem). The output is the same as with a single run", default=1, type=int)
+    main_parser.add_argument('--version', action=utils.VersionAction)
     main_parser.add_argument('--log_to_stderr', action='store_true', help='Output log to stderr instead of log_dir/varsim.log')
     main_parser.add_argument("--loglevel", help="Set logging level", choices=["debug", "warn", "info"], default="info")
 
@@ -718,4 +1113,8 @@ if __name__ == "__main__":
                 force_five_base_encoding=args.force_five_base_encoding,
                 lift_ref=args.lift_ref,
                 disable_vcf2diploid=args.disable_vcf2diploid,
-                java=args.java)
+                vcf2diploid_shards=args.vcf2diploid_shards,
+                java=args.java,
+                cores=args.cores,
+                memory=args.memory,
+                stream_liftover=args.stream_liftover)
@@ -14,15 +14,253 @@ import itertools
 import glob
 import tempfile
 import re
+import errno
+import Queue
+import multiprocessing
+from collections import OrderedDict
 from distutils.version import LooseVersion
 from liftover_restricted_vcf_map import lift_vcfs, lift_maps
 from generate_small_test_ref import gen_restricted_ref_and_vcfs 
-from varsim import varsim_main, RandVCFOptions, RandDGVOptions, run_randvcf, run_randdgv, randdgv_options2randvcf_options, convertCN
-import pybedtools
-import pysam
+from varsim import varsim_main, RandVCFOptions, RandDGVOptions, run_randdgv, randdgv_options2randvcf_options, get_randvcf_command, StageScheduler
 from utils import check_simulator_opts, sort_and_compress, get_version, get_loglevel, makedirs, check_java
 import utils
 
+#seconds between checks that the pool processes of the running samples are alive
+SAMPLE_JOB_CHECK_SECONDS = 10
+#queue of (sample, pid) put by each sample job as it starts, in the pool processes
+STARTED_SAMPLE_JOBS = None
+
+def simulate_sample(reference,
+                    restricted_reference,
+                    simulator,
+                    simulator_exe,
+                    coverage,
+                    sample,
+                    sample_dir,
+                    sample_seed,
+                    sample_variant_vcfs,
+                    sampling_vcf,
+                    dgv_file,
+                    dgv_vcf,
+                    regions,
+                    randvcf_options,
+                    randdgv_options,
+                    nlanes,
+                    simulator_options,
+                    sv_insert_seq,
+                    sex,
+                    remove_filtered,
+                    keep_temp,
+                    force_five_base_encoding,
+                    lift_ref,
+                    disable_vcf2diploid,
+                    java,
+                    cores,
+                    memory,
+                    java_max_mem=None):
+    '''
+    sample the variants of one sample and run varsim_main on them
+    :param java_max_mem: Java heap of the steps of the sample, e.g. 4096m, JAVA_XMX is left as it is if None
+    '''
+    logger = logging.getLogger(simulate_sample.__name__)
+    if java_max_mem:
+        #JAVA_XMX is global to the process simulating the sample
+        utils.JAVA_XMX = "-Xmx" + java_max_mem
+    makedirs([sample_dir])
+    logger.info("Simulating sample {} in {}".format(sample, sample_dir))
+
+    # Run RandVCF first to get the sampled variants for the sample.
+    # The small variant and SV samplings are independent JVMs seeded from their command lines,
+    # so running them concurrently gives the same output as running them one after the other
+    scheduler = StageScheduler(cores, memory)
+    if randvcf_options and sampling_vcf:
+        sampled_vcf = os.path.join(sample_dir, "randvcf.vcf")
+        randvcf_command = get_randvcf_command(sampling_vcf, sample_seed, sex, randvcf_options, reference, sample, java)
+        scheduler.add("RandVCF2VCF", [(randvcf_command, sampled_vcf, os.path.join(sample_dir, "randvcf.err"))], memory=utils.get_java_memory())
+    if randdgv_options and dgv_vcf:
+        sampled_dgv_vcf = os.path.join(sample_dir, "randdgvvcf.vcf")
+        randdgvvcf_command = get_randvcf_command(dgv_vcf, sample_seed, sex, randdgv_options2randvcf_options(randdgv_options), reference, sample, java)
+        scheduler.add("RandVCF2VCF DGV", [(randdgvvcf_command, sampled_dgv_vcf, os.path.join(sample_dir, "randdgvvcf.err"))], memory=utils.get_java_memory())
+    scheduler.run()
+
+    if randvcf_options and sampling_vcf:
+        sampled_vcf = sort_and_compress(sampled_vcf, reference = reference)
+        # Now generate the restricted sampled VCF for the sample
+        _, [restricted_sampled_vcf] = gen_restricted_ref_and_vcfs(reference, [sampled_vcf], regions, [], os.path.join(sample_dir, "restricted_randvcf"), flank=0)
+        sample_variant_vcfs = sample_variant_vcfs + [restricted_sampled_vcf]
+
+    if randdgv_options and dgv_vcf:
+        # copy numbers are split over the alleles while sorting, restricting leaves them as they are
+        sampled_dgv_vcf = sort_and_compress(sampled_dgv_vcf, reference = reference, transform = lambda l: utils.convert_cn(l, "one2two"))
+        # Now generate the restricted sampled dgv VCF for the sample
+        _, [restricted_sampled_dgv_vcf] = gen_restricted_ref_and_vcfs(reference, [sampled_dgv_vcf], regions, [], os.path.join(sample_dir, "restricted_randdgvvcf"), flank=0)
+        sample_variant_vcfs = sample_variant_vcfs + [restricted_sampled_dgv_vcf]
+
+    varsim_main(restricted_reference,
+                simulator,
+                simulator_exe,
+                coverage,
+                sample_variant_vcfs,
+                None,
+                dgv_file,
+                None,
+                randdgv_options,
+                nlanes,
+                simulator_options,
+                sample,
+                os.path.join(sample_dir, "log"),
+                os.path.join(sample_dir, "out"),
+                sv_insert_seq,
+                sample_seed,
+                sex,
+                remove_filtered,
+                keep_temp,
+                force_five_base_encoding,
+                lift_ref,
+                disable_vcf2diploid,
+                java = java,
+                cores = cores,
+                memory = memory,
+                original_reference = reference)
+
+
+def simulate_sample_job(kwargs):
+    '''
+    run simulate_sample in a pool process, logging to varsim.log in the directory of the sample
+    :return: (sample, None) on success, (sample, error) on failure
+    '''
+    STARTED_SAMPLE_JOBS.put((kwargs["sample"], os.getpid()))
+    root = logging.getLogger()
+    formatter = root.handlers[0].formatter if root.handlers else None
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    makedirs([kwargs["sample_dir"]])
+    handler = logging.FileHandler(os.path.join(kwargs["sample_dir"], "varsim.log"), mode="w")
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+    return run_sample(kwargs)
+
+
+def run_sample(kwargs):
+    '''
+    :return: (sample, None) on success, (sample, error) on failure
+    '''
+    logger = logging.getLogger(run_sample.__name__)
+    try:
+        simulate_sample(**kwargs)
+    except Exception, e:
+        logger.exception("Sample {} failed".format(kwargs["sample"]))
+        return kwargs["sample"], str(e)
+    return kwargs["sample"], None
+
+
+def init_sample_job(started_sample_jobs):
+    global STARTED_SAMPLE_JOBS
+    STARTED_SAMPLE_JOBS = started_sample_jobs
+    #a terminated job kills its running commands like on Ctrl-C
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, terminate)
+
+
+def is_process_alive(pid):
+    '''
+    :return: False if the process is gone, or exited and not yet reaped
+    '''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    try:
+        with open("/proc/{}/stat".format(pid)) as stat_fd:
+            return stat_fd.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except IOError:
+        return True
+
+
+def get_lost_sample_jobs(results, started_sample_jobs, pids):
+    '''
+    :param results: sample -> AsyncResult of the sample jobs not done
+    :param started_sample_jobs: queue of (sample, pid) of the started sample jobs, read into pids
+    :return: samples whose pool process died (e.g. killed by the OOM killer) without a result
+    '''
+    while True:
+        try:
+            sample, pid = started_sample_jobs.get_nowait()
+        except Queue.Empty:
+            break
+        pids[sample] = pid
+    lost = []
+    for sample, result in results.iteritems():
+        if sample in pids and not is_process_alive(pids[sample]):
+            #the result may still be on its way from a process that just exited
+            result.wait(SAMPLE_JOB_CHECK_SECONDS)
+            if not result.ready():
+                lost.append(sample)
+    return lost
+
+
+def run_sample_jobs_in_pool(sample_jobs, jobs, out_dir, fail_fast=False):
+    '''
+    run simulate_sample_job on each sample with a pool of jobs processes
+    :param fail_fast: stop at the first failed sample
+    :return: failed samples
+    '''
+    logger = logging.getLogger(run_sample_jobs_in_pool.__name__)
+    failed = []
+    #one process per sample so that each sample has its own log
+    started_sample_jobs = multiprocessing.Queue()
+    def new_pool():
+        return multiprocessing.Pool(jobs, init_sample_job, (started_sample_jobs,), maxtasksperchild=1)
+    pools = [new_pool()]
+    try:
+        done = Queue.Queue()
+        #in the order of the samples. A pool is given at most one sample per process,
+        #so that no sample waits in a pool that lost a process
+        pending = list(sample_jobs)
+        results = OrderedDict()
+        pids = {}
+        while pending or results:
+            while pending and len(results) < jobs:
+                sample_job = pending.pop(0)
+                results[sample_job["sample"]] = pools[-1].apply_async(simulate_sample_job, (sample_job,), callback=done.put)
+            #a timeout keeps the wait interruptible by Ctrl-C, and dead pool processes are looked for meanwhile
+            try:
+                sample, error = done.get(timeout=SAMPLE_JOB_CHECK_SECONDS)
+            except Queue.Empty:
+                lost = get_lost_sample_jobs(results, started_sample_jobs, pids)
+                if not lost:
+                    continue
+                for sample in lost:
+                    logger.error("Sample {} failed: its process {} died. See {}".format(sample, pids[sample], os.path.join(out_dir, sample, "varsim.log")))
+                    del results[sample]
+                    failed.append(sample)
+                if fail_fast:
+                    break
+                #the samples running finish in the pool that lost a process, the next ones go to a new pool
+                pools[-1].close()
+                pools.append(new_pool())
+                continue
+            if sample not in results:
+                #given up as lost already
+                continue
+            del results[sample]
+            if error is None:
+                logger.info("Sample {} done".format(sample))
+                continue
+            logger.error("Sample {} failed: {}. See {}".format(sample, error, os.path.join(out_dir, sample, "varsim.log")))
+            failed.append(sample)
+            if fail_fast:
+                break
+        for pool in pools:
+            pool.close()
+    finally:
+        for pool in pools:
+            pool.terminate()
+            pool.join()
+    return failed
+
+
 def varsim_multi(reference,
                  simulator,
                  simulator_exe,
@@ -46,101 +284,123 @@ def varsim_multi(reference,
                  lift_ref=False,
                  disable_vcf2diploid=False,
                  samples_random=0,
-                 java = "java"):
+                 java = "java",
+                 cores = 1,
+                 memory = None,
+                 jobs = 1,
+                 fail_fast = False,
+                 cache_dir = None):
     logger = logging.getLogger(varsim_multi.__name__)
 
     makedirs([out_dir])
 
-    restricted_dir = os.path.join(out_dir, "restricted")
+    def restrict(build_dir):
+        return gen_restricted_ref_and_vcfs(reference, variant_vcfs, regions, samples, os.path.join(build_dir, "restricted"), flank=0, short_contig_names=False)
 
-    restricted_reference, restricted_vcfs = gen_restricted_ref_and_vcfs(reference, variant_vcfs, regions, samples, restricted_dir, flank=0, short_contig_names=False)
+    #derived inputs are shared through the cache by runs with the same inputs
+    restricted_reference, restricted_vcfs = utils.cached_build(cache_dir if regions else None, "restricted", [reference, regions] + variant_vcfs,
+                                                               {"samples": samples}, restrict, out_dir)
     dgv_vcf = None
 
+    if regions:
+        merged_bed = os.path.join(out_dir, "merged.bed")
+        import pybedtools
+        pybedtools.BedTool(regions).merge().saveas(merged_bed)
+
     if dgv_file:
         assert sv_insert_seq, "SV insertion sequence file is required."
-        dgv_vcf_dir = os.path.join(out_dir,"tmp")
-        makedirs([dgv_vcf_dir])
-        dgv_vcf = os.path.join(dgv_vcf_dir, "dgv.vcf")
         makedirs([os.path.join(out_dir, "log")])
         dgv_err_file = os.path.join(out_dir, "log", "dgv2vcf.err")
         randdgv_options2vcf = copy.copy(randdgv_options)
         randdgv_options2vcf.output_all = "-all"
-        with open(dgv_vcf, "w") as dgv2vcf_out, open(dgv_err_file, "w") as dgv2vcf_log:
-            # set sample ID to empty string such that it can be used with arbitrary sample name in randvcf
-            run_randdgv(dgv_file, dgv2vcf_out, dgv2vcf_log, seed, sex, randdgv_options2vcf, reference, sv_insert_seq, "", java)
 
-    if regions:
-        merged_bed = os.path.join(out_dir, "merged.bed")
-        pybedtools.BedTool(regions).merge().saveas(merged_bed)
-        restricted_dir = os.path.join(out_dir, "region_restricted")
-        if sampling_vcf:
+        def convert_dgv(build_dir):
+            dgv_vcf_dir = os.path.join(build_dir, "tmp")
+            makedirs([dgv_vcf_dir])
+            dgv_vcf = os.path.join(dgv_vcf_dir, "dgv.vcf")
+            with open(dgv_vcf, "w") as dgv2vcf_out, open(dgv_err_file, "w") as dgv2vcf_log:
+                # set sample ID to empty string such that it can be used with arbitrary sample name in randvcf
+                run_randdgv(dgv_file, dgv2vcf_out, dgv2vcf_log, seed, sex, randdgv_options2vcf, reference, sv_insert_seq, "", java)
+            if regions:
+                restricted_dir = os.path.join(build_dir, "region_restricted")
+                dgv_vcf = sort_and_compress(dgv_vcf, reference = reference, transform = lambda l: utils.convert_cn(l, "two2one"))
+                _, [restricted_dgv_vcf] = gen_restricted_ref_and_vcfs(reference, [dgv_vcf], merged_bed, [], restricted_dir , flank=0)
+                # Now lift over the restricted_dgv_vcf to get the region-limited VCF
+                dgv_vcf = lift_vcfs([restricted_dgv_vcf], os.path.join(restricted_dir, "region-restricted-dgv.vcf"), reference)
+            return dgv_vcf
+
+        dgv_vcf = utils.cached_build(cache_dir, "dgv", [dgv_file, reference, sv_insert_seq, regions, utils.VARSIMJAR],
+                                     {"seed": seed, "sex": sex, "options": vars(randdgv_options2vcf)}, convert_dgv, out_dir)
+
+    if regions and sampling_vcf:
+        def restrict_sampling(build_dir):
+            restricted_dir = os.path.join(build_dir, "region_restricted")
             _, [restricted_sampling_vcf] = gen_restricted_ref_and_vcfs(reference, [sampling_vcf], merged_bed, [], restricted_dir , flank=0)
             # Now lift over the restricted_sampling_vcf to get the region-limited VCF
-            sampling_vcf = lift_vcfs([restricted_sampling_vcf], os.path.join(restricted_dir, "region-restricted-sampling.vcf"), reference)
-        if dgv_vcf:
-            convertCN([dgv_vcf], "two2one")
-            dgv_vcf = sort_and_compress(dgv_vcf)
-            _, [restricted_dgv_vcf] = gen_restricted_ref_and_vcfs(reference, [dgv_vcf], merged_bed, [], restricted_dir , flank=0)
-            # Now lift over the restricted_dgv_vcf to get the region-limited VCF
-            dgv_vcf = lift_vcfs([restricted_dgv_vcf], os.path.join(restricted_dir, "region-restricted-dgv.vcf"), reference)
+            return lift_vcfs([restricted_sampling_vcf], os.path.join(restricted_dir, "region-restricted-sampling.vcf"), reference)
+
+        sampling_vcf = utils.cached_build(cache_dir, "sampling", [sampling_vcf, reference, regions], {}, restrict_sampling, out_dir)
 
     all_samples = samples + ["VarSim%d" % i for i in xrange(samples_random)]
 
+    job_cores = max(1, cores / jobs)
+    job_memory = str(utils.parse_memory(memory) / jobs) if memory else None
+    #the Java heap of each job fits in its share of the memory
+    java_memory = utils.get_java_memory()
+    if job_memory and (not java_memory or java_memory > int(job_memory)):
+        java_memory = int(job_memory)
+        logger.warning("Java steps of each job run with a heap of {}m to fit {} jobs in {} of memory".format(java_memory >> 20, jobs, memory))
+    job_java_max_mem = "{}m".format(max(1, java_memory >> 20)) if java_memory else None
+
+    sample_jobs = []
     for index, (sample, coverage) in enumerate(zip(all_samples, total_coverage)):
-        sample_dir = os.path.join(out_dir, sample)
-        sample_seed = seed + 1000 * index
-        makedirs([sample_dir])
-        logger.info("Simulating sample {} in {}".format(sample, sample_dir))
-        sample_variant_vcfs = list(restricted_vcfs if index < len(samples) else [])
-
-        # Run RandVCF first to get the sampled variants for the sample
-        if randvcf_options and sampling_vcf:
-            sampled_vcf = os.path.join(sample_dir, "randvcf.vcf")
-            with open(sampled_vcf, "w") as randvcf_out, open(os.path.join(sample_dir, "randvcf.err"), "w") as randvcf_log:
-                run_randvcf(sampling_vcf, randvcf_out, randvcf_log, sample_seed, sex, randvcf_options, reference, sample, java)
-            sampled_vcf = sort_and_compress(sampled_vcf)
-            # Now generate the restricted sampled VCF for the sample
-            _, [restricted_sampled_vcf] = gen_restricted_ref_and_vcfs(reference, [sampled_vcf], regions, [], os.path.join(sample_dir, "restricted_randvcf"), flank=0)
-            sample_variant_vcfs = sample_variant_vcfs + [restricted_sampled_vcf]
-
-        if randdgv_options and dgv_vcf:
-            sampled_dgv_vcf = os.path.join(sample_dir, "randdgvvcf.vcf")
-            randdgvvcf_options = randdgv_options2randvcf_options(randdgv_options)
-            with open(sampled_dgv_vcf, "w") as randdgvvcf_out, open(os.path.join(sample_dir, "randdgvvcf.err"), "w") as randdgvvcf_log:
-                run_randvcf(dgv_vcf, randdgvvcf_out, randdgvvcf_log, sample_seed, sex, randdgvvcf_options, reference, sample, java)
-            sampled_dgv_vcf = sort_and_compress(sampled_dgv_vcf)
-            # Now generate the restricted sampled dgv VCF for the sample
-            _, [restricted_sampled_dgv_vcf] = gen_restricted_ref_and_vcfs(reference, [sampled_dgv_vcf], regions, [], os.path.join(sample_dir, "restricted_randdgvvcf"), flank=0)
-            convertCN([restricted_sampled_dgv_vcf], "one2two")
-            sample_variant_vcfs = sample_variant_vcfs + [restricted_sampled_dgv_vcf]
-
-        varsim_main(restricted_reference,
-                    simulator,
-                    simulator_exe,
-                    coverage,
-                    sample_variant_vcfs,
-                    None,
-                    dgv_file,
-                    None,
-                    randdgv_options,
-                    nlanes,
-                    simulator_options,
-                    sample,
-                    os.path.join(sample_dir, "log"),
-                    os.path.join(sample_dir, "out"),
-                    sv_insert_seq,
-                    sample_seed,
-                    sex,
-                    remove_filtered,
-                    keep_temp,
-                    force_five_base_encoding,
-                    lift_ref,
-                    disable_vcf2diploid,
-                    java = java)
+        sample_jobs.append(dict(reference=reference,
+                                restricted_reference=restricted_reference,
+                                simulator=simulator,
+                                simulator_exe=simulator_exe,
+                                coverage=coverage,
+                                sample=sample,
+                                sample_dir=os.path.join(out_dir, sample),
+                                sample_seed=seed + 1000 * index,
+                                sample_variant_vcfs=list(restricted_vcfs if index < len(samples) else []),
+                                sampling_vcf=sampling_vcf,
+                                dgv_file=dgv_file,
+                                dgv_vcf=dgv_vcf,
+                                regions=regions,
+                                randvcf_options=randvcf_options,
+                                randdgv_options=randdgv_options,
+                                nlanes=nlanes,
+                                simulator_options=simulator_options,
+                                sv_insert_seq=sv_insert_seq,
+                                sex=sex,
+                                remove_filtered=remove_filtered,
+                                keep_temp=keep_temp,
+                                force_five_base_encoding=force_five_base_encoding,
+                                lift_ref=lift_ref,
+                                disable_vcf2diploid=disable_vcf2diploid,
+                                java=java,
+                                cores=job_cores,
+                                memory=job_memory,
+                                java_max_mem=job_java_max_mem))
+
+    failed = []
+    if jobs > 1:
+        logger.info("Simulating {} samples with {} jobs, each with {} cores and {} memory".format(len(sample_jobs), jobs, job_cores, job_memory))
+        failed = run_sample_jobs_in_pool(sample_jobs, jobs, out_dir, fail_fast)
+    else:
+        for sample_job in sample_jobs:
+            sample, error = run_sample(sample_job)
+            if error is not None:
+                failed.append(sample)
+                if fail_fast:
+                    break
 
     with open(os.path.join(out_dir, "samples.txt"), "w") as samples_fd:
         samples_fd.write("\n".join(all_samples))
 
+    if failed:
+        raise Exception("Samples {} failed".format(", ".join(failed)))
+
 
 if __name__ == "__main__":
     main_parser = argparse.ArgumentParser(description="VarSim: A high-fidelity simulation validation framework",
@@ -171,8 +431,13 @@ if __name__ == "__main__":
     main_parser.add_argument("--keep_temp", action="store_true", help="Keep temporary files after simulation")
     main_parser.add_argument("--lift_ref", action="store_true", help="Liftover chromosome names from restricted reference")
     main_parser.add_argument("--java_max_mem", metavar="XMX", help="max java memory", default="10g", type = str)
+    main_parser.add_argument("--cores", metavar="INTEGER", help="Number of cores available for running independent pipeline steps concurrently", default=1, type=int)
+    main_parser.add_argument("--memory", metavar="MEM", help="Total memory available for concurrent pipeline steps (e.g. 64g), each Java step takes --java_max_mem. Not limited if not specified", default=None, type=str)
+    main_parser.add_argument("--jobs", metavar="INTEGER", help="Number of samples simulated concurrently, each with its own log in its directory. --cores and --memory are split between the jobs, and the Java heap of each job is capped to its share of --memory", default=1, type=int)
+    main_parser.add_argument("--fail_fast", action="store_true", help="Stop all samples as soon as one fails, instead of finishing the others")
+    main_parser.add_argument("--cache_dir", metavar="DIR", help="Directory to cache the restricted reference and VCFs and the converted DGV VCF in. Runs with the same inputs and parameters reuse them. Not cached if not specified", default=None, type=str)
     main_parser.add_argument("--java", metavar="PATH", help="path to java", default="java", type = str)
-    main_parser.add_argument('--version', action='version', version=get_version())
+    main_parser.add_argument('--version', action=utils.VersionAction)
     main_parser.add_argument('--log_to_stderr', action='store_true', help='Output log to stderr instead of log_dir/varsim.log')
     main_parser.add_argument("--loglevel", help="Set logging level", choices=["debug", "warn", "info"], default="info")
 
@@ -291,4 +556,9 @@ if __name__ == "__main__":
                  lift_ref=args.lift_ref,
                  disable_vcf2diploid=args.disable_vcf2diploid,
                  samples_random=args.samples_random,
-                 java = args.java)
+                 java = args.java,
+                 cores = args.cores,
+                 memory = args.memory,
+                 jobs = args.jobs,
+                 fail_fast = args.fail_fast,
+                 cache_dir = args.cache_dir)
@@ -53,7 +53,7 @@ def varsim_somatic_main():
     main_parser.add_argument("--java_max_mem", metavar="XMX", help="max java memory", default="10g", type = str)
     main_parser.add_argument("--java", metavar="PATH", help="path to java", default="java", type = str)
     main_parser.add_argument("--python", metavar="PATH", help="path to python", default="python", type = str)
-    main_parser.add_argument('--version', action='version', version=get_version())
+    main_parser.add_argument('--version', action=utils.VersionAction)
 
 
     input_vcf_group = main_parser.add_argument_group("Input VCFs options")
@@ -200,18 +200,18 @@ def varsim_somatic_main():
 		      "--sv_insert_seq", args.sv_insert_seq.name] + other_varsim_opts + vcf_arg_list + filter_arg_list + disable_sim_arg_list \
                      + force_five_base_encoding_arg_list + keep_temp_arg_list + profile_1_arg_list + profile_2_arg_list
     varsim_command = " ".join(varsim_command)
-    p_varsim = subprocess.Popen(varsim_command, stdout=varsim_stdout, stderr=varsim_stderr, shell=True)
+    p_varsim = subprocess.Popen(varsim_command, stdout=varsim_stdout, stderr=varsim_stderr, shell=True, preexec_fn=os.setsid)
     logger.info("Executing command " + varsim_command + " with pid " + str(p_varsim.pid))
     processes.append(p_varsim)
 
     processes = monitor_processes(processes)
 
     # Split the tumor truth VCF into normal variants and somatic variants
-    tumor_vcf = os.path.realpath(os.path.join(args.out_dir, "%s.truth.vcf" % args.id))
+    tumor_vcf = os.path.realpath(os.path.join(args.out_dir, "%s.truth.vcf.gz" % args.id))
     normal_vcf = os.path.join(args.out_dir, "%s_norm.vcf" % args.id)
     somatic_vcf = os.path.join(args.out_dir, "%s_somatic.vcf" % args.id)
     logger.info("Splitting the truth VCF %s into normal and somatic VCFs" % tumor_vcf)
-    with open(tumor_vcf, "r") as tumor_truth_fd, \
+    with utils.versatile_open(tumor_vcf, "r") as tumor_truth_fd, \
         open(normal_vcf, "w") as normal_vcf_fd, \
         open(somatic_vcf, "w") as somatic_vcf_fd:
         for line in tumor_truth_fd:
@@ -224,7 +224,7 @@ def varsim_somatic_main():
             else:
                 normal_vcf_fd.write(line)
 
-    run_vcfstats([normal_vcf, somatic_vcf], args.out_dir, args.log_dir, args.java)
+    monitor_processes(run_vcfstats([normal_vcf, somatic_vcf], args.out_dir, args.log_dir, args.java))
 
     logger.info("Done! (%g hours)" % ((time.time() - t_s) / 3600.0))
 
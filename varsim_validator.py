@@ -88,7 +88,8 @@ def varsim_multi_validation(regions, samples, varsim_dirs, variants_dirs, out_di
    
     samples_found = {}
     for sample in samples:
-        truth = filter(os.path.isfile, map(lambda d: os.path.join(d, sample, "out", "lifted", "truth.vcf"), varsim_dirs))
+        #the lifted truth is written as truth.vcf.gz with a tabix index, older runs wrote truth.vcf
+        truth = filter(os.path.isfile, [os.path.join(d, sample, "out", "lifted", name) for d in varsim_dirs for name in ["truth.vcf.gz", "truth.vcf"]])
         called = filter(os.path.isfile, map(lambda d: os.path.join(d, sample, "{}.vcf".format(sample)), variants_dirs))
         if truth and called:
             samples_found[sample] = {"truth": truth[0], "called": called[0]}
@@ -108,7 +109,7 @@ def varsim_multi_validation(regions, samples, varsim_dirs, variants_dirs, out_di
             command = "{} {} -jar {} vcfcompare {} -true_vcf {} -prefix {} {}".format(java, utils.JAVA_XMX, VARSIMJAR, vcfcompare_options, sample_truth, os.path.join(sample_dir, sample), sample_called)
 
             with open(os.path.join(sample_dir, "vcfcompare.out"), "w") as stdout, open(os.path.join(sample_dir, "vcfcompare.err"), "w") as stderr:
-                subprocess.check_call(command, shell=True, stdout=stdout, stderr=stderr)
+                utils.run_shell_command(command, stdout, stderr)
 
         report_json = os.path.join(sample_dir, "{}_report.json".format(sample))
 
@@ -166,7 +167,7 @@ if __name__ == "__main__":
     parser.add_argument("--disable_vcfcompare", action="store_true", help="Do not run VCFcompare if already ran")
     parser.add_argument("--java_max_mem", metavar="XMX", help="max java memory", default="10g", type = str)
     parser.add_argument("--java", metavar="PATH", help="path to java", default="java", type = str)
-    parser.add_argument('--version', action='version', version=get_version())
+    parser.add_argument('--version', action=utils.VersionAction)
     parser.add_argument("--loglevel", help="Set logging level", choices=["debug", "warn", "info"], default="info")
 
     args = parser.parse_args()